@@ -15,15 +15,553 @@
 
 from collections import Counter
 from collections import defaultdict
+from multiprocessing import Pool
+import hashlib
+from itertools import chain
+import json
+import os
 
+import numpy as np
 import pysam
 from tqdm import tqdm
 
-from .common import is_read_uniq_mapping
+from .common import ReadFilter
+from .common import mkdir_p
+from .coverage import CoverageStore
 
+# Number of regions to create per worker process, so that
+# the work remains balanced when chromosomes differ in size
+REGIONS_PER_THREAD = 4
+# Number of reads decoded at once
+READ_BLOCK_SIZE = 1 << 16
+# M, =, X
+__CIGAR_ALIGNED_OPS__ = (0, 7, 8)
+# D, N: reference positions without aligned bases
+__CIGAR_REFERENCE_GAP_OPS__ = (2, 3)
+# Bumped whenever the layout of coverage cache files changes
+COVERAGE_CACHE_VERSION = 2
+# Path that stands for reading alignments from the standard input
+STDIN = "-"
+# Maximum number of reads kept in memory for inferring
+# the protocol of a stream
+MAX_BUFFERED_READS = 1 << 18
+
+
+def open_bam(bam_path, reference_fasta=None):
+    """Open a SAM, BAM or CRAM file
+
+    Parameters
+    ----------
+    bam_path: str
+              Path to the alignment file, '-' for the standard input.
+              The format is detected from the content
+    reference_fasta: str
+                     Path to the reference used for decoding CRAM files
+
+    Returns
+    -------
+    bam: pysam.AlignmentFile
+    """
+    return pysam.AlignmentFile(bam_path, "r", reference_filename=reference_fasta)
+
+
+class AlignmentStream:
+    """Alignments that can only be read once, such as the standard input.
+
+    Reads consumed through prefix() are kept in memory and replayed
+    when iterating over the stream, so that the protocol can be
+    inferred from the first reads without a second pass.
+    """
+
+    def __init__(self, bam_path=STDIN, reference_fasta=None):
+        """
+        Parameters
+        ----------
+        bam_path: str
+                  Path to the alignment file, '-' for the standard input
+        reference_fasta: str
+                         Path to the reference used for decoding CRAM files
+        """
+        self.bam = open_bam(bam_path, reference_fasta)
+        self.references = self.bam.references
+        self._buffer = []
+
+    def prefix(self, max_reads=MAX_BUFFERED_READS):
+        """Iterate over the first reads of the stream without consuming them
+
+        Parameters
+        ----------
+        max_reads: int
+                   maximum number of reads to keep in memory
+
+        Returns
+        -------
+        reads: generator of pysam.AlignedSegment
+        """
+        for read in list(self._buffer):
+            yield read
+        while len(self._buffer) < max_reads:
+            read = next(self.bam, None)
+            if read is None:
+                return
+            self._buffer.append(read)
+            yield read
+
+    def __iter__(self):
+        buffered, self._buffer = self._buffer, []
+        return chain(buffered, self.bam)
+
+
+def decode_reads(reads, read_filter, block_size=READ_BLOCK_SIZE):
+    """Decode reads into blocks of column arrays
+
+    Only cheap per-record attributes are accessed. The NH tag,
+    the CIGAR and the alignment end are only looked up for reads
+    that pass the flag filters.
+
+    Parameters
+    ----------
+    reads: iterable of pysam.AlignedSegment
+           reads to decode
+    read_filter: ReadFilter
+                 filter that will be applied to the reads
+    block_size: int
+                number of reads per block
+
+    Returns
+    -------
+    blocks: generator of dict
+            each block maps 'flag', 'chrom_id', 'start', 'first', 'end',
+            'length', 'nh' and 'mapq' to arrays with one entry per read.
+            'start' is the leftmost reference position (0-based), as used by
+            fetch, 'first' and 'end' the first and last aligned positions,
+            which differ from the ends of the alignment when the CIGAR starts
+            or ends with a deletion or a skipped region. 'length' is the
+            number of aligned reference positions and 'nh' is -1 if the tag
+            is missing
+    """
+    flag_mask = read_filter.flag_mask
+    uses_nh = read_filter.uses_nh
+    columns = ("flag", "chrom_id", "start", "first", "end", "length", "nh", "mapq")
+    block = {column: [] for column in columns}
+    for read in reads:
+        flag = read.flag
+        start = read.reference_start
+        block["flag"].append(flag)
+        block["chrom_id"].append(read.reference_id)
+        block["start"].append(start)
+        block["mapq"].append(read.mapping_quality)
+        if flag & flag_mask:
+            block["first"].append(-1)
+            block["end"].append(-1)
+            block["length"].append(0)
+            block["nh"].append(-1)
+        else:
+            first = start
+            end = read.reference_end
+            cigar = read.cigartuples
+            if len(cigar) == 1:
+                length = end - start
+            else:
+                length = sum(n for op, n in cigar if op in __CIGAR_ALIGNED_OPS__)
+                # deletions and skipped regions before the first
+                # and after the last aligned base
+                for op, n in cigar:
+                    if op in __CIGAR_ALIGNED_OPS__:
+                        break
+                    if op in __CIGAR_REFERENCE_GAP_OPS__:
+                        first += n
+                for op, n in reversed(cigar):
+                    if op in __CIGAR_ALIGNED_OPS__:
+                        break
+                    if op in __CIGAR_REFERENCE_GAP_OPS__:
+                        end -= n
+            block["first"].append(first)
+            block["end"].append(end - 1)
+            block["length"].append(length)
+            nh_count = -1
+            if uses_nh:
+                try:
+                    nh_count = read.get_tag("NH")
+                except KeyError:
+                    pass
+            block["nh"].append(nh_count)
+        if len(block["flag"]) == block_size:
+            yield {column: np.array(values) for column, values in block.items()}
+            block = {column: [] for column in columns}
+    if block["flag"]:
+        yield {column: np.array(values) for column, values in block.items()}
+
+
+def count_reads(
+    reads,
+    alignments,
+    protocol,
+    read_filter,
+    read_lengths=None,
+    start=None,
+    pbar=None,
+    footprint=None,
+):
+    """Split reads by read length and strand
+
+    Parameters
+    ----------
+    reads: iterable of pysam.AlignedSegment
+           reads to process
+    alignments: CoverageStore
+                store to add the reads to. Its chromosome ids must
+                match the reference ids of the reads
+    protocol: str
+          Experiment protocol [forward, reverse]
+    read_filter: ReadFilter
+                 rules for selecting usable reads
+    read_lengths: list[int]
+                  read lengths to use
+    start: int
+           If not None, only reads whose leftmost position is
+           at least start are used. Reads starting further upstream
+           belong to the preceding region.
+    pbar: tqdm
+          progress bar to update per block of reads
+    footprint: Footprint
+               If not None, only reads whose 5' end is inside
+               the footprint are stored
+
+    Returns
+    -------
+    alignments: CoverageStore
+                reads split by length, strand, (chrom, pos)
+    read_length_counts: dict
+                  key is the length, value is the number of reads
+                  (ordered by the first occurrence of the length)
+    filter_counts: Counter
+                   number of reads in each category of the summary
+                   (see ReadFilter.apply)
+    """
+    if protocol not in ("forward", "reverse"):
+        raise ValueError("unknown protocol: {}".format(protocol))
+    read_length_counts = defaultdict(int)
+    filter_counts = Counter()
+    for block in decode_reads(reads, read_filter):
+        if pbar is not None:
+            pbar.update(len(block["flag"]))
+        if start is not None:
+            keep = block["start"] >= start
+            block = {column: values[keep] for column, values in block.items()}
+        flag = block["flag"]
+        filter_counts["total"] += len(flag)
+        usable, counts = read_filter.apply(flag, block["nh"], block["mapq"])
+        filter_counts.update(counts)
+
+        length = block["length"]
+        if read_lengths is not None:
+            usable &= np.isin(length, read_lengths)
+        length = length[usable]
+        is_reverse = (flag[usable] & 16) != 0
+        if protocol == "forward":
+            # Library preparation was forward-stranded:
+            # Genes defined on + strand should have
+            # reads mapping only on the positive strand
+            minus_strand = is_reverse
+        else:
+            # Library preparation was reverse-stranded
+            # Mappings on the positive strand are
+            # switched to negative strand with their positions
+            # reversed and vice versa for mappings on the negative
+            # strand.
+            minus_strand = ~is_reverse
+        # The 5'end is the first aligned position on the + strand
+        # and the last aligned position on the - strand
+        pos = np.where(minus_strand, block["end"][usable], block["first"][usable])
+        # convert bam coordinate to one-based
+        pos += 1
+        chrom_id = block["chrom_id"][usable]
+        if footprint is not None:
+            inside = np.zeros(len(pos), dtype=bool)
+            for read_chrom_id in np.unique(chrom_id).tolist():
+                on_chrom = chrom_id == read_chrom_id
+                inside[on_chrom] = footprint.contains(
+                    alignments.chroms[read_chrom_id], pos[on_chrom]
+                )
+            filter_counts["outside_footprint"] += int(np.count_nonzero(~inside))
+            length = length[inside]
+            minus_strand = minus_strand[inside]
+            pos = pos[inside]
+            chrom_id = chrom_id[inside]
+        alignments.add_reads(chrom_id, minus_strand, length, pos)
+
+        lengths_seen, first_seen, counts = np.unique(
+            length, return_index=True, return_counts=True
+        )
+        for i in np.argsort(first_seen):
+            read_length_counts[int(lengths_seen[i])] += int(counts[i])
+        filter_counts["valid"] += len(length)
+    return (alignments, read_length_counts, filter_counts)
+
+
+def estimate_total_reads(bam):
+    """Number of reads in a bam file according to its index
+
+    Parameters
+    ----------
+    bam: pysam.AlignmentFile
+         bam file
+
+    Returns
+    -------
+    total_reads: int
+                 total number of reads or None if the bam file
+                 has no index
+    """
+    if not bam.has_index():
+        return None
+    return sum(stat.total for stat in bam.get_index_statistics()) + bam.nocoordinate
+
+
+def bam_regions(bam, n_regions):
+    """Partition an indexed bam into regions of similar number of reads
+
+    Parameters
+    ----------
+    bam: pysam.AlignmentFile
+         indexed bam file
+    n_regions: int
+               approximate number of regions to create
+
+    Returns
+    -------
+    regions: list of (contig, start, end, weight)
+             regions in the order they appear in the bam file.
+             Reads without coordinates are represented by the
+             contig '*'
+    """
+    stats = [
+        (stat.contig, stat.total) for stat in bam.get_index_statistics() if stat.total
+    ]
+    total = sum(reads for _, reads in stats) + bam.nocoordinate
+    target = max(1, total // max(1, n_regions))
+    regions = []
+    for contig, reads in stats:
+        contig_length = bam.get_reference_length(contig)
+        n_pieces = min(contig_length, max(1, -(-reads // target)))
+        step = -(-contig_length // n_pieces)
+        for start in range(0, contig_length, step):
+            end = min(start + step, contig_length)
+            regions.append((contig, start, end, reads * (end - start) / contig_length))
+    if bam.nocoordinate:
+        regions.append(("*", None, None, bam.nocoordinate))
+    return regions
 
-def split_bam(bam_path, protocol, prefix, read_lengths=None):
-    """Split bam by read length and strand
+
+def footprint_regions(bam, footprint, n_tasks):
+    """Partition the footprint of an index into tasks for fetching
+
+    Parameters
+    ----------
+    bam: pysam.AlignmentFile
+         indexed bam file
+    footprint: Footprint
+               footprint of the ribotricer index
+    n_tasks: int
+             approximate number of tasks to create
+
+    Returns
+    -------
+    tasks: list of list of (contig, start, end, owned_from)
+           regions to fetch in the order they appear in the bam file.
+           Reads starting before owned_from were already fetched with
+           the preceding region
+    weights: list of float
+             estimated number of reads of each task
+    """
+    contig_reads = {stat.contig: stat.total for stat in bam.get_index_statistics()}
+    regions = []
+    previous_contig = previous_end = None
+    for contig, start, end in footprint.fetch_regions(bam.references):
+        owned_from = previous_end if contig == previous_contig else None
+        weight = contig_reads.get(contig, 0) * (end - start)
+        weight /= bam.get_reference_length(contig)
+        regions.append((contig, start, end, owned_from, weight))
+        previous_contig, previous_end = contig, end
+    total = sum(region[4] for region in regions)
+    target = max(1, total / max(1, n_tasks))
+    tasks = []
+    weights = []
+    for contig, start, end, owned_from, weight in regions:
+        if not tasks or weights[-1] >= target:
+            tasks.append([])
+            weights.append(0)
+        tasks[-1].append((contig, start, end, owned_from))
+        weights[-1] += weight
+    return tasks, weights
+
+
+def count_regions(
+    bam, regions, protocol, read_filter, read_lengths=None, footprint=None, pbar=None
+):
+    """Split the reads of some regions of an indexed bam
+
+    Parameters
+    ----------
+    bam: pysam.AlignmentFile
+         indexed bam file
+    regions: list of (contig, start, end, owned_from)
+             regions to fetch, the contig '*' stands for
+             reads without coordinates
+    protocol: str
+          Experiment protocol [forward, reverse]
+    read_filter: ReadFilter
+                 rules for selecting usable reads
+    read_lengths: list[int]
+                  read lengths to use
+    footprint: Footprint
+               If not None, only reads whose 5' end is inside
+               the footprint are stored
+    pbar: tqdm
+          progress bar to update per region
+
+    Returns
+    -------
+    alignments: CoverageStore
+                reads split by length, strand, (chrom, pos)
+    read_length_counts: dict
+                        key is the length, value is the number of reads
+    filter_counts: Counter
+                   number of reads in each category of the summary
+    """
+    alignments = CoverageStore(bam.references)
+    read_length_counts = defaultdict(int)
+    filter_counts = Counter()
+    for contig, start, end, owned_from in regions:
+        if contig == "*":
+            reads = bam.fetch(contig)
+        else:
+            reads = bam.fetch(contig, start, end)
+        _, region_length_counts, region_filter_counts = count_reads(
+            reads,
+            alignments,
+            protocol,
+            read_filter,
+            read_lengths,
+            owned_from,
+            footprint=footprint,
+        )
+        for length, count in region_length_counts.items():
+            read_length_counts[length] += count
+        filter_counts.update(region_filter_counts)
+        if pbar is not None:
+            pbar.update()
+    return (alignments, dict(read_length_counts), filter_counts)
+
+
+def _split_regions(args):
+    """Worker for splitting some regions of the bam file
+
+    Parameters
+    ----------
+    args: tuple
+          (bam_path, reference_fasta, regions, protocol, read_filter,
+          read_lengths, footprint)
+
+    Returns
+    -------
+    counts: tuple
+            output of count_regions
+    """
+    bam_path, reference_fasta, regions, protocol, read_filter = args[:5]
+    read_lengths, footprint = args[5:]
+    with open_bam(bam_path, reference_fasta) as bam:
+        return count_regions(
+            bam, regions, protocol, read_filter, read_lengths, footprint
+        )
+
+
+def split_bam_parallel(
+    bam_path,
+    protocol,
+    read_filter,
+    read_lengths=None,
+    threads=1,
+    footprint=None,
+    reference_fasta=None,
+):
+    """Split an indexed bam by read length and strand using multiple processes
+
+    The bam is partitioned into regions using its index and each region
+    is processed by a worker process. The per-region results are merged
+    in the order of the regions in the bam file, so the result is identical
+    to a single pass over the file.
+
+    Parameters
+    ----------
+    bam_path : str
+          Path to indexed bam file
+    protocol: str
+          Experiment protocol [forward, reverse]
+    read_lengths: list[int]
+                  read lengths to use
+    threads: int
+             number of worker processes
+    footprint: Footprint
+               If not None, only the reads in the footprint are fetched
+    reference_fasta: str
+                     Path to the reference used for decoding CRAM files
+
+    Returns
+    -------
+    alignments: CoverageStore
+                bam split by length, strand, (chrom, pos)
+    read_length_counts: dict
+                  key is the length, value is the number of reads
+    filter_counts: Counter
+                   number of reads in each category of the summary
+    """
+    with open_bam(bam_path, reference_fasta) as bam:
+        if footprint is None:
+            regions = bam_regions(bam, threads * REGIONS_PER_THREAD)
+            tasks = [[(contig, start, end, start)] for contig, start, end, _ in regions]
+            weights = [weight for _, _, _, weight in regions]
+        else:
+            tasks, weights = footprint_regions(
+                bam, footprint, threads * REGIONS_PER_THREAD
+            )
+        alignments = CoverageStore(bam.references)
+    # Submit the largest tasks first to keep all workers busy
+    order = sorted(range(len(tasks)), key=lambda i: -weights[i])
+    args = [
+        (
+            bam_path,
+            reference_fasta,
+            tasks[i],
+            protocol,
+            read_filter,
+            read_lengths,
+            footprint,
+        )
+        for i in order
+    ]
+    results = [None] * len(tasks)
+    with Pool(threads) as pool:
+        with tqdm(total=len(tasks), unit="regions", leave=False) as pbar:
+            for i, result in zip(order, pool.imap(_split_regions, args)):
+                results[i] = result
+                pbar.update()
+
+    read_length_counts = defaultdict(int)
+    filter_counts = Counter()
+    for region_alignments, region_length_counts, region_filter_counts in results:
+        for length, count in region_length_counts.items():
+            read_length_counts[length] += count
+        alignments.merge(region_alignments)
+        filter_counts.update(region_filter_counts)
+    return (alignments, read_length_counts, filter_counts)
+
+
+def coverage_cache_key(
+    bam_path, protocol, read_lengths, read_filter, footprint=None, reference_fasta=None
+):
+    """Fingerprint of the inputs that determine the output of split_bam
 
     Parameters
     ----------
@@ -31,102 +569,282 @@ def split_bam(bam_path, protocol, prefix, read_lengths=None):
           Path to bam file
     protocol: str
           Experiment protocol [forward, reverse]
+    read_lengths: list[int]
+                  read lengths to use, None for all
+    read_filter: ReadFilter
+                 rules for selecting usable reads
+    footprint: Footprint
+               footprint the reads are restricted to, None for all reads
+    reference_fasta: str
+                     Path to the reference used for decoding CRAM files
+
+    Returns
+    -------
+    key: str
+         hex digest that changes with the bam file size, modification
+         time, header and with any of the settings
+    """
+    stat = os.stat(bam_path)
+    with open_bam(bam_path, reference_fasta) as bam:
+        header = str(bam.header)
+    fingerprint = {
+        "version": COVERAGE_CACHE_VERSION,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "header": hashlib.md5(header.encode()).hexdigest(),
+        "protocol": protocol,
+        "read_lengths": None if read_lengths is None else sorted(set(read_lengths)),
+        "aligner": read_filter.aligner,
+        "min_mapq": read_filter.min_mapq,
+        "flag_mask": read_filter.flag_mask,
+        "footprint": None if footprint is None else footprint.digest(),
+    }
+    return hashlib.sha1(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()
+
+
+def coverage_cache_path(bam_path, cache_dir, key):
+    """Location of the cached coverage of a bam file
+
+    Parameters
+    ----------
+    bam_path : str
+          Path to bam file
+    cache_dir: str
+               directory of the cache files
+    key: str
+         output of coverage_cache_key
+
+    Returns
+    -------
+    path: str
+    """
+    name = os.path.basename(bam_path)
+    return os.path.join(cache_dir, "{}.{}.coverage.npz".format(name, key[:16]))
+
+
+def save_coverage_cache(path, key, alignments, read_length_counts, filter_counts):
+    """Save the output of split_bam as an uncompressed npz file
+
+    The file is written under a temporary name and renamed, so that
+    an interrupted run never leaves a truncated cache behind.
+
+    Parameters
+    ----------
+    path: str
+          cache file to write
+    key: str
+         output of coverage_cache_key
+    alignments: CoverageStore
+    read_length_counts: dict
+                        key is the length, value is the number of reads
+    filter_counts: Counter
+                   number of reads discarded by each filter
+    """
+    arrays = alignments.to_arrays()
+    arrays["key"] = np.array(key)
+    arrays["read_lengths"] = np.array(list(read_length_counts), dtype=np.int64)
+    arrays["read_length_counts"] = np.array(
+        list(read_length_counts.values()), dtype=np.int64
+    )
+    arrays["filter_names"] = np.array(list(filter_counts), dtype=str)
+    arrays["filter_counts"] = np.array(list(filter_counts.values()), dtype=np.int64)
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "wb") as cache:
+        np.savez(cache, **arrays)
+    os.replace(tmp_path, path)
+
+
+def load_coverage_cache(path, key):
+    """Load a cache file written by save_coverage_cache
+
+    Parameters
+    ----------
+    path: str
+          cache file to read
+    key: str
+         output of coverage_cache_key
+
+    Returns
+    -------
+    cached: tuple
+            (alignments, read_length_counts, filter_counts) or None if
+            the file does not exist or was built from different inputs
+    """
+    if not os.path.isfile(path):
+        return None
+    with np.load(path, allow_pickle=False) as arrays:
+        if str(arrays["key"]) != key:
+            return None
+        alignments = CoverageStore.from_arrays(arrays)
+        read_length_counts = dict(
+            zip(arrays["read_lengths"].tolist(), arrays["read_length_counts"].tolist())
+        )
+        filter_counts = Counter(
+            dict(zip(arrays["filter_names"].tolist(), arrays["filter_counts"].tolist()))
+        )
+    return (alignments, read_length_counts, filter_counts)
+
+
+def _read_bam(
+    bam_path, protocol, read_filter, read_lengths, threads, footprint, reference_fasta
+):
+    """Read a bam file with count_reads, in parallel if it is indexed"""
+    if isinstance(bam_path, AlignmentStream):
+        with tqdm(unit="reads", leave=False) as pbar:
+            return count_reads(
+                bam_path,
+                CoverageStore(bam_path.references),
+                protocol,
+                read_filter,
+                read_lengths,
+                pbar=pbar,
+                footprint=footprint,
+            )
+    bam = open_bam(bam_path, reference_fasta)
+    has_index = bam.has_index()
+    if threads > 1 and has_index:
+        bam.close()
+        alignments, read_length_counts, filter_counts = split_bam_parallel(
+            bam_path,
+            protocol,
+            read_filter,
+            read_lengths,
+            threads,
+            footprint,
+            reference_fasta,
+        )
+    elif footprint is not None and has_index:
+        tasks, _ = footprint_regions(bam, footprint, 1)
+        regions = [region for task in tasks for region in task]
+        with tqdm(total=len(regions), unit="regions", leave=False) as pbar:
+            alignments, read_length_counts, filter_counts = count_regions(
+                bam, regions, protocol, read_filter, read_lengths, footprint, pbar
+            )
+        bam.close()
+    else:
+        if threads > 1:
+            print("bam file is not indexed, reading it in a single process")
+        # print('reading bam file...')
+        # The index statistics are only used to display a progress bar,
+        # an unindexed bam is shown without a total
+        total_reads = estimate_total_reads(bam)
+        with tqdm(total=total_reads, unit="reads", leave=False) as pbar:
+            alignments, read_length_counts, filter_counts = count_reads(
+                bam.fetch(until_eof=True),
+                CoverageStore(bam.references),
+                protocol,
+                read_filter,
+                read_lengths,
+                pbar=pbar,
+                footprint=footprint,
+            )
+        bam.close()
+    return (alignments, read_length_counts, filter_counts)
+
+
+def split_bam(
+    bam_path,
+    protocol,
+    prefix,
+    read_lengths=None,
+    threads=1,
+    read_filter=None,
+    cache_dir=None,
+    rebuild_cache=False,
+    footprint=None,
+    reference_fasta=None,
+):
+    """Split bam by read length and strand
+
+    Parameters
+    ----------
+    bam_path : str or AlignmentStream
+          Path to bam file, or stream of alignments to read once
+    protocol: str
+          Experiment protocol [forward, reverse]
     prefix: str
             prefix for output files
     read_lengths: list[int]
                   read lengths to use
                   If None, it will be automatically determined by assessing
                   the periodicity of metagene profile of this read length
+    threads: int
+             number of worker processes to use. Multiple processes
+             are only used if the bam file is indexed
+    read_filter: ReadFilter
+                 rules for selecting usable reads, default rules if None
+    cache_dir: str
+               directory where the split bam is cached, no caching if None.
+               A cache file is reused as long as the bam file and the
+               settings it was built with are unchanged
+    rebuild_cache: bool
+                   read the bam file even if a cache file exists, and
+                   replace the cache file
+    footprint: Footprint
+               If not None, only reads whose 5' end is inside the
+               footprint are counted. Reads are fetched through the
+               bam index if there is one
+    reference_fasta: str
+                     Path to the reference used for decoding CRAM files
 
     Returns
     -------
-    alignments: dict(dict(Counter))
+    alignments: CoverageStore
                 bam split by length, strand, (chrom, pos)
     read_length_counts: dict
                   key is the length, value is the number of reads
     """
-    alignments = defaultdict(lambda: defaultdict(Counter))
-    read_length_counts = defaultdict(int)
-    total_count = qcfail = duplicate = secondary = unmapped = multi = valid = 0
-    # print('reading bam file...')
-    # First pass just counts the reads
-    # this is required to display a progress bar
-    bam = pysam.AlignmentFile(bam_path, "rb")
-    total_reads = bam.count(until_eof=True)
-    bam.close()
-    with tqdm(total=total_reads, unit="reads", leave=False) as pbar:
-        bam = pysam.AlignmentFile(bam_path, "rb")
-        for read in bam.fetch(until_eof=True):
-            pbar.update()
-            # Track if the current read is usable
-            is_usable = True
-            total_count += 1
-
-            if read.is_qcfail:
-                qcfail += 1
-                is_usable = False
-            elif read.is_duplicate:
-                duplicate += 1
-                is_usable = False
-            elif read.is_secondary:
-                secondary += 1
-                is_usable = False
-            elif read.is_unmapped:
-                unmapped += 1
-                is_usable = False
-            elif not is_read_uniq_mapping(read):
-                multi += 1
-                is_usable = False
-
-            if is_usable:
-                map_strand = "-" if read.is_reverse else "+"
-                ref_positions = read.get_reference_positions()
-                strand = None
-                pos = None
-                chrom = read.reference_name
-                length = len(ref_positions)
-                if read_lengths is not None and length not in read_lengths:
-                    # Do nothing
-                    pass
-                else:
-                    if protocol == "forward":
-                        # Library preparation was forward-stranded:
-                        # Genes defined on + strand should have
-                        # reads mapping only on the positive strand
-                        if map_strand == "+":
-                            strand = "+"
-                            # Track the 5'end
-                            pos = ref_positions[0]
-                        else:
-                            strand = "-"
-                            # For negative strand of forward protocol read the
-                            # the 5'end of the read is the last element
-                            pos = ref_positions[-1]
-                    elif protocol == "reverse":
-                        # Library preparation was reverse-stranded
-                        # Mappings on the positive strand are
-                        # switched to negative strand with their positions
-                        # reversed and vice versa for mappings on the negative
-                        # strand.
-                        if map_strand == "+":
-                            strand = "-"
-                            # The 5' end is the last position
-                            pos = ref_positions[-1]
-                        else:
-                            strand = "+"
-                            # The 5'end is the first position
-                            pos = ref_positions[0]
-
-                    # convert bam coordinate to one-based
-                    alignments[length][strand][(chrom, pos + 1)] += 1
-                    read_length_counts[length] += 1
-                    valid += 1
-    bam.close()
+    if read_filter is None:
+        read_filter = ReadFilter()
+    if isinstance(bam_path, AlignmentStream):
+        # a stream has no fingerprint
+        cache_dir = None
+    cached = None
+    if cache_dir is not None:
+        cache_key = coverage_cache_key(
+            bam_path, protocol, read_lengths, read_filter, footprint, reference_fasta
+        )
+        cache_path = coverage_cache_path(bam_path, cache_dir, cache_key)
+        if not rebuild_cache:
+            cached = load_coverage_cache(cache_path, cache_key)
+    if cached is not None:
+        print("using cached coverage {}".format(cache_path))
+        alignments, read_length_counts, filter_counts = cached
+    else:
+        alignments, read_length_counts, filter_counts = _read_bam(
+            bam_path,
+            protocol,
+            read_filter,
+            read_lengths,
+            threads,
+            footprint,
+            reference_fasta,
+        )
+        if cache_dir is not None:
+            mkdir_p(cache_dir)
+            save_coverage_cache(
+                cache_path, cache_key, alignments, read_length_counts, filter_counts
+            )
+    read_filter.undetermined += filter_counts["undetermined"]
+    read_filter.warn_undetermined()
     summary = (
         "summary:\n\ttotal_reads: {}\n\tunique_mapped: {}\n"
         "\tqcfail: {}\n\tduplicate: {}\n\tsecondary: {}\n"
-        "\tunmapped:{}\n\tmulti:{}\n\nlength dist:\n"
-    ).format(total_count, valid, qcfail, duplicate, secondary, unmapped, multi)
+        "\tunmapped:{}\n\tmulti:{}\n"
+    ).format(
+        filter_counts["total"],
+        filter_counts["valid"],
+        filter_counts["qcfail"],
+        filter_counts["duplicate"],
+        filter_counts["secondary"],
+        filter_counts["unmapped"],
+        filter_counts["multi"],
+    )
+    if "flag_mask" in dict(read_filter.categories):
+        summary += "\tflag_mask:{}\n".format(filter_counts["flag_mask"])
+    if footprint is not None:
+        summary += "\toutside_footprint:{}\n".format(filter_counts["outside_footprint"])
+    summary += "\nlength dist:\n"
 
     for length in sorted(read_length_counts):
         summary += "\t{}: {}\n".format(length, read_length_counts[length])
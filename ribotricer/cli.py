@@ -20,6 +20,9 @@ import sys
 
 from . import __version__
 from .common import _clean_input
+from .common import ALIGNERS
+from .common import DEFAULT_FLAG_MASK
+from .common import ReadFilter
 from .const import CUTOFF
 from .const import MINIMUM_VALID_CODONS
 from .const import MINIMUM_VALID_CODONS_RATIO
@@ -29,11 +32,15 @@ from .const import MINIMUM_DENSITY_OVER_ORF
 from .count_orfs import count_orfs
 from .count_orfs import count_orfs_codon
 from .detect_orfs import detect_orfs
+from .genome import pack_genome
 from .learn_cutoff import determine_cutoff_bam
 from .learn_cutoff import determine_cutoff_tsv
 
 from .orf_seq import orf_seq
 from .prepare_orfs import prepare_orfs
+from .shard import merge_detected
+from .shard import shard_index
+from .shard import shard_index_path
 
 from click_help_colors import HelpColorsGroup
 
@@ -82,8 +89,40 @@ def cli():
     help="Choose the most upstream start codon if multiple in frame ones exist",
     is_flag=True,
 )
+@click.option(
+    "--threads",
+    type=int,
+    default=1,
+    show_default=True,
+    help=(
+        "Number of processes to use for searching ORFs\n"
+        "Each process keeps the sequences of up to two chromosomes in memory"
+        " (one byte per base), unless the FASTA file is packed with pack-genome"
+    ),
+)
+@click.option(
+    "--previous_index",
+    help=(
+        "Path to the index of an earlier prepare-orfs run\n"
+        "ORFs of transcripts that did not change are reused"
+    ),
+)
+@click.option(
+    "--bgzip",
+    help="Compress the index with bgzip ({PREFIX}_candidate_orfs.tsv.gz)",
+    is_flag=True,
+)
 def prepare_orfs_cmd(
-    gtf, fasta, prefix, min_orf_length, start_codons, stop_codons, longest
+    gtf,
+    fasta,
+    prefix,
+    min_orf_length,
+    start_codons,
+    stop_codons,
+    longest,
+    threads,
+    previous_index,
+    bgzip,
 ):
     if not os.path.isfile(gtf):
         sys.exit("Error: GTF file not found")
@@ -94,6 +133,12 @@ def prepare_orfs_cmd(
     if min_orf_length <= 0:
         sys.exit("Error: min ORF length at least to be 1")
 
+    if threads < 1:
+        sys.exit("Error: number of threads must be at least 1")
+
+    if previous_index is not None and not os.path.isfile(previous_index):
+        sys.exit("Error: previous ribotricer index file not found")
+
     start_codons = set([x.strip().upper() for x in start_codons.strip().split(",")])
     if not start_codons:
         sys.exit("Error: start codons cannot be empty")
@@ -106,7 +151,18 @@ def prepare_orfs_cmd(
     if not all([len(x) == 3 and set(x) <= {"A", "C", "G", "T"} for x in stop_codons]):
         sys.exit("Error: invalid codon, only A, C, G, T allowed")
 
-    prepare_orfs(gtf, fasta, prefix, min_orf_length, start_codons, stop_codons, longest)
+    prepare_orfs(
+        gtf,
+        fasta,
+        prefix,
+        min_orf_length,
+        start_codons,
+        stop_codons,
+        longest,
+        threads,
+        previous_index,
+        bgzip,
+    )
 
 
 ###################### detect-orfs function #########################################
@@ -115,7 +171,11 @@ def prepare_orfs_cmd(
     context_settings=CONTEXT_SETTINGS,
     help="Detect translating ORFs from BAM file",
 )
-@click.option("--bam", help="Path to BAM file", required=True)
+@click.option(
+    "--bam",
+    help="Path to BAM file, '-' to read SAM/BAM/CRAM from the standard input",
+    required=True,
+)
 @click.option(
     "--ribotricer_index",
     help=(
@@ -196,6 +256,80 @@ def prepare_orfs_cmd(
     help=("Whether output all ORFs including those " "non-translating ones"),
     is_flag=True,
 )
+@click.option(
+    "--threads",
+    type=int,
+    default=1,
+    show_default=True,
+    help=(
+        "Number of processes to use for reading the BAM file (requires a BAM index)"
+        " and for scoring the ORFs"
+    ),
+)
+@click.option(
+    "--aligner",
+    type=click.Choice(ALIGNERS),
+    default="auto",
+    show_default=True,
+    help=(
+        "Aligner convention for identifying uniquely mapping reads without NH tag"
+        " (star: MAPQ 255, hisat2: MAPQ 60, bowtie: MAPQ >= 2)"
+    ),
+)
+@click.option(
+    "--min_mapq",
+    type=int,
+    default=None,
+    show_default=True,
+    help=(
+        "Identify uniquely mapping reads by a minimum MAPQ"
+        " instead of the NH tag and the aligner convention"
+    ),
+)
+@click.option(
+    "--flag_mask",
+    type=int,
+    default=DEFAULT_FLAG_MASK,
+    show_default=True,
+    help=(
+        "Discard reads with any of these SAM flags"
+        " (unmapped reads are always discarded)"
+    ),
+)
+@click.option(
+    "--coverage_cache",
+    type=click.Path(file_okay=False),
+    help=(
+        "Directory for caching the reads counted from the BAM file."
+        " The cache is reused while the BAM file and read settings are unchanged"
+    ),
+)
+@click.option(
+    "--rebuild_cache",
+    help="Whether to read the BAM file again and replace its cached counts",
+    is_flag=True,
+)
+@click.option(
+    "--footprint",
+    help=(
+        "Whether to only read and store reads near the ORFs of the index."
+        " The bam summary, read length distribution and wig files then only"
+        " cover these reads"
+    ),
+    is_flag=True,
+)
+@click.option(
+    "--reference_fasta",
+    help="Path to the reference FASTA used for decoding CRAM input",
+)
+@click.option(
+    "--shard",
+    help=(
+        "Only score shard i of N of the index, given as i/N, such as 1/4."
+        " The shards must be written with ribotricer shard-index first,"
+        " and --read_lengths and --psite_offsets are required"
+    ),
+)
 def detect_orfs_cmd(
     bam,
     ribotricer_index,
@@ -209,10 +343,40 @@ def detect_orfs_cmd(
     min_valid_codons_ratio,
     min_read_density,
     report_all,
+    threads,
+    aligner,
+    min_mapq,
+    flag_mask,
+    coverage_cache,
+    rebuild_cache,
+    footprint,
+    reference_fasta,
+    shard,
 ):
-    if not os.path.isfile(bam):
+    if bam != "-" and not os.path.isfile(bam):
         sys.exit("Error: BAM file not found")
 
+    if reference_fasta is not None and not os.path.isfile(reference_fasta):
+        sys.exit("Error: reference FASTA file not found")
+
+    if threads < 1:
+        sys.exit("Error: number of threads must be at least 1")
+
+    if min_mapq is not None and min_mapq < 0:
+        sys.exit("Error: min_mapq must be >= 0")
+    if flag_mask < 0:
+        sys.exit("Error: flag_mask must be >= 0")
+    read_filter = ReadFilter(aligner, min_mapq, flag_mask)
+
+    if rebuild_cache and coverage_cache is None:
+        sys.exit("Error: --rebuild_cache requires --coverage_cache")
+
+    if bam == "-":
+        if coverage_cache is not None:
+            sys.exit("Error: --coverage_cache cannot be used with the standard input")
+        if threads > 1:
+            print("reading the standard input in a single process")
+
     if not os.path.isfile(ribotricer_index):
         sys.exit("Error: ribotricer index file not found")
 
@@ -238,6 +402,18 @@ def detect_orfs_cmd(
         if not all(x > y for (x, y) in zip(read_lengths, psite_offsets)):
             sys.exit("Error: P-site offset must be smaller than read length")
         psite_offsets = dict(list(zip(read_lengths, psite_offsets)))
+    if shard is not None:
+        try:
+            shard = tuple(int(x.strip()) for x in shard.split("/"))
+        except:
+            sys.exit("Error: shard must be given as i/N, such as 1/4")
+        if len(shard) != 2 or not 1 <= shard[0] <= shard[1]:
+            sys.exit("Error: shard must be given as i/N, with 1 <= i <= N")
+        if not os.path.isfile(shard_index_path(ribotricer_index, *shard)):
+            sys.exit("Error: shard not found, run ribotricer shard-index first")
+        # the offsets inferred from a shard would differ between shards
+        if psite_offsets is None:
+            sys.exit("Error: --shard requires --read_lengths and --psite_offsets")
     if stranded == "yes":
         stranded = "forward"
     detect_orfs(
@@ -253,9 +429,79 @@ def detect_orfs_cmd(
         min_valid_codons_ratio,
         min_read_density,
         report_all,
+        threads,
+        read_filter,
+        coverage_cache,
+        rebuild_cache,
+        footprint,
+        reference_fasta,
+        shard,
     )
 
 
+###################### shard-index function #########################################
+@cli.command(
+    "shard-index",
+    context_settings=CONTEXT_SETTINGS,
+    help="Split the index into shards for running detect-orfs on several nodes",
+)
+@click.option(
+    "--ribotricer_index",
+    help=(
+        "Path to the index file of ribotricer\n"
+        "This file should be generated using ribotricer prepare-orfs"
+    ),
+    required=True,
+)
+@click.option("--shards", type=int, help="Number of shards", required=True)
+def shard_index_cmd(ribotricer_index, shards):
+    if not os.path.isfile(ribotricer_index):
+        sys.exit("Error: ribotricer index file not found")
+
+    if shards < 1:
+        sys.exit("Error: number of shards must be at least 1")
+
+    shard_index(ribotricer_index, shards)
+
+
+###################### merge-detected function #########################################
+@cli.command(
+    "merge-detected",
+    context_settings=CONTEXT_SETTINGS,
+    help="Join the detect-orfs outputs of all shards of an index",
+)
+@click.option(
+    "--ribotricer_index",
+    help=(
+        "Path to the index file of ribotricer\n"
+        "This should be the index given to ribotricer shard-index"
+    ),
+    required=True,
+)
+@click.option(
+    "--detected_orfs",
+    help=(
+        "Paths to the detected orfs files of the shards, separated by comma\n"
+        "These files should be generated using ribotricer detect-orfs --shard"
+    ),
+    required=True,
+)
+@click.option("--out", help="Path to output file", required=True)
+def merge_detected_cmd(ribotricer_index, detected_orfs, out):
+    if not os.path.isfile(ribotricer_index):
+        sys.exit("Error: ribotricer index file not found")
+
+    detected_orfs = [x.strip() for x in detected_orfs.strip().split(",")]
+    for path in detected_orfs:
+        if not os.path.isfile(path):
+            sys.exit("Error: detected orfs file {} not found".format(path))
+
+    try:
+        merge_detected(ribotricer_index, detected_orfs, out)
+    except ValueError as error:
+        sys.exit("Error: {}".format(error))
+
+
 ###################### count-orfs function #########################################
 @cli.command(
     "count-orfs",
@@ -384,6 +630,21 @@ def orf_seq_cmd(ribotricer_index, fasta, saveto):
     orf_seq(ribotricer_index, fasta, saveto)
 
 
+###################### pack-genome function #########################################
+@cli.command(
+    "pack-genome",
+    context_settings=CONTEXT_SETTINGS,
+    help="Write a 2-bit packed copy of a FASTA file, used by the other commands",
+)
+@click.option("--fasta", help="Path to FASTA file", required=True)
+def pack_genome_cmd(fasta):
+    if not os.path.isfile(fasta):
+        sys.exit("Error: fasta file not found")
+
+    path = pack_genome(fasta)
+    print("packed genome written to {}".format(path))
+
+
 ###################### learn-cutoff function #########################################
 @cli.command(
     "learn-cutoff",
@@ -443,6 +704,19 @@ def orf_seq_cmd(ribotricer_index, fasta, saveto):
     show_default=True,
     help="Number of bootstraps",
 )
+@click.option(
+    "--coverage_cache",
+    type=click.Path(file_okay=False),
+    help=(
+        "Directory for caching the reads counted from the BAM file."
+        " The cache is reused while the BAM file and read settings are unchanged"
+    ),
+)
+@click.option(
+    "--rebuild_cache",
+    help="Whether to read the BAM file again and replace its cached counts",
+    is_flag=True,
+)
 def determine_cutoff_cmd(
     ribo_bams,
     rna_bams,
@@ -455,6 +729,8 @@ def determine_cutoff_cmd(
     min_valid_codons,
     sampling_ratio,
     n_bootstraps,
+    coverage_cache,
+    rebuild_cache,
 ):
 
     filter_by = _clean_input(filter_by_tx_annotation)
@@ -500,6 +776,8 @@ def determine_cutoff_cmd(
                 phase_score_cutoff,
                 min_valid_codons,
                 report_all=True,
+                coverage_cache=coverage_cache,
+                rebuild_cache=rebuild_cache,
             )
     else:
         determine_cutoff_tsv(
@@ -13,45 +13,208 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 # GNU General Public License for more details.
 
+from collections import Counter
+import gzip
+import hashlib
 import ntpath
+import os
 import pathlib
+import shutil
 import sys
+
+import numpy as np
+
 from .interval import Interval
 
+# Number of bytes read at a time to compute the checksum of a file
+CHECKSUM_BLOCK_SIZE = 1 << 20
+
 # Source: https://broadinstitute.github.io/picard/explain-flags.html
 __SAM_NOT_UNIQ_FLAGS__ = [4, 20, 256, 272, 2048]
 
+# Flags used to discard reads, in the order they are reported
+# in the bam summary
+__SAM_FILTER_FLAGS__ = [("qcfail", 512), ("duplicate", 1024), ("secondary", 256)]
+__SAM_UNMAPPED_FLAG__ = 4
+# unmapped, secondary, qcfail, duplicate
+DEFAULT_FLAG_MASK = 4 | 256 | 512 | 1024
 
-def is_read_uniq_mapping(read):
-    """Check if read is uniquely mappable.
+# MAPQ range (inclusive) that aligners assign to uniquely mapping reads.
+# Used when the NH tag is not set. STAR uses 255 and HISAT2 uses 60 for
+# unique reads, bowtie2 assigns 0 or 1 to multimapping reads.
+ALIGNER_UNIQ_MAPQ = {"star": (255, 255), "hisat2": (60, 60), "bowtie": (2, 255)}
+ALIGNERS = ["auto"] + sorted(ALIGNER_UNIQ_MAPQ)
 
-    Parameters
-    ----------
-    read : pysam.Alignment.fetch object
 
+class ReadFilter:
+    """Rules for selecting usable reads, set up once per run.
+
+    A read is discarded if it has any flag of the flag mask, or if
+    it is not uniquely mapping. Uniqueness is decided by the NH tag,
+    falling back to the MAPQ convention of the aligner when the
+    tag is not set. If min_mapq is given, uniqueness is decided by MAPQ
+    alone and no tags are looked up.
 
-    Most reliable: ['NH'] tag
+    With the 'auto' convention, reads without NH tag are unique with
+    MAPQ 255 (STAR), multimapping with MAPQ 0 and otherwise undetermined.
+    Undetermined reads are treated as multimapping.
     """
-    # Filter out secondary alignments
-    if read.is_secondary:
-        return False
-    tags = dict(read.get_tags())
-    try:
-        nh_count = tags["NH"]
-        return nh_count == 1
-    except KeyError:
-        # Reliable in case of STAR
-        if read.mapping_quality == 255:
-            return True
-        elif read.mapping_quality < 1:
-            return False
-        # NH tag not set so rely on flags
-        elif read.flag in __SAM_NOT_UNIQ_FLAGS__:
-            return False
-        else:
+
+    def __init__(self, aligner="auto", min_mapq=None, flag_mask=DEFAULT_FLAG_MASK):
+        """
+        Parameters
+        ----------
+        aligner: str
+                 one of ALIGNERS
+        min_mapq: int
+                  minimum MAPQ for a read to be unique, replaces the NH rule
+        flag_mask: int
+                   reads with any of these SAM flags are discarded.
+                   Unmapped reads are always discarded
+        """
+        if aligner not in ALIGNERS:
+            raise ValueError("unknown aligner: {}".format(aligner))
+        self.aligner = aligner
+        self.min_mapq = min_mapq
+        self.flag_mask = flag_mask | __SAM_UNMAPPED_FLAG__
+        self.categories = [
+            (category, flag)
+            for category, flag in __SAM_FILTER_FLAGS__
+            if self.flag_mask & flag
+        ]
+        self.categories.append(("unmapped", __SAM_UNMAPPED_FLAG__))
+        # flags not covered by the named categories
+        other_flags = self.flag_mask & ~DEFAULT_FLAG_MASK
+        if other_flags:
+            self.categories.append(("flag_mask", other_flags))
+        # number of reads of unknown mapping status seen so far
+        self.undetermined = 0
+        self.warned = False
+
+    @property
+    def uses_nh(self):
+        """Whether the NH tag is needed"""
+        return self.min_mapq is None
+
+    def warn_undetermined(self):
+        """Warn, only once per run, about reads of unknown mapping status"""
+        if self.undetermined and not self.warned:
+            self.warned = True
             sys.stdout.write(
-                "WARNING: ribotricer was unable to detect any tags for determining multimapping status. All the reads will be treated as uniquely mapping\n"
+                "WARNING: ribotricer was unable to detect any tags for determining "
+                "multimapping status of {} reads. These reads are treated as "
+                "multimapping, use --aligner or --min_mapq to set how unique reads "
+                "are identified\n".format(self.undetermined)
+            )
+
+    def uniq_mapping(self, flags, nh_counts, mapping_qualities):
+        """Check if reads are uniquely mapping
+
+        Parameters
+        ----------
+        flags: np.ndarray
+               SAM flag of each read
+        nh_counts: np.ndarray
+                   value of the NH tag, negative if the tag is missing
+        mapping_qualities: np.ndarray
+                           MAPQ of each read
+
+        Returns
+        -------
+        uniq: np.ndarray
+              True for reads that are uniquely mapping
+        undetermined: int
+                      number of reads whose status could not be determined
+        """
+        # Secondary alignments are never unique
+        primary = (flags & 256) == 0
+        if self.min_mapq is not None:
+            return primary & (mapping_qualities >= self.min_mapq), 0
+        has_nh = nh_counts >= 0
+        if self.aligner == "auto":
+            # Reliable in case of STAR
+            uniq_mapq = mapping_qualities == 255
+            # NH tag not set so rely on MAPQ and flags
+            undetermined = (
+                ~has_nh
+                & ~uniq_mapq
+                & (mapping_qualities >= 1)
+                & ~np.isin(flags, __SAM_NOT_UNIQ_FLAGS__)
             )
+            undetermined = int(np.count_nonzero(undetermined & primary))
+        else:
+            low, high = ALIGNER_UNIQ_MAPQ[self.aligner]
+            uniq_mapq = (mapping_qualities >= low) & (mapping_qualities <= high)
+            undetermined = 0
+        uniq = primary & np.where(has_nh, nh_counts == 1, uniq_mapq)
+        return uniq, undetermined
+
+    def is_uniq_mapping(self, read):
+        """Check if a single read is uniquely mapping
+
+        Parameters
+        ----------
+        read : pysam.AlignedSegment
+
+        Returns
+        -------
+        uniq: bool
+        """
+        # Filter out secondary alignments
+        if read.is_secondary:
+            return False
+        mapping_quality = read.mapping_quality
+        if self.min_mapq is not None:
+            return mapping_quality >= self.min_mapq
+        try:
+            return read.get_tag("NH") == 1
+        except KeyError:
+            pass
+        if self.aligner != "auto":
+            low, high = ALIGNER_UNIQ_MAPQ[self.aligner]
+            return low <= mapping_quality <= high
+        if mapping_quality == 255:
+            return True
+        if mapping_quality >= 1 and read.flag not in __SAM_NOT_UNIQ_FLAGS__:
+            self.undetermined += 1
+        return False
+
+    def apply(self, flags, nh_counts, mapping_qualities):
+        """Select usable reads
+
+        Parameters
+        ----------
+        flags: np.ndarray
+               SAM flag of each read
+        nh_counts: np.ndarray
+                   value of the NH tag, negative if the tag is missing
+        mapping_qualities: np.ndarray
+                           MAPQ of each read
+
+        Returns
+        -------
+        usable: np.ndarray
+                True for reads passing all filters
+        counts: Counter
+                number of reads discarded by each filter, each read
+                is assigned to the first filter it fails. 'undetermined'
+                counts the multimapping reads of unknown status, these
+                are not added to self.undetermined so that results of
+                worker processes can be merged first
+        """
+        counts = Counter()
+        usable = np.ones(len(flags), dtype=bool)
+        for category, flag in self.categories:
+            failed = usable & ((flags & flag) != 0)
+            counts[category] += int(np.count_nonzero(failed))
+            usable &= ~failed
+        uniq, undetermined = self.uniq_mapping(
+            flags[usable], nh_counts[usable], mapping_qualities[usable]
+        )
+        counts["multi"] += int(np.count_nonzero(~uniq))
+        counts["undetermined"] += undetermined
+        usable[usable] = uniq
+        return usable, counts
 
 
 def merge_intervals(intervals):
@@ -84,6 +247,247 @@ def merge_intervals(intervals):
     return merged_intervals
 
 
+class TranscriptCoordinateMapper:
+    """Map positions between a transcript and the genome.
+
+    Transcript positions are 0-based and start at the 5' end of the
+    transcript, genome positions are 1-based. The cumulative exon lengths
+    are computed once, and positions are then mapped in batches by binary
+    search.
+    """
+
+    def __init__(self, intervals, reverse=False):
+        """
+        Parameters
+        ----------
+        intervals: List[Interval]
+                   exons of the transcript, sorted by start and not overlapping
+        reverse: bool
+                 whether the transcript is on the reverse strand
+        """
+        self.intervals = intervals
+        self.reverse = reverse
+        self.chrom = intervals[0].chrom if intervals else None
+        self.strand = intervals[0].strand if intervals else None
+        self.starts = np.array([iv.start for iv in intervals], dtype=np.int64)
+        self.ends = np.array([iv.end for iv in intervals], dtype=np.int64)
+        # transcript position of each exon start, read in the genome direction
+        self.offsets = np.zeros(len(intervals) + 1, dtype=np.int64)
+        np.cumsum(self.ends - self.starts + 1, out=self.offsets[1:])
+        self.length = int(self.offsets[-1])
+
+    def _flip(self, positions):
+        """Switch between transcript and genome direction"""
+        if self.reverse:
+            return self.length - 1 - positions
+        return positions
+
+    def _exons(self, positions):
+        """Exon of positions given in the genome direction"""
+        return np.searchsorted(self.offsets, positions, side="right") - 1
+
+    def to_genome(self, positions):
+        """Genome positions of transcript positions
+
+        Parameters
+        ----------
+        positions: array like
+                   0-based transcript positions, within the transcript
+
+        Returns
+        -------
+        genome_positions: np.ndarray
+                          1-based genome positions
+        """
+        positions = self._flip(np.asarray(positions, dtype=np.int64))
+        exons = self._exons(positions)
+        return self.starts[exons] + positions - self.offsets[exons]
+
+    def to_transcript(self, positions):
+        """Transcript positions of genome positions
+
+        Parameters
+        ----------
+        positions: array like
+                   1-based genome positions
+
+        Returns
+        -------
+        transcript_positions: np.ndarray
+                              0-based transcript positions,
+                              -1 for positions outside of the exons
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        exons = np.searchsorted(self.starts, positions, side="right") - 1
+        inside = exons >= 0
+        inside[inside] = positions[inside] <= self.ends[exons[inside]]
+        exons = np.maximum(exons, 0)
+        transcript = self._flip(self.offsets[exons] + positions - self.starts[exons])
+        return np.where(inside, transcript, -1)
+
+    def genome_positions(self):
+        """All genome positions of the transcript, in ascending order"""
+        lengths = self.ends - self.starts + 1
+        return np.repeat(self.starts - self.offsets[:-1], lengths) + np.arange(
+            self.length
+        )
+
+    def map_intervals(self, starts, ends):
+        """Genome intervals of transcript regions
+
+        Parameters
+        ----------
+        starts: array like
+                0-based start of each region in the transcript
+        ends: array like
+              0-based end (included) of each region in the transcript
+
+        Returns
+        -------
+        ivs: List[List[Interval]]
+             intervals of each region, sorted by start
+        """
+        starts = self._flip(np.asarray(starts, dtype=np.int64))
+        ends = self._flip(np.asarray(ends, dtype=np.int64))
+        if self.reverse:
+            starts, ends = ends, starts
+        first_exons = self._exons(starts)
+        last_exons = self._exons(ends)
+        genome_starts = self.starts[first_exons] + starts - self.offsets[first_exons]
+        genome_ends = self.starts[last_exons] + ends - self.offsets[last_exons]
+        exon_starts = self.starts.tolist()
+        exon_ends = self.ends.tolist()
+        regions = []
+        for first, last, start, end in zip(
+            first_exons.tolist(),
+            last_exons.tolist(),
+            genome_starts.tolist(),
+            genome_ends.tolist(),
+        ):
+            ivs = [
+                Interval(self.chrom, exon_starts[i], exon_ends[i], self.strand)
+                for i in range(first, last + 1)
+            ]
+            ivs[0].start = start
+            ivs[-1].end = end
+            regions.append(ivs)
+        return regions
+
+
+def file_checksum(path):
+    """MD5 checksum of the content of a file
+
+    Parameters
+    ----------
+    path: str
+          Path to the file
+
+    Returns
+    -------
+    checksum: str
+    """
+    checksum = hashlib.md5()
+    with open(path, "rb") as handle:
+        for block in iter(lambda: handle.read(CHECKSUM_BLOCK_SIZE), b""):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+def file_fingerprint(path):
+    """Size, modification time and checksum of a file
+
+    Saved with a binary copy of a file, to check with same_content
+    that the copy is up-to-date.
+
+    Parameters
+    ----------
+    path: str
+          Path to the file
+
+    Returns
+    -------
+    fingerprint: dict
+    """
+    stat = os.stat(path)
+    return {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "md5": file_checksum(path),
+    }
+
+
+def same_content(path, fingerprint):
+    """Check that a file has the content it had when fingerprinted
+
+    The file is only read again if its modification time changed but
+    not its size, as after a copy, a checkout or a touch.
+
+    Parameters
+    ----------
+    path: str
+          Path to the file
+    fingerprint: dict
+                 output of file_fingerprint
+
+    Returns
+    -------
+    same: bool
+    """
+    stat = os.stat(path)
+    if stat.st_size != fingerprint["size"]:
+        return False
+    if stat.st_mtime_ns == fingerprint["mtime_ns"]:
+        return True
+    return file_checksum(path) == fingerprint["md5"]
+
+
+def replace_directory(tmp_path, path):
+    """Move a directory into place, replacing any previous one
+
+    If another process moves its own copy into place at the same time,
+    that copy is kept and tmp_path is removed.
+
+    Parameters
+    ----------
+    tmp_path: str
+              Path to the new directory
+    path: str
+          Path to move it to
+    """
+    shutil.rmtree(path, ignore_errors=True)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not os.path.isdir(path):
+            raise
+
+
+def is_gzipped(path):
+    """Check whether a file is compressed with gzip (or bgzip)"""
+    with open(path, "rb") as handle:
+        return handle.read(2) == b"\x1f\x8b"
+
+
+def open_file(path, mode="r"):
+    """Open a file for reading, decompressing it if needed
+
+    Parameters
+    ----------
+    path: str
+          Path to the file, possibly compressed with gzip or bgzip
+    mode: str
+          'r' for text or 'rb' for bytes
+
+    Returns
+    -------
+    handle: file
+    """
+    if is_gzipped(path):
+        return gzip.open(path, mode if "b" in mode else mode + "t")
+    return open(path, mode)
+
+
 def mkdir_p(path):
     """Make directory even if it exists.
 
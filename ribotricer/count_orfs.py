@@ -15,7 +15,7 @@
 
 from collections import defaultdict
 from textwrap import wrap
-from .orf import ORF
+from .orf_index import read_orf_table
 
 import numpy as np
 import pandas as pd
@@ -38,13 +38,9 @@ def count_orfs(ribotricer_index, detected_orfs, features, outfile, report_all=Fa
     """
     orf_index = {}
     read_counts = defaultdict(dict)
-    with open(ribotricer_index, "r") as fin:
-        # Skip header
-        fin.readline()
-        for line in fin:
-            orf = ORF.from_string(line)
-            if orf.category in features:
-                orf_index[orf.oid] = orf
+    orf_table = read_orf_table(ribotricer_index, features)
+    for orf in orf_table:
+        orf_index[orf.oid] = orf.row
     with open(detected_orfs, "r") as fin:
         # Skip header
         fin.readline()
@@ -56,7 +52,7 @@ def count_orfs(ribotricer_index, detected_orfs, features, outfile, report_all=Fa
             if otype in features:
                 # do not output 'nontranslating' events unless report_all is set
                 if status != "nontranslating" or report_all:
-                    intervals = orf_index[oid].intervals
+                    intervals = orf_table[orf_index[oid]].intervals
                     coor = [x for iv in intervals for x in range(iv.start, iv.end + 1)]
                     if strand == "-":
                         coor = coor[::-1]
@@ -107,13 +103,9 @@ def count_orfs_codon(
     orf_index = {}
     fasta_df = pd.read_csv(ribotricer_index_fasta, sep="\t").set_index("ORF_ID")
     read_counts = defaultdict(dict)
-    with open(ribotricer_index, "r") as fin:
-        # Skip header
-        fin.readline()
-        for line in fin:
-            orf = ORF.from_string(line)
-            if orf.category in features:
-                orf_index[orf.oid] = orf
+    orf_table = read_orf_table(ribotricer_index, features)
+    for orf in orf_table:
+        orf_index[orf.oid] = orf.row
     with open(detected_orfs, "r") as fin:
         # Skip header
         fin.readline()
@@ -125,7 +117,7 @@ def count_orfs_codon(
             if otype in features:
                 # do not output 'nontranslating' events unless report_all is set
                 if status != "nontranslating" or report_all:
-                    intervals = orf_index[oid].intervals
+                    intervals = orf_table[orf_index[oid]].intervals
                     coor = [x for iv in intervals for x in range(iv.start, iv.end + 1)]
                     codon_coor = [
                         x for iv in intervals for x in range(iv.start, iv.end + 1, 3)
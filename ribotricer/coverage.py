@@ -0,0 +1,385 @@
+"""Array backed storage of read coverage"""
+# Part of ribotricer software
+#
+# Copyright (C) 2019 Saket Choudhary, Wenzheng Li, and Andrew D Smith
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+from array import array
+from collections import defaultdict
+
+import numpy as np
+
+# Number of buffered positions per track before they
+# are collapsed into the sorted arrays
+BUFFER_SIZE = 1 << 20
+
+
+def _position_dtype(positions):
+    """Smallest signed integer type that holds the positions"""
+    if len(positions) == 0:
+        return np.int32
+    info = np.iinfo(np.int32)
+    if positions[0] >= info.min and positions[-1] <= info.max:
+        return np.int32
+    return np.int64
+
+
+def _count_dtype(counts):
+    """Smallest unsigned integer type that holds the counts"""
+    if len(counts) == 0:
+        return np.uint8
+    return np.min_scalar_type(int(counts.max()))
+
+
+def sum_by_position(positions, counts):
+    """Add up counts of identical positions
+
+    Parameters
+    ----------
+    positions: np.ndarray
+               positions, in any order and possibly repeated
+    counts: np.ndarray
+            count for each entry of positions
+
+    Returns
+    -------
+    positions: np.ndarray
+               sorted unique positions
+    counts: np.ndarray
+            total count for each position
+    """
+    positions = np.asarray(positions, dtype=np.int64)
+    counts = np.asarray(counts, dtype=np.int64)
+    order = np.argsort(positions, kind="mergesort")
+    positions = positions[order]
+    counts = counts[order]
+    if len(positions) == 0:
+        return positions, counts
+    boundaries = np.flatnonzero(np.diff(positions)) + 1
+    boundaries = np.concatenate(([0], boundaries))
+    return positions[boundaries], np.add.reduceat(counts, boundaries)
+
+
+class CoverageStore:
+    """Read counts stored as one sorted position array and one
+    count array per (chromosome, strand, read length).
+
+    Chromosomes are referred to by integer ids internally. Coverage
+    merged across read lengths is stored with a read length of None.
+    All positions are one-based.
+    """
+
+    def __init__(self, chroms=None):
+        """
+        Parameters
+        ----------
+        chroms: list of str
+                chromosome names, their index is used as chromosome id
+        """
+        self.chroms = []
+        self.chrom_ids = {}
+        for chrom in chroms or []:
+            self.chrom_id(chrom)
+        self._tracks = {}
+        self._pending = defaultdict(lambda: array("q"))
+
+    def __getstate__(self):
+        self._flush()
+        return {"chroms": self.chroms, "tracks": self._tracks}
+
+    def __setstate__(self, state):
+        self.chroms = []
+        self.chrom_ids = {}
+        for chrom in state["chroms"]:
+            self.chrom_id(chrom)
+        self._tracks = state["tracks"]
+        self._pending = defaultdict(lambda: array("q"))
+
+    def chrom_id(self, chrom):
+        """Integer id of a chromosome, assigned on first use"""
+        try:
+            return self.chrom_ids[chrom]
+        except KeyError:
+            self.chrom_ids[chrom] = len(self.chroms)
+            self.chroms.append(chrom)
+            return self.chrom_ids[chrom]
+
+    def add(self, chrom, strand, length, pos):
+        """Count one read
+
+        Parameters
+        ----------
+        chrom: str
+               chromosome name
+        strand: str
+                '+' or '-'
+        length: int
+                read length
+        pos: int
+             one-based position of the read
+        """
+        key = (self.chrom_id(chrom), strand, length)
+        buffered = self._pending[key]
+        buffered.append(pos)
+        if len(buffered) >= BUFFER_SIZE:
+            self._flush_track(key)
+
+    def add_reads(self, chrom_ids, minus_strand, lengths, positions):
+        """Count a block of reads
+
+        Parameters
+        ----------
+        chrom_ids: np.ndarray
+                   chromosome id of each read
+        minus_strand: np.ndarray
+                      True for reads assigned to the '-' strand
+        lengths: np.ndarray
+                 read length of each read
+        positions: np.ndarray
+                   one-based position of each read
+        """
+        if len(positions) == 0:
+            return
+        keys = np.stack(
+            (np.asarray(chrom_ids), np.asarray(minus_strand), np.asarray(lengths))
+        ).astype(np.int64)
+        order = np.lexsort(keys[::-1])
+        keys = keys[:, order]
+        positions = np.asarray(positions, dtype=np.int64)[order]
+        boundaries = np.flatnonzero(np.any(np.diff(keys, axis=1), axis=0)) + 1
+        boundaries = np.concatenate(([0], boundaries, [len(positions)]))
+        for begin, end in zip(boundaries[:-1], boundaries[1:]):
+            chrom_id, minus, length = keys[:, begin].tolist()
+            key = (chrom_id, "-" if minus else "+", length)
+            buffered = self._pending[key]
+            buffered.frombytes(positions[begin:end].tobytes())
+            if len(buffered) >= BUFFER_SIZE:
+                self._flush_track(key)
+
+    def add_counts(self, chrom, strand, length, positions, counts=None):
+        """Count a batch of reads
+
+        Parameters
+        ----------
+        chrom: str
+               chromosome name
+        strand: str
+                '+' or '-'
+        length: int
+                read length, None for merged coverage
+        positions: array like
+                   one-based positions
+        counts: array like
+                number of reads for each position, one if None
+        """
+        if counts is None:
+            counts = np.ones(len(positions), dtype=np.int64)
+        if len(positions) == 0:
+            return
+        key = (self.chrom_id(chrom), strand, length)
+        self._flush_track(key)
+        self._merge_track(key, positions, counts)
+
+    def _merge_track(self, key, positions, counts):
+        if key in self._tracks:
+            old_positions, old_counts = self._tracks[key]
+            positions = np.concatenate((old_positions, positions))
+            counts = np.concatenate((old_counts, counts))
+        positions, counts = sum_by_position(positions, counts)
+        self._tracks[key] = (
+            positions.astype(_position_dtype(positions)),
+            counts.astype(_count_dtype(counts)),
+        )
+
+    def _flush_track(self, key):
+        buffered = self._pending.pop(key, None)
+        if buffered:
+            positions = np.frombuffer(buffered, dtype=np.int64)
+            self._merge_track(key, positions, np.ones(len(positions), np.int64))
+
+    def _flush(self):
+        for key in list(self._pending):
+            self._flush_track(key)
+
+    def keys(self):
+        """List of (chrom, strand, length) with coverage"""
+        self._flush()
+        return [
+            (self.chroms[chrom_id], strand, length)
+            for chrom_id, strand, length in self._tracks
+        ]
+
+    def strands(self):
+        """Strands with coverage"""
+        return sorted({strand for _, strand, _ in self.keys()})
+
+    def track(self, chrom, strand, length=None):
+        """Sorted positions and their counts
+
+        Parameters
+        ----------
+        chrom: str
+               chromosome name
+        strand: str
+                '+' or '-'
+        length: int
+                read length, None for merged coverage
+
+        Returns
+        -------
+        positions: np.ndarray
+                   sorted one-based positions
+        counts: np.ndarray
+                number of reads at each position
+        """
+        self._flush()
+        key = (self.chrom_ids.get(chrom), strand, length)
+        if key not in self._tracks:
+            return np.zeros(0, np.int32), np.zeros(0, np.uint8)
+        return self._tracks[key]
+
+    def gather(self, chrom, strand, positions, length=None):
+        """Counts at a batch of positions
+
+        Parameters
+        ----------
+        chrom: str
+               chromosome name
+        strand: str
+                '+' or '-'
+        positions: array like
+                   one-based positions to query
+        length: int
+                read length, None for merged coverage
+
+        Returns
+        -------
+        counts: np.ndarray
+                counts for each position (0 for uncovered ones)
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        counts = np.zeros(len(positions), dtype=np.int64)
+        track_positions, track_counts = self.track(chrom, strand, length)
+        if len(track_positions) == 0 or len(positions) == 0:
+            return counts
+        idx = np.searchsorted(track_positions, positions)
+        idx[idx == len(track_positions)] = 0
+        found = track_positions[idx] == positions
+        counts[found] = track_counts[idx[found]]
+        return counts
+
+    def shift(self, offsets):
+        """Merge read lengths after shifting by their offsets
+
+        Parameters
+        ----------
+        offsets: dict
+                 key is the length, value is the offset.
+                 Positions on the + strand are moved downstream and
+                 positions on the - strand are moved upstream.
+                 Lengths not in offsets are discarded.
+
+        Returns
+        -------
+        merged: CoverageStore
+                coverage with all lengths merged (length None)
+        """
+        self._flush()
+        grouped = defaultdict(list)
+        for (chrom_id, strand, length), (positions, counts) in self._tracks.items():
+            if length not in offsets:
+                continue
+            offset = int(offsets[length])
+            if strand == "-":
+                offset = -offset
+            grouped[chrom_id, strand].append(
+                (positions.astype(np.int64) + offset, counts)
+            )
+        merged = CoverageStore(self.chroms)
+        for (chrom_id, strand), tracks in grouped.items():
+            positions = np.concatenate([positions for positions, _ in tracks])
+            counts = np.concatenate([counts.astype(np.int64) for _, counts in tracks])
+            merged._merge_track((chrom_id, strand, None), positions, counts)
+        return merged
+
+    def merge(self, other):
+        """Add the counts of another store to this one
+
+        Parameters
+        ----------
+        other: CoverageStore
+               coverage to add, its chromosome ids need not match
+        """
+        other._flush()
+        for (chrom_id, strand, length), (positions, counts) in other._tracks.items():
+            key = (self.chrom_id(other.chroms[chrom_id]), strand, length)
+            self._flush_track(key)
+            self._merge_track(key, positions, counts)
+        return self
+
+    def to_arrays(self):
+        """Flatten the store into arrays, for saving with numpy
+
+        Returns
+        -------
+        arrays: dict
+                'chroms' lists the chromosome names, 'keys' has one
+                (chrom_id, strand, length) row per track with strand
+                0 for '+' and 1 for '-' and length -1 for merged coverage.
+                The positions and counts of all tracks are concatenated
+                in 'positions' and 'counts', track i spans
+                offsets[i]:offsets[i + 1]
+        """
+        self._flush()
+        keys = []
+        positions = []
+        counts = []
+        for (chrom_id, strand, length), track in self._tracks.items():
+            keys.append((chrom_id, strand == "-", -1 if length is None else length))
+            positions.append(track[0].astype(np.int64))
+            counts.append(track[1].astype(np.int64))
+        offsets = np.cumsum([0] + [len(track) for track in positions])
+        return {
+            "chroms": np.array(self.chroms, dtype=str),
+            "keys": np.array(keys, dtype=np.int64).reshape(-1, 3),
+            "offsets": offsets.astype(np.int64),
+            "positions": np.concatenate(positions or [np.zeros(0, np.int64)]),
+            "counts": np.concatenate(counts or [np.zeros(0, np.int64)]),
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Rebuild a store from the output of to_arrays
+
+        Parameters
+        ----------
+        arrays: dict like
+                arrays created by to_arrays, e.g. a loaded npz file
+
+        Returns
+        -------
+        store: CoverageStore
+        """
+        store = cls(arrays["chroms"].tolist())
+        offsets = arrays["offsets"]
+        positions = arrays["positions"]
+        counts = arrays["counts"]
+        for i, (chrom_id, minus, length) in enumerate(arrays["keys"].tolist()):
+            begin, end = offsets[i], offsets[i + 1]
+            key = (chrom_id, "-" if minus else "+", None if length < 0 else length)
+            track_positions = positions[begin:end]
+            track_counts = counts[begin:end]
+            store._tracks[key] = (
+                track_positions.astype(_position_dtype(track_positions)),
+                track_counts.astype(_count_dtype(track_counts)),
+            )
+        return store
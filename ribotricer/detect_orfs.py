@@ -13,16 +13,19 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 # GNU General Public License for more details.
 
-from collections import Counter
 from collections import defaultdict
+from collections import deque
 import datetime
+import multiprocessing
 
 import numpy as np
-from tqdm import tqdm
 from quicksect import Interval, IntervalTree
 
+from .bam import AlignmentStream
+from .bam import STDIN
 from .bam import split_bam
 from .common import collapse_coverage_to_codon
+from .common import ReadFilter
 from .common import mkdir_p
 from .common import parent_dir
 from .const import CUTOFF
@@ -30,16 +33,51 @@ from .const import MINIMUM_VALID_CODONS
 from .const import MINIMUM_VALID_CODONS_RATIO
 from .const import MINIMUM_READS_PER_CODON
 from .const import MINIMUM_DENSITY_OVER_ORF
+from .footprint import footprint_padding
+from .footprint import index_footprint
 from .infer_protocol import infer_protocol
 from .metagene import metagene_coverage
 from .metagene import align_metagenes
 from .orf import ORF
+from .orf import ORFTable
+from .orf import ORFView
+from .orf_index import ORFStream
 from .plotting import plot_read_lengths
 from .plotting import plot_metagene
+from .shard import shard_index_path
 from .statistics import coherence
+from .statistics import phase_scores
 
 # Required for IntervalTree
 STRAND_TO_NUM = {"+": 1, "-": -1}
+# Number of ORFs scored together, whose coverages are gathered at once
+SCORE_CHUNK_SIZE = 1024
+# Number of chunks submitted ahead per scoring process
+CHUNKS_PER_THREAD = 4
+# Columns of the detected ORFs file
+OUTPUT_COLUMNS = [
+    "ORF_ID",
+    "ORF_type",
+    "status",
+    "phase_score",
+    "read_count",
+    "length",
+    "valid_codons",
+    "valid_codons_ratio",
+    "read_density",
+    "transcript_id",
+    "transcript_type",
+    "gene_id",
+    "gene_name",
+    "gene_type",
+    "chrom",
+    "strand",
+    "start_codon",
+    "profile",
+]
+
+# ORFScorer of a worker process
+_worker_scorer = None
 
 
 def merge_read_lengths(alignments, psite_offsets):
@@ -49,28 +87,17 @@ def merge_read_lengths(alignments, psite_offsets):
 
     Parameters
     ----------
-    alignments: dict(dict(Counter))
+    alignments: CoverageStore
                 bam split by length, strand
     psite_offsets: dict
                    key is the length, value is the offset
     Returns
     -------
-    merged_alignments: dict(dict)
+    merged_alignments: CoverageStore
                        alignments by merging all lengths
     """
     # print('merging different lengths...')
-    merged_alignments = defaultdict(Counter)
-
-    for length, offset in list(psite_offsets.items()):
-        for strand in alignments[length]:
-            for chrom, pos in alignments[length][strand]:
-                count = alignments[length][strand][(chrom, pos)]
-                if strand == "+":
-                    pos_shifted = pos + offset
-                else:
-                    pos_shifted = pos - offset
-                merged_alignments[strand][(chrom, pos_shifted)] += count
-    return merged_alignments
+    return alignments.shift(psite_offsets)
 
 
 def parse_ribotricer_index(ribotricer_index):
@@ -80,61 +107,116 @@ def parse_ribotricer_index(ribotricer_index):
 
     Parameters
     ----------
-    ribotricer_index: str
-                   Path to the index file generated by ribotricer prepare_orfs
+    ribotricer_index: str or ORFStream
+                   Path to the index file generated by ribotricer prepare_orfs,
+                   or a stream of it. The annotated regions appear first in
+                   the index, a stream is left at the first other region
 
     Returns
     -------
     annotated: List[ORF]
                ORFs of CDS annotated
-    novel: List[ORF]
-           list of non-annotated ORFs
     refseq: defaultdict(IntervalTree)
             chrom: (start, end, strand)
     """
-
-    annotated = []
+    if not isinstance(ribotricer_index, ORFStream):
+        ribotricer_index = ORFStream(ribotricer_index)
+    with ribotricer_index.progress(leave=False) as pbar:
+        annotated = ribotricer_index.read_leading("annotated", pbar)
     refseq = defaultdict(IntervalTree)
-
-    # First count the number of
-    # annotated regions to count.
-    # The annotated regions appear first in the index file
-    # so need to read only upto a point where the regions
-    # no longer have the annotated tag.
-    total_lines = 0
-    with open(ribotricer_index, "r") as anno:
-        # read header
-        anno.readline()
-        while "annotated" in anno.readline():
-            total_lines += 1
-    with open(ribotricer_index, "r") as anno:
-        with tqdm(total=total_lines, unit="lines", leave=False) as pbar:
-            # read header
-            anno.readline()
-            line = anno.readline()
-            while "annotated" in line:
-                pbar.update()
-                orf = ORF.from_string(line)
-                if orf is not None and orf.category == "annotated":
-                    refseq[orf.chrom].insert(
-                        Interval(
-                            orf.intervals[0].start,
-                            orf.intervals[-1].end,
-                            STRAND_TO_NUM[orf.strand],
-                        )
-                    )
-                    annotated.append(orf)
-                line = anno.readline()
+    for orf in annotated:
+        refseq[orf.chrom].insert(
+            Interval(
+                orf.intervals[0].start, orf.intervals[-1].end, STRAND_TO_NUM[orf.strand]
+            )
+        )
     return (annotated, refseq)
 
 
+def orf_coverages(orfs, alignments, offset_5p=0, offset_3p=0):
+    """Coverage of a batch of ORFs
+
+    The genome positions of all ORFs are built from their exons at once,
+    and the counts of all ORFs on the same chromosome and strand are
+    looked up together.
+
+    Parameters
+    ----------
+    orfs: List[ORF]
+          ORFs or ORFViews
+    alignments: CoverageStore
+                alignments summarized from bam by merging lengths
+    offset_5p: int
+               the number of nts to include from 5'prime
+    offset_3p: int
+               the number of nts to include from 3'prime
+
+    Returns
+    -------
+    coverages: List[list]
+               coverage of each ORF, from 5' to 3'
+    """
+    if not orfs:
+        return []
+    starts = []
+    ends = []
+    n_exons = []
+    tracks = {}
+    track_ids = []
+    for orf in orfs:
+        if isinstance(orf, ORFView):
+            orf_starts, orf_ends = orf.table.exons(orf.row)
+        else:
+            orf_starts = [iv.start for iv in orf.intervals]
+            orf_ends = [iv.end for iv in orf.intervals]
+        starts.extend(orf_starts)
+        ends.extend(orf_ends)
+        n_exons.append(len(orf_starts))
+        track_ids.append(tracks.setdefault((orf.chrom, orf.strand), len(tracks)))
+    starts = np.array(starts, dtype=np.int64)
+    ends = np.array(ends, dtype=np.int64)
+    n_exons = np.array(n_exons, dtype=np.int64)
+    track_ids = np.array(track_ids, dtype=np.int64)
+    minus = np.array([strand == "-" for _, strand in tracks], dtype=bool)[track_ids]
+
+    # the offsets extend the first and last exon of each ORF
+    first = np.cumsum(n_exons) - n_exons
+    last = first + n_exons - 1
+    starts[first] -= np.where(minus, offset_3p, offset_5p)
+    ends[last] += np.where(minus, offset_5p, offset_3p)
+
+    exon_lengths = ends - starts + 1
+    exon_offsets = np.cumsum(exon_lengths) - exon_lengths
+    positions = np.repeat(starts - exon_offsets, exon_lengths) + np.arange(
+        exon_lengths.sum()
+    )
+    lengths = np.add.reduceat(exon_lengths, first)
+    bounds = np.cumsum(lengths)
+
+    counts = np.zeros(len(positions), dtype=np.int64)
+    position_tracks = np.repeat(track_ids, lengths)
+    for (chrom, strand), track_id in tracks.items():
+        selected = np.flatnonzero(position_tracks == track_id)
+        counts[selected] = alignments.gather(chrom, strand, positions[selected])
+
+    coverages = []
+    for begin, end, reverse in zip(
+        (bounds - lengths).tolist(), bounds.tolist(), minus.tolist()
+    ):
+        coverage = counts[begin:end]
+        if reverse:
+            coverage = coverage[::-1]
+        coverages.append(coverage.tolist())
+    return coverages
+
+
 def orf_coverage(orf, alignments, offset_5p=0, offset_3p=0):
     """
     Parameters
     ----------
     orf: ORF
          instance of ORF
-    alignments: dict(Counter)
+    alignments: CoverageStore
                 alignments summarized from bam by merging lengths
     offset_5p: int
                the number of nts to include from 5'prime
@@ -143,144 +225,227 @@ def orf_coverage(orf, alignments, offset_5p=0, offset_3p=0):
 
     Returns
     -------
-    coverage: array
+    coverage: list
               coverage for ORF
     """
-    coverage = []
-    chrom = orf.chrom
-    strand = orf.strand
-    if strand == "-":
-        offset_5p, offset_3p = offset_3p, offset_5p
-    first, last = orf.intervals[0], orf.intervals[-1]
-    for pos in range(first.start - offset_5p, first.start):
-        if orf.category == "annotated":
-            try:
-                coverage.append(alignments[strand][(chrom, pos)])
-            except KeyError:
-                coverage.append(0)
-        else:
-            if strand in alignments and (chrom, pos) in alignments[strand]:
-                coverage.append(alignments[strand][(chrom, pos)])
-            else:
-                coverage.append(0)
-
-    for interval in orf.intervals:
-        for pos in range(interval.start, interval.end + 1):
-            if orf.category == "annotated":
-                try:
-                    coverage.append(alignments[strand][(chrom, pos)])
-                except KeyError:
-                    coverage.append(0)
-            else:
-                if strand in alignments and (chrom, pos) in alignments[strand]:
-                    coverage.append(alignments[strand][(chrom, pos)])
-                else:
-                    coverage.append(0)
-
-    for pos in range(last.end + 1, last.end + offset_3p + 1):
-        if orf.category == "annotated":
-            try:
-                coverage.append(alignments[strand][(chrom, pos)])
-            except KeyError:
-                coverage.append(0)
-        else:
-            if strand in alignments and (chrom, pos) in alignments[strand]:
-                coverage.append(alignments[strand][(chrom, pos)])
-            else:
-                coverage.append(0)
+    return orf_coverages([orf], alignments, offset_5p, offset_3p)[0]
 
-    if strand == "-":
-        coverage.reverse()
-    return coverage
 
-
-def export_orf_coverages(
-    ribotricer_index,
-    merged_alignments,
-    prefix,
+def score_coverage(
+    cov,
     phase_score_cutoff=CUTOFF,
     min_valid_codons=MINIMUM_VALID_CODONS,
     min_reads_per_codon=MINIMUM_READS_PER_CODON,
     min_valid_codons_ratio=MINIMUM_VALID_CODONS_RATIO,
     min_density_over_orf=MINIMUM_DENSITY_OVER_ORF,
-    report_all=False,
+    phase=None,
 ):
-    """
+    """Score the coverage of an ORF
+
     Parameters
     ----------
-    ribotricer_index: str
-                   Path to the index file generated by ribotricer prepare_orfs
-    merged_alignments: dict(dict)
-                       alignments by merging all lengths
-    prefix: str
-            prefix for output file
-    report_all: bool
-                if True, all coverages will be exported
+    cov: list
+         coverage of the ORF, as given by orf_coverage
+    phase: tuple
+           phase score and number of valid codons of the coverage,
+           computed with coherence if None
+
+    Returns
+    -------
+    status: str
+            'translating' or 'nontranslating'
+    coh: float
+         phase score
+    count: int
+           number of reads
+    length: int
+            length of the ORF
+    valid_codons: int
+                  number of codons with reads
+    valid_codons_ratio: float
+                        fraction of codons with reads
+    orf_density: float
+                 reads per codon
     """
-    # print('exporting coverages for all ORFs...')
-    columns = [
-        "ORF_ID",
-        "ORF_type",
-        "status",
-        "phase_score",
-        "read_count",
-        "length",
-        "valid_codons",
-        "valid_codons_ratio",
-        "read_density",
-        "transcript_id",
-        "transcript_type",
-        "gene_id",
-        "gene_name",
-        "gene_type",
-        "chrom",
-        "strand",
-        "start_codon",
-        "profile\n",
-    ]
-    to_write = "\t".join(columns)
-    formatter = "{}\t" * (len(columns) - 1) + "{}\n"
-    with open(ribotricer_index, "r") as anno:
-        total_lines = len(["" for line in anno])
-
-    with open(ribotricer_index, "r") as anno, open(
-        "{}_translating_ORFs.tsv".format(prefix), "w"
-    ) as output:
-        output.write(to_write)
-        with tqdm(total=total_lines, unit="ORFs") as pbar:
-            # Skip header
-            anno.readline()
-            for line in anno:
-                pbar.update()
-                orf = ORF.from_string(line)
-                cov = orf_coverage(orf, merged_alignments)
-                count = sum(cov)
-                length = len(cov)
-                coh, valid_codons = coherence(cov)
-                n_codons = max(1, length // 3)
-
-                # codon level coverage
-                codon_coverage = np.array(collapse_coverage_to_codon(cov))
-                valid_codons_ratio = valid_codons / n_codons
-                # total reads in the ORF divided by the length
-                orf_density = np.sum(codon_coverage) / n_codons
-                codon_coverage_exceeds_min = codon_coverage >= min_reads_per_codon
-                status = (
-                    "translating"
-                    if (
-                        coh >= phase_score_cutoff
-                        and valid_codons >= min_valid_codons
-                        and np.all(codon_coverage_exceeds_min)
-                        and valid_codons_ratio >= min_valid_codons_ratio
-                        and orf_density >= min_density_over_orf
-                    )
-                    else "nontranslating"
+    if phase is None:
+        phase = coherence(cov)
+    coh, valid_codons = phase
+    count = sum(cov)
+    length = len(cov)
+    n_codons = max(1, length // 3)
+
+    # codon level coverage
+    codon_coverage = np.array(collapse_coverage_to_codon(cov))
+    valid_codons_ratio = valid_codons / n_codons
+    # total reads in the ORF divided by the length
+    orf_density = np.sum(codon_coverage) / n_codons
+    codon_coverage_exceeds_min = codon_coverage >= min_reads_per_codon
+    status = (
+        "translating"
+        if (
+            coh >= phase_score_cutoff
+            and valid_codons >= min_valid_codons
+            and np.all(codon_coverage_exceeds_min)
+            and valid_codons_ratio >= min_valid_codons_ratio
+            and orf_density >= min_density_over_orf
+        )
+        else "nontranslating"
+    )
+    return (
+        status,
+        coh,
+        count,
+        length,
+        valid_codons,
+        valid_codons_ratio,
+        orf_density,
+    )
+
+
+class ORFScorer:
+    """Score chunks of ORFs and format their lines of the output.
+
+    A chunk is a row range of the binary index, a table of ORFs or
+    a list of lines of the tsv index, with the row of its first ORF.
+    Chunks must be given in increasing rows. ORFs of several transcripts
+    covering the same exons are scored once: the scores of a duplicated
+    signature are kept until the last row with the same signature hash.
+    Each worker process keeps its own scores.
+    """
+
+    def __init__(
+        self,
+        merged_alignments,
+        index,
+        hashes,
+        phase_score_cutoff=CUTOFF,
+        min_valid_codons=MINIMUM_VALID_CODONS,
+        min_reads_per_codon=MINIMUM_READS_PER_CODON,
+        min_valid_codons_ratio=MINIMUM_VALID_CODONS_RATIO,
+        min_density_over_orf=MINIMUM_DENSITY_OVER_ORF,
+        report_all=False,
+    ):
+        """
+        Parameters
+        ----------
+        merged_alignments: CoverageStore
+                           alignments by merging all lengths
+        index: ORFIndex
+               binary index the row ranges refer to, None if there is none
+        hashes: np.ndarray
+                signature hash of each row of the index, None to
+                score every ORF
+        report_all: bool
+                    if True, all coverages will be exported
+        """
+        self.merged_alignments = merged_alignments
+        self.index = index
+        self.hashes = None
+        # last row of each duplicated hash
+        self.last_rows = {}
+        if hashes is not None:
+            self.hashes = hashes.tolist()
+            keys, reverse_rows, counts = np.unique(
+                hashes[::-1], return_index=True, return_counts=True
+            )
+            duplicated = counts > 1
+            self.last_rows = dict(
+                zip(
+                    keys[duplicated].tolist(),
+                    (len(hashes) - 1 - reverse_rows[duplicated]).tolist(),
                 )
-                # skip outputing nontranslating ones
-                if not report_all and status == "nontranslating":
-                    pass
+            )
+        self.cutoffs = (
+            phase_score_cutoff,
+            min_valid_codons,
+            min_reads_per_codon,
+            min_valid_codons_ratio,
+            min_density_over_orf,
+        )
+        self.report_all = report_all
+        self.formatter = "{}\t" * (len(OUTPUT_COLUMNS) - 1) + "{}\n"
+        # scores and last row of the duplicated signatures seen
+        self.scores = {}
+
+    def _orfs(self, chunk):
+        """ORFs of a chunk"""
+        if isinstance(chunk, tuple):
+            return [self.index[row] for row in range(*chunk)]
+        if isinstance(chunk, ORFTable):
+            return list(chunk)
+        return [ORF.from_string(line) for line in chunk]
+
+    def score(self, chunk):
+        """Score a chunk
+
+        Parameters
+        ----------
+        chunk: tuple
+               (row of the first ORF, ORFs), the ORFs being given as
+               a row range, an ORFTable or a list of tsv lines
+
+        Returns
+        -------
+        text: str
+              output lines of the ORFs
+        """
+        first_row, orfs = chunk
+        orfs = self._orfs(orfs)
+        # signatures whose last ORF went to another process
+        for key in [key for key, (_, last) in self.scores.items() if last < first_row]:
+            del self.scores[key]
+
+        keys = []
+        chunk_scores = {}
+        to_gather = []
+        for row, orf in enumerate(orfs, first_row):
+            key = row
+            if self.last_rows and self.hashes[row] in self.last_rows:
+                key = (
+                    orf.chrom,
+                    orf.strand,
+                    tuple((iv.start, iv.end) for iv in orf.intervals),
+                )
+            keys.append(key)
+            if key in self.scores:
+                chunk_scores[key] = self.scores[key][0]
+            elif key not in chunk_scores:
+                chunk_scores[key] = None
+                to_gather.append((key, orf))
+        coverages = orf_coverages([orf for _, orf in to_gather], self.merged_alignments)
+        cohs, valids = phase_scores(coverages)
+        for (key, _), cov, coh, valid in zip(
+            to_gather, coverages, cohs, valids.tolist()
+        ):
+            chunk_scores[key] = (cov,) + score_coverage(
+                cov, *self.cutoffs, phase=(coh, valid)
+            )
+
+        lines = []
+        for row, orf, key in zip(range(first_row, first_row + len(orfs)), orfs, keys):
+            if isinstance(key, tuple):
+                last_row = self.last_rows[self.hashes[row]]
+                if row < last_row:
+                    self.scores[key] = (chunk_scores[key], last_row)
                 else:
-                    to_write = formatter.format(
+                    # last ORF with this hash, its scores are not needed
+                    self.scores.pop(key, None)
+            (
+                cov,
+                status,
+                coh,
+                count,
+                length,
+                valid_codons,
+                valid_codons_ratio,
+                orf_density,
+            ) = chunk_scores[key]
+            # skip outputing nontranslating ones
+            if not self.report_all and status == "nontranslating":
+                pass
+            else:
+                lines.append(
+                    self.formatter.format(
                         orf.oid,
                         orf.category,
                         status,
@@ -300,27 +465,155 @@ def export_orf_coverages(
                         orf.start_codon,
                         cov,
                     )
-                    output.write(to_write)
+                )
+        return "".join(lines)
+
+
+def _init_score_worker(scorer):
+    """Keep the scorer of the worker process"""
+    global _worker_scorer
+    _worker_scorer = scorer
+
+
+def _score_chunk(chunk):
+    """Score a chunk of ORFs in a worker process"""
+    return _worker_scorer.score(chunk)
+
+
+def index_chunks(ribotricer_index, annotated, size, pbar=None):
+    """Split the ORFs of an index into chunks for an ORFScorer
+
+    Parameters
+    ----------
+    ribotricer_index: ORFStream
+                      stream positioned after the annotated ORFs
+    annotated: ORFTable or List[ORF]
+               annotated ORFs already read from the stream, the
+               leading rows of the index
+    size: int
+          number of ORFs in each chunk
+    pbar: tqdm
+          progress bar to update
+
+    Returns
+    -------
+    chunks: generator of (row of the first ORF, ORFs)
+    """
+    for start in range(0, len(annotated), size):
+        end = min(start + size, len(annotated))
+        if ribotricer_index.index is not None:
+            # they are rows of the binary index
+            yield start, (start, end)
+        else:
+            table = ORFTable()
+            for row in range(start, end):
+                table.append(annotated[row])
+            yield start, table
+    row = len(annotated)
+    for chunk in ribotricer_index.chunks(size, pbar):
+        yield row, chunk
+        row += chunk[1] - chunk[0] if isinstance(chunk, tuple) else len(chunk)
+
+
+def export_orf_coverages(
+    ribotricer_index,
+    merged_alignments,
+    prefix,
+    phase_score_cutoff=CUTOFF,
+    min_valid_codons=MINIMUM_VALID_CODONS,
+    min_reads_per_codon=MINIMUM_READS_PER_CODON,
+    min_valid_codons_ratio=MINIMUM_VALID_CODONS_RATIO,
+    min_density_over_orf=MINIMUM_DENSITY_OVER_ORF,
+    report_all=False,
+    annotated=None,
+    threads=1,
+):
+    """
+    Parameters
+    ----------
+    ribotricer_index: str or ORFStream
+                   Path to the index file generated by ribotricer prepare_orfs,
+                   or a stream of it positioned after the annotated ORFs
+    annotated: List[ORF]
+               annotated ORFs already read from the stream, scored first;
+               they must be the leading rows of the index
+    merged_alignments: CoverageStore
+                       alignments by merging all lengths
+    prefix: str
+            prefix for output file
+    report_all: bool
+                if True, all coverages will be exported
+    threads: int
+             Number of processes scoring chunks of the index. The output
+             is written in the order of the index whatever their number.
+             A single one is used where processes cannot be forked
+    """
+    # print('exporting coverages for all ORFs...')
+    if threads > 1 and "fork" not in multiprocessing.get_all_start_methods():
+        print("processes cannot be forked, scoring the ORFs in a single process")
+        threads = 1
+    if not isinstance(ribotricer_index, ORFStream):
+        ribotricer_index = ORFStream(ribotricer_index)
+    if annotated is None:
+        annotated = []
+
+    # rows are numbered from the start of the index, where the annotated ORFs are
+    scorer = ORFScorer(
+        merged_alignments,
+        ribotricer_index.index,
+        ribotricer_index.signature_hashes(),
+        phase_score_cutoff,
+        min_valid_codons,
+        min_reads_per_codon,
+        min_valid_codons_ratio,
+        min_density_over_orf,
+        report_all,
+    )
+
+    with open("{}_translating_ORFs.tsv".format(prefix), "w") as output:
+        output.write("\t".join(OUTPUT_COLUMNS) + "\n")
+        with ribotricer_index.progress() as pbar:
+            chunks = index_chunks(ribotricer_index, annotated, SCORE_CHUNK_SIZE, pbar)
+            if threads == 1:
+                for chunk in chunks:
+                    output.write(scorer.score(chunk))
+                return
+            # workers get the scorer and the coverages when they are forked,
+            # other start methods would pickle them for every process
+            context = multiprocessing.get_context("fork")
+            with context.Pool(threads, _init_score_worker, (scorer,)) as pool:
+                # a few chunks per process are submitted ahead of
+                # the one written, keeping the output in order
+                pending = deque()
+                for chunk in chunks:
+                    pending.append(pool.apply_async(_score_chunk, (chunk,)))
+                    if len(pending) >= threads * CHUNKS_PER_THREAD:
+                        output.write(pending.popleft().get())
+                while pending:
+                    output.write(pending.popleft().get())
 
 
 def export_wig(merged_alignments, prefix):
     """
     Parameters
     ----------
-    merged_alignments: dict(dict)
+    merged_alignments: CoverageStore
                        alignments by merging all lengths
     prefix: str
             prefix of output wig files
     """
     # print('exporting merged alignments to wig file...')
-    for strand in merged_alignments:
-        to_write = ""
-        cur_chrom = ""
-        for chrom, pos in sorted(merged_alignments[strand]):
-            if chrom != cur_chrom:
-                cur_chrom = chrom
-                to_write += "variableStep chrom={}\n".format(chrom)
-            to_write += "{}\t{}\n".format(pos, merged_alignments[strand][(chrom, pos)])
+    tracks = merged_alignments.keys()
+    for strand in merged_alignments.strands():
+        to_write = []
+        for chrom in sorted({chrom for chrom, s, _ in tracks if s == strand}):
+            positions, counts = merged_alignments.track(chrom, strand)
+            to_write.append("variableStep chrom={}\n".format(chrom))
+            to_write.extend(
+                "{}\t{}\n".format(pos, count)
+                for pos, count in zip(positions.tolist(), counts.tolist())
+            )
+        to_write = "".join(to_write)
         if strand == "+":
             fname = "{}_pos.wig".format(prefix)
         else:
@@ -342,12 +635,20 @@ def detect_orfs(
     min_valid_codons_ratio,
     min_density_over_orf,
     report_all,
+    threads=1,
+    read_filter=None,
+    coverage_cache=None,
+    rebuild_cache=False,
+    use_footprint=False,
+    reference_fasta=None,
+    shard=None,
 ):
     """
     Parameters
     ----------
     bam: str
-         Path to the bam file
+         Path to the bam file, '-' to read a SAM/BAM/CRAM stream
+         from the standard input
     ribotricer_index: str
                    Path to the index file generated by ribotricer prepare_orfs
     prefix: str
@@ -369,18 +670,52 @@ def detect_orfs(
     report_all: bool
                 Whether to output all ORFs' scores regardless of translation
                 status
+    threads: int
+             Number of processes to use for reading the bam file
+             and for scoring the ORFs
+    read_filter: ReadFilter
+                 rules for selecting usable reads, default rules if None
+    coverage_cache: str
+                    directory for caching the split bam file, no caching if None
+    rebuild_cache: bool
+                   Whether to read the bam file again and replace the cache
+    use_footprint: bool
+                   Whether to only count reads near the ORFs of the index
+    reference_fasta: str
+                     Path to the reference used for decoding CRAM files
+    shard: tuple
+           (shard, n_shards) to only score a shard written by shard_index,
+           reading the reads near its ORFs. None for the whole index
     """
     now = datetime.datetime.now()
     print(now.strftime("%b %d %H:%M:%S ..... started ribotricer detect-orfs"))
+    if read_filter is None:
+        read_filter = ReadFilter()
 
     # parse the index file
     now = datetime.datetime.now()
     print(now.strftime("%b %d %H:%M:%S ... started parsing ribotricer index file"))
-    annotated, refseq = parse_ribotricer_index(ribotricer_index)
+    full_index = ribotricer_index
+    if shard is not None:
+        ribotricer_index = shard_index_path(ribotricer_index, *shard)
+        use_footprint = True
+    orf_stream = ORFStream(ribotricer_index)
+    annotated = []
+    refseq = None
+    if shard is None:
+        annotated, refseq = parse_ribotricer_index(orf_stream)
+    elif protocol is None:
+        # all shards infer the protocol from the same annotated ORFs,
+        # those of the shard are scored with the rest of it
+        refseq = parse_ribotricer_index(full_index)[1]
 
     # create directory
     mkdir_p(parent_dir(prefix))
 
+    # a stream is read once, its first reads are kept for inferring the protocol
+    if bam == STDIN:
+        bam = AlignmentStream(STDIN, reference_fasta)
+
     # infer experimental protocol if not provided
     if protocol is None:
         now = datetime.datetime.now()
@@ -389,13 +724,38 @@ def detect_orfs(
                 now.strftime("%b %d %H:%M:%S"), "started inferring experimental design"
             )
         )
-        protocol = infer_protocol(bam, refseq, prefix)
+        protocol = infer_protocol(
+            bam,
+            refseq,
+            prefix,
+            read_filter=read_filter,
+            reference_fasta=reference_fasta,
+        )
     del refseq
 
+    footprint = None
+    if use_footprint:
+        now = datetime.datetime.now()
+        print(now.strftime("%b %d %H:%M:%S ... started computing index footprint"))
+        footprint = index_footprint(
+            ribotricer_index, footprint_padding(read_lengths, psite_offsets)
+        )
+
     # split bam file into strand and read length
     now = datetime.datetime.now()
     print(now.strftime("%b %d %H:%M:%S ... started reading bam file"))
-    alignments, read_length_counts = split_bam(bam, protocol, prefix, read_lengths)
+    alignments, read_length_counts = split_bam(
+        bam,
+        protocol,
+        prefix,
+        read_lengths,
+        threads,
+        read_filter,
+        coverage_cache,
+        rebuild_cache,
+        footprint,
+        reference_fasta,
+    )
 
     # plot read length distribution
     now = datetime.datetime.now()
@@ -470,7 +830,7 @@ def detect_orfs(
         )
     )
     export_orf_coverages(
-        ribotricer_index,
+        orf_stream,
         merged_alignments,
         prefix,
         phase_score_cutoff,
@@ -479,6 +839,8 @@ def detect_orfs(
         min_valid_codons_ratio,
         min_density_over_orf,
         report_all,
+        annotated,
+        threads,
     )
     now = datetime.datetime.now()
     print(
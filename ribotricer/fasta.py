@@ -18,20 +18,51 @@ import os
 import warnings
 
 from pyfaidx import Fasta
+from pyfaidx import FetchError
 
+from .genome import COMPLEMENT
+from .genome import PackedGenome
+
+# Number of whole chromosome sequences kept in memory by a FastaReader.
+# A chromosome takes as many bytes as it has bases (about 250 MB for
+# human chr1), in every process reading the fasta file
+CHROMOSOME_CACHE_SIZE = 2
 
-class FastaReader:
-    """Class for reading and querying fasta file."""
 
-    def __init__(self, fasta_location):
+class FastaReader:
+    """Class for reading and querying fasta file.
+
+    The sequences of the most recently queried chromosomes are kept
+    in memory, so that querying exons is a matter of slicing. Each of
+    them takes one byte per base. A chromosome is loaded whole only the
+    first time it is queried: once evicted, its intervals are read from
+    the file one by one, so that queries which are not grouped by
+    chromosome read each chromosome at most once. If the
+    fasta file has an up-to-date packed genome (see pack_genome), it is
+    memory-mapped and used instead of the fasta file.
+    """
+
+    def __init__(self, fasta_location, cache_size=CHROMOSOME_CACHE_SIZE):
         """
         Parameters
         ---------
         fasta_location : string
                          Path to fasta file
+        cache_size : int
+                     Number of chromosome sequences to keep in memory,
+                     0 to read every interval from the file
 
         """
         self.fasta_location = fasta_location
+        self.packed = PackedGenome.open(fasta_location)
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        # chromosomes loaded whole so far, including evicted ones
+        self._loaded = set()
+        if self.packed is not None:
+            self.fasta = None
+            self.chrom_lengths = OrderedDict(self.packed.chrom_lengths)
+            return
         try:
             self.fasta = Fasta(fasta_location, as_raw=True, sequence_always_upper=True)
         except Exception as e:
@@ -40,6 +71,37 @@ class FastaReader:
                     os.path.abspath(self.fasta_location), e
                 )
             )
+        self.chrom_lengths = OrderedDict(
+            (chrom, len(self.fasta[chrom])) for chrom in self.fasta.keys()
+        )
+
+    def sequence(self, chrom):
+        """Whole sequence of a chromosome, from the cache if possible
+
+        Parameters
+        ----------
+        chrom: str
+               chromosome name
+
+        Returns
+        -------
+        sequence: str
+                  upper case sequence of the chromosome
+        """
+        sequence = self._cache.get(chrom)
+        if sequence is not None:
+            self._cache.move_to_end(chrom)
+            return sequence
+        if self.packed is not None:
+            sequence = self.packed.fetch(chrom, 1, self.chrom_lengths[chrom])
+        else:
+            sequence = self.fasta.get_seq(chrom, 1, self.chrom_lengths[chrom])
+        self._loaded.add(chrom)
+        self._cache[chrom] = sequence
+        while len(self._cache) > self.cache_size:
+            # evict the least recently used chromosome
+            self._cache.popitem(last=False)
+        return sequence
 
     def query(self, intervals):
         """ Query regions for sequence.
@@ -58,9 +120,10 @@ class FastaReader:
 
         """
         sequences = []
-        chrom_lengths = self.chromosomes
+        chrom_lengths = self.chrom_lengths
+        chrom = None
         for i in intervals:
-            if i.chrom not in list(chrom_lengths.keys()):
+            if i.chrom not in chrom_lengths:
                 warnings.warn(
                     "Chromosome {} does not appear in the fasta".format(i.chrom),
                     UserWarning,
@@ -79,7 +142,23 @@ class FastaReader:
                             i.end, chrom_length
                         )
                     )
-                seq = self.fasta.get_seq(i.chrom, i.start, i.end)
+                if i.start < 1:
+                    raise FetchError(
+                        "Requested start coordinate must be greater than 1."
+                    )
+                if self.packed is not None:
+                    seq = self.packed.fetch(i.chrom, i.start, i.end)
+                elif i.chrom == chrom:
+                    seq = chrom_seq[i.start - 1 : i.end]
+                elif self.cache_size <= 0 or (
+                    i.chrom in self._loaded and i.chrom not in self._cache
+                ):
+                    # back to an evicted chromosome, read the interval only
+                    seq = self.fasta.get_seq(i.chrom, i.start, i.end)
+                else:
+                    chrom = i.chrom
+                    chrom_seq = self.sequence(chrom)
+                    seq = chrom_seq[i.start - 1 : i.end]
                 sequences.append(seq)
         return sequences
 
@@ -97,15 +176,7 @@ class FastaReader:
         complement_seq: str
                         complemenet of input fasta
         """
-        complement_letters = {"A": "T", "C": "G", "T": "A", "G": "C"}
-        seq = seq.upper()
-        comp = []
-        for nuc in seq:
-            if nuc in complement_letters:
-                comp.append(complement_letters[nuc])
-            else:
-                comp.append(nuc)
-        return "".join(comp)
+        return seq.upper().translate(COMPLEMENT)
 
     def reverse_complement(self, seq):
         """Reverse-complment a FASTA sequence.
@@ -121,7 +192,6 @@ class FastaReader:
         complement_seq: str
                         complemenet of input fasta
         """
-        seq = seq.upper()
         return self.complement(seq)[::-1]
 
     @property
@@ -139,7 +209,4 @@ class FastaReader:
         .. autosummary::
             .FastaReader
         """
-        chroms = OrderedDict()
-        for chrom in list(self.fasta.keys()):
-            chroms[chrom] = len(self.fasta[chrom])
-        return chroms
+        return OrderedDict(self.chrom_lengths)
@@ -0,0 +1,206 @@
+"""Genomic footprint of a ribotricer index"""
+# Part of ribotricer software
+#
+# Copyright (C) 2019 Saket Choudhary, Wenzheng Li, and Andrew D Smith
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+from collections import defaultdict
+import hashlib
+
+import numpy as np
+from tqdm import tqdm
+
+from .common import open_file
+from .const import TYPICAL_OFFSET
+from .orf_index import ORFIndex
+
+# Padding used when neither read lengths nor P-site offsets are known.
+# It covers P-site offsets of reads up to 88 nt
+FOOTPRINT_PADDING = 100
+# Nucleotides included upstream of the start codon in metagene profiles
+METAGENE_LEADER = 20
+# Footprint intervals closer than this are fetched from the bam together
+FETCH_GAP = 1000
+
+
+def footprint_padding(read_lengths=None, psite_offsets=None):
+    """Padding needed around the index intervals
+
+    Reads are stored by their 5' end and moved by their P-site offset
+    later on, so the 5' end of a read counted in an ORF is at most
+    one P-site offset away from the ORF. Automatically determined
+    offsets are within TYPICAL_OFFSET plus the read length.
+
+    Parameters
+    ----------
+    read_lengths: list[int]
+                  read lengths to use, None if unknown
+    psite_offsets: dict
+                   key is the length, value is the offset, None if unknown
+
+    Returns
+    -------
+    padding: int
+    """
+    if psite_offsets:
+        padding = max(abs(offset) for offset in psite_offsets.values())
+    elif read_lengths:
+        padding = max(read_lengths) + TYPICAL_OFFSET
+    else:
+        padding = FOOTPRINT_PADDING
+    return max(padding, METAGENE_LEADER)
+
+
+class Footprint:
+    """Merged genomic intervals, regardless of strand.
+
+    Intervals are one-based and inclusive, stored as sorted start
+    and end arrays per chromosome.
+    """
+
+    def __init__(self, intervals):
+        """
+        Parameters
+        ----------
+        intervals: dict
+                   key is the chromosome, value is a tuple of
+                   (starts, ends) arrays in any order, possibly overlapping
+        """
+        self.intervals = {}
+        for chrom, (starts, ends) in intervals.items():
+            starts = np.asarray(starts, dtype=np.int64)
+            ends = np.asarray(ends, dtype=np.int64)
+            order = np.argsort(starts, kind="mergesort")
+            starts = starts[order]
+            ends = np.maximum.accumulate(ends[order])
+            # a new interval begins where the start is past all previous ends
+            first = np.ones(len(starts), dtype=bool)
+            first[1:] = starts[1:] > ends[:-1] + 1
+            last = np.ones(len(starts), dtype=bool)
+            last[:-1] = first[1:]
+            self.intervals[chrom] = (starts[first], ends[last])
+
+    def digest(self):
+        """Checksum of the intervals"""
+        checksum = hashlib.md5()
+        for chrom in sorted(self.intervals):
+            starts, ends = self.intervals[chrom]
+            checksum.update(chrom.encode())
+            checksum.update(starts.tobytes())
+            checksum.update(ends.tobytes())
+        return checksum.hexdigest()
+
+    def size(self):
+        """Number of nucleotides covered"""
+        return sum(
+            int((ends - starts + 1).sum()) for starts, ends in self.intervals.values()
+        )
+
+    def contains(self, chrom, positions):
+        """Check which positions are inside the footprint
+
+        Parameters
+        ----------
+        chrom: str
+               chromosome name
+        positions: np.ndarray
+                   one-based positions
+
+        Returns
+        -------
+        inside: np.ndarray
+                True for positions inside the footprint
+        """
+        if chrom not in self.intervals:
+            return np.zeros(len(positions), dtype=bool)
+        starts, ends = self.intervals[chrom]
+        idx = np.searchsorted(starts, positions, side="right") - 1
+        return (idx >= 0) & (positions <= ends[np.maximum(idx, 0)])
+
+    def fetch_regions(self, references, max_gap=FETCH_GAP):
+        """Regions to fetch from a bam file
+
+        Parameters
+        ----------
+        references: list of str
+                    chromosome names of the bam file, in their order
+        max_gap: int
+                 intervals closer than this are fetched together
+
+        Returns
+        -------
+        regions: list of (contig, start, end)
+                 zero-based, half-open regions in the order of references
+        """
+        regions = []
+        for chrom in references:
+            if chrom not in self.intervals:
+                continue
+            starts, ends = self.intervals[chrom]
+            first = np.ones(len(starts), dtype=bool)
+            first[1:] = starts[1:] - ends[:-1] > max_gap
+            last = np.ones(len(starts), dtype=bool)
+            last[:-1] = first[1:]
+            for start, end in zip(starts[first].tolist(), ends[last].tolist()):
+                regions.append((chrom, max(start - 1, 0), end))
+        return regions
+
+
+def index_footprint(ribotricer_index, padding):
+    """Footprint of all ORFs of a ribotricer index
+
+    Parameters
+    ----------
+    ribotricer_index: str
+                   Path to the index file generated by ribotricer prepare_orfs
+    padding: int
+             number of nucleotides added on both sides of each exon
+
+    Returns
+    -------
+    footprint: Footprint
+    """
+    index = ORFIndex.open(ribotricer_index)
+    if index is not None:
+        # chromosome code of each exon
+        chrom_codes, chroms = index.column("chrom")
+        exon_chroms = np.repeat(chrom_codes, np.diff(index.array("exon_offsets")))
+        exon_starts = index.array("exon_starts")
+        exon_ends = index.array("exon_ends")
+        intervals = {}
+        for code, chrom in enumerate(chroms.tolist()):
+            on_chrom = exon_chroms == code
+            intervals[chrom] = (
+                exon_starts[on_chrom] - padding,
+                exon_ends[on_chrom] + padding,
+            )
+        return Footprint(intervals)
+
+    starts = defaultdict(list)
+    ends = defaultdict(list)
+    with open_file(ribotricer_index, "r") as anno:
+        # read header
+        anno.readline()
+        for line in tqdm(anno, unit="lines", leave=False):
+            fields = line.rstrip("\n").split("\t")
+            chrom = fields[7]
+            for group in fields[10].split(","):
+                start, end = group.split("-")
+                starts[chrom].append(int(start))
+                ends[chrom].append(int(end))
+    intervals = {}
+    for chrom in starts:
+        intervals[chrom] = (
+            np.array(starts[chrom], dtype=np.int64) - padding,
+            np.array(ends[chrom], dtype=np.int64) + padding,
+        )
+    return Footprint(intervals)
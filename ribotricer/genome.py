@@ -0,0 +1,257 @@
+"""2-bit packed genome"""
+# Part of ribotricer software
+#
+# Copyright (C) 2019 Saket Choudhary, Wenzheng Li, and Andrew D Smith
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+import json
+import os
+
+import numpy as np
+from pyfaidx import Fasta
+from tqdm import tqdm
+
+from .common import file_fingerprint
+from .common import replace_directory
+from .common import same_content
+
+# Bumped whenever the layout of the packed genome changes
+PACKED_GENOME_VERSION = 2
+# Bases stored with 2 bits, in the order of their codes
+PACKED_BASES = b"ACGT"
+
+# 2-bit code of each byte, bytes other than A, C, G, T are masked
+_ENCODE = np.zeros(256, dtype=np.uint8)
+_ENCODE[np.frombuffer(PACKED_BASES, dtype=np.uint8)] = np.arange(4)
+_MASKED = np.ones(256, dtype=bool)
+_MASKED[np.frombuffer(PACKED_BASES, dtype=np.uint8)] = False
+# the 4 bases packed in each byte value, most significant bits first
+_DECODE = np.frombuffer(PACKED_BASES, dtype=np.uint8)[
+    (np.arange(256)[:, None] >> np.array([6, 4, 2, 0])) & 3
+]
+# Complement of the bases, other characters are unchanged
+COMPLEMENT = str.maketrans("ACGT", "TGCA")
+
+
+def packed_genome_path(fasta_location):
+    """Directory of the packed genome belonging to a fasta file"""
+    return "{}.packed".format(fasta_location)
+
+
+def pack_sequence(sequence):
+    """Pack an upper case sequence
+
+    Parameters
+    ----------
+    sequence: str
+              sequence to pack
+
+    Returns
+    -------
+    packed: np.ndarray
+            4 bases per byte, the last byte is padded with A
+    mask: tuple of np.ndarray
+          (starts, ends, bases) of the runs of identical bytes other than
+          A, C, G, T, zero-based and half open
+    """
+    raw = np.frombuffer(sequence.encode("ascii"), dtype=np.uint8)
+    codes = _ENCODE[raw]
+    padding = -len(codes) % 4
+    codes = np.concatenate((codes, np.zeros(padding, dtype=np.uint8))).reshape(-1, 4)
+    packed = (codes[:, 0] << 6) | (codes[:, 1] << 4) | (codes[:, 2] << 2) | codes[:, 3]
+
+    masked = np.where(_MASKED[raw], raw, 0)
+    boundaries = np.flatnonzero(np.diff(masked)) + 1
+    run_starts = np.concatenate(([0], boundaries)).astype(np.int64)
+    run_ends = np.concatenate((boundaries, [len(raw)])).astype(np.int64)
+    if len(raw) == 0:
+        run_starts = run_ends = np.zeros(0, dtype=np.int64)
+    run_bases = masked[run_starts]
+    kept = run_bases != 0
+    return packed, (run_starts[kept], run_ends[kept], run_bases[kept])
+
+
+def pack_genome(fasta_location):
+    """Write the packed genome next to a fasta file
+
+    Parameters
+    ----------
+    fasta_location: str
+                    Path to fasta file
+
+    Returns
+    -------
+    path: str
+          directory of the packed genome
+    """
+    fasta = Fasta(fasta_location, as_raw=True, sequence_always_upper=True)
+    names = list(fasta.keys())
+    lengths = np.array([len(fasta[name]) for name in names], dtype=np.int64)
+    byte_offsets = np.zeros(len(names) + 1, dtype=np.int64)
+    np.cumsum((lengths + 3) // 4, out=byte_offsets[1:])
+
+    path = packed_genome_path(fasta_location)
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    os.makedirs(tmp_path)
+    packed = np.lib.format.open_memmap(
+        os.path.join(tmp_path, "packed.npy"),
+        mode="w+",
+        dtype=np.uint8,
+        shape=(int(byte_offsets[-1]),),
+    )
+    mask_starts = []
+    mask_ends = []
+    mask_bases = []
+    mask_offsets = [0]
+    for i, name in enumerate(tqdm(names, unit="chromosomes")):
+        sequence = fasta.get_seq(name, 1, int(lengths[i])) if lengths[i] else ""
+        chrom_packed, (starts, ends, bases) = pack_sequence(sequence)
+        packed[byte_offsets[i] : byte_offsets[i + 1]] = chrom_packed
+        mask_starts.append(starts)
+        mask_ends.append(ends)
+        mask_bases.append(bases)
+        mask_offsets.append(mask_offsets[-1] + len(starts))
+    packed.flush()
+    del packed
+
+    arrays = {
+        "lengths": lengths,
+        "byte_offsets": byte_offsets,
+        "mask_offsets": np.array(mask_offsets, dtype=np.int64),
+        "mask_starts": np.concatenate(mask_starts or [np.zeros(0, np.int64)]),
+        "mask_ends": np.concatenate(mask_ends or [np.zeros(0, np.int64)]),
+        "mask_bases": np.concatenate(mask_bases or [np.zeros(0, np.uint8)]),
+    }
+    for name, values in arrays.items():
+        np.save(os.path.join(tmp_path, "{}.npy".format(name)), values)
+    meta = {
+        "version": PACKED_GENOME_VERSION,
+        "chromosomes": names,
+        "fasta": file_fingerprint(fasta_location),
+    }
+    with open(os.path.join(tmp_path, "meta.json"), "w") as output:
+        json.dump(meta, output)
+    replace_directory(tmp_path, path)
+    return path
+
+
+class PackedGenome:
+    """Memory-mapped 2-bit packed genome.
+
+    Each chromosome is stored with 4 bases per byte, starting at a byte
+    boundary. Bytes other than A, C, G, T (N, IUPAC codes) are stored
+    as runs in a mask and restored when decoding, so sequences are
+    identical to the upper case fasta sequences.
+    """
+
+    def __init__(self, path):
+        """
+        Parameters
+        ----------
+        path: str
+              directory of the packed genome
+        """
+        with open(os.path.join(path, "meta.json")) as meta:
+            self.meta = json.load(meta)
+        self.path = path
+
+        def load(name):
+            return np.load(os.path.join(path, "{}.npy".format(name)), mmap_mode="r")
+
+        self.packed = load("packed")
+        self.byte_offsets = np.array(load("byte_offsets"))
+        self.mask_offsets = np.array(load("mask_offsets"))
+        self.mask_starts = load("mask_starts")
+        self.mask_ends = load("mask_ends")
+        self.mask_bases = load("mask_bases")
+        lengths = np.array(load("lengths")).tolist()
+        self.chrom_ids = {}
+        self.chrom_lengths = {}
+        for chrom_id, (chrom, length) in enumerate(
+            zip(self.meta["chromosomes"], lengths)
+        ):
+            self.chrom_ids[chrom] = chrom_id
+            self.chrom_lengths[chrom] = length
+
+    @classmethod
+    def open(cls, fasta_location):
+        """Packed genome of a fasta file
+
+        Parameters
+        ----------
+        fasta_location: str
+                        Path to fasta file
+
+        Returns
+        -------
+        genome: PackedGenome
+                None if there is no packed genome, or if it
+                does not match the fasta file
+        """
+        path = packed_genome_path(fasta_location)
+        if not os.path.isfile(os.path.join(path, "meta.json")):
+            return None
+        with open(os.path.join(path, "meta.json")) as meta:
+            meta = json.load(meta)
+        if meta["version"] != PACKED_GENOME_VERSION or not same_content(
+            fasta_location, meta["fasta"]
+        ):
+            print("packed genome {} is outdated, reading the fasta file".format(path))
+            return None
+        return cls(path)
+
+    def fetch(self, chrom, start, end, reverse=False):
+        """Sequence of a region
+
+        Parameters
+        ----------
+        chrom: str
+               chromosome name
+        start: int
+               one-based start, included
+        end: int
+             one-based end, included
+        reverse: bool
+                 whether to return the reverse complement
+
+        Returns
+        -------
+        sequence: str
+                  upper case sequence
+        """
+        chrom_id = self.chrom_ids[chrom]
+        start = max(start - 1, 0)
+        end = min(end, self.chrom_lengths[chrom])
+        if end <= start:
+            return ""
+        first_byte = self.byte_offsets[chrom_id] + start // 4
+        last_byte = self.byte_offsets[chrom_id] + (end + 3) // 4
+        skip = start % 4
+        raw = _DECODE[self.packed[first_byte:last_byte]].ravel()[
+            skip : skip + end - start
+        ]
+        mask_begin = self.mask_offsets[chrom_id]
+        mask_end = self.mask_offsets[chrom_id + 1]
+        if mask_end > mask_begin:
+            # runs overlapping the region
+            ends = self.mask_ends[mask_begin:mask_end]
+            first = mask_begin + np.searchsorted(ends, start, side="right")
+            starts = self.mask_starts[mask_begin:mask_end]
+            last = mask_begin + np.searchsorted(starts, end, side="left")
+            for run in range(first, last):
+                run_start = max(int(self.mask_starts[run]), start) - start
+                run_end = min(int(self.mask_ends[run]), end) - start
+                raw[run_start:run_end] = self.mask_bases[run]
+        sequence = raw.tobytes().decode("ascii")
+        if reverse:
+            return sequence.translate(COMPLEMENT)[::-1]
+        return sequence
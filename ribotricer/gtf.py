@@ -14,8 +14,34 @@
 # GNU General Public License for more details.
 
 from collections import defaultdict
+import gzip
+import json
+import os
+
+import numpy as np
 from tqdm import tqdm
 
+from .common import file_fingerprint
+from .common import replace_directory
+from .common import same_content
+
+# Bumped whenever the layout of the parsed GTF cache changes
+GTF_CACHE_VERSION = 2
+# Attributes of exon and CDS lines used by ribotricer
+GTF_ATTRIBUTES = [
+    "gene_id",
+    "transcript_id",
+    "gene_name",
+    "transcript_type",
+    "gene_type",
+]
+# String columns of a parsed GTF
+GTF_STRING_COLUMNS = ["chrom", "strand"] + GTF_ATTRIBUTES
+# Features kept from a GTF, in the order of their codes
+GTF_FEATURES = ["exon", "cds"]
+# Number of lines read between progress bar updates
+GTF_PROGRESS_LINES = 1 << 16
+
 
 class GTFTrack(object):
     """Class for feature in GTF file."""
@@ -90,39 +116,271 @@ class GTFTrack(object):
         return str(self.__dict__)
 
 
+class GTFRecord(object):
+    """Exon or CDS line of a GTF file, with the attributes used by ribotricer."""
+
+    __slots__ = ["chrom", "feature", "start", "end", "strand"] + GTF_ATTRIBUTES
+
+    def __init__(
+        self,
+        chrom,
+        feature,
+        start,
+        end,
+        strand,
+        gene_id,
+        transcript_id,
+        gene_name,
+        transcript_type,
+        gene_type,
+    ):
+        self.chrom = chrom
+        self.feature = feature
+        self.start = start
+        self.end = end
+        self.strand = strand
+        self.gene_id = gene_id
+        self.transcript_id = transcript_id
+        self.gene_name = gene_name
+        self.transcript_type = transcript_type
+        self.gene_type = gene_type
+
+    def __repr__(self):
+        return str({name: getattr(self, name) for name in self.__slots__})
+
+
+def parse_attributes(attribute):
+    """Extract the attributes used by ribotricer
+
+    Defaults are filled in as GTFTrack does.
+
+    Parameters
+    ----------
+    attribute: str
+               attribute column of a GTF line
+
+    Returns
+    -------
+    attributes: dict
+                key is the attribute name (among GTF_ATTRIBUTES)
+    """
+    attributes = {}
+    for att in attribute.split(";"):
+        key_value = att.split()
+        if len(key_value) == 2:
+            k, v = key_value
+            k = GTFTrack.standards.get(k, k)
+            if k in GTF_ATTRIBUTES:
+                attributes[k] = v.strip('"')
+    if "gene_name" not in attributes and "gene_id" in attributes:
+        attributes["gene_name"] = attributes["gene_id"]
+    if "transcript_type" not in attributes:
+        attributes["transcript_type"] = "assumed_protein_coding"
+    if "gene_type" not in attributes:
+        attributes["gene_type"] = attributes["transcript_type"]
+    return attributes
+
+
+def open_gtf(gtf_location):
+    """Open a GTF file, compressed with gzip or not
+
+    Returns
+    -------
+    raw: file
+         the file itself, whose position tells the progress
+    lines: file
+           binary stream of the uncompressed lines
+    """
+    raw = open(gtf_location, "rb")
+    if raw.read(2) == b"\x1f\x8b":
+        raw.seek(0)
+        return raw, gzip.GzipFile(fileobj=raw)
+    raw.seek(0)
+    return raw, raw
+
+
+def parse_gtf(gtf_location):
+    """Read the exon and CDS lines of a GTF file into columns
+
+    Lines of other features are dropped before their attributes are
+    parsed, and only the attributes in GTF_ATTRIBUTES are kept.
+
+    Parameters
+    ----------
+    gtf_location: str
+                  Path to GTF file, possibly compressed with gzip
+
+    Returns
+    -------
+    columns: dict
+             feature (code in GTF_FEATURES), start and end arrays,
+             and the codes ({column}_codes) and dictionary
+             ({column}_values) of each column of GTF_STRING_COLUMNS
+    """
+    codes = {column: [] for column in GTF_STRING_COLUMNS}
+    lookup = {column: {} for column in GTF_STRING_COLUMNS}
+    features = []
+    starts = []
+    ends = []
+    feature_codes = {feature: code for code, feature in enumerate(GTF_FEATURES)}
+    raw, lines = open_gtf(gtf_location)
+    with raw, lines, tqdm(
+        total=os.path.getsize(gtf_location), unit="B", unit_scale=True, leave=False
+    ) as pbar:
+        for n_lines, line in enumerate(lines, 1):
+            if n_lines % GTF_PROGRESS_LINES == 0:
+                pbar.update(raw.tell() - pbar.n)
+            if line.startswith(b"#"):
+                continue
+            fields = line.strip().split(b"\t")
+            if len(fields) != 9:
+                print("mal-formatted GTF file")
+                continue
+            feature = feature_codes.get(fields[2].lower().decode())
+            if feature is None:
+                continue
+            chrom = fields[0].decode()
+            start = int(fields[3])
+            end = int(fields[4])
+            attributes = parse_attributes(fields[8].decode())
+            if "gene_id" not in attributes or "transcript_id" not in attributes:
+                print(
+                    "missing gene or transcript id {}:{}-{}".format(chrom, start, end)
+                )
+                continue
+            attributes["chrom"] = chrom
+            attributes["strand"] = fields[6].decode()
+            for column in GTF_STRING_COLUMNS:
+                value = attributes[column]
+                code = lookup[column].get(value)
+                if code is None:
+                    code = lookup[column][value] = len(lookup[column])
+                codes[column].append(code)
+            features.append(feature)
+            starts.append(start)
+            ends.append(end)
+        pbar.update(raw.tell() - pbar.n)
+    columns = {
+        "feature": np.array(features, dtype=np.int8),
+        "start": np.array(starts, dtype=np.int64),
+        "end": np.array(ends, dtype=np.int64),
+    }
+    for column in GTF_STRING_COLUMNS:
+        columns["{}_codes".format(column)] = np.array(codes[column], dtype=np.int32)
+        columns["{}_values".format(column)] = np.array(list(lookup[column]), dtype=str)
+    return columns
+
+
+def gtf_cache_path(gtf_location):
+    """Directory of the parsed GTF cache belonging to a GTF file"""
+    return "{}.parsed".format(gtf_location)
+
+
+def save_gtf_cache(columns, gtf_location):
+    """Save the parsed columns of a GTF file next to it
+
+    Parameters
+    ----------
+    columns: dict
+             output of parse_gtf
+    gtf_location: str
+                  Path to GTF file
+    """
+    path = gtf_cache_path(gtf_location)
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    os.makedirs(tmp_path)
+    for name, values in columns.items():
+        np.save(os.path.join(tmp_path, "{}.npy".format(name)), values)
+    meta = {"version": GTF_CACHE_VERSION, "gtf": file_fingerprint(gtf_location)}
+    with open(os.path.join(tmp_path, "meta.json"), "w") as output:
+        json.dump(meta, output)
+    replace_directory(tmp_path, path)
+
+
+def load_gtf_cache(gtf_location):
+    """Load the parsed columns of a GTF file
+
+    Returns
+    -------
+    columns: dict
+             same as parse_gtf, None if there is no cache or
+             if it does not match the GTF file
+    """
+    path = gtf_cache_path(gtf_location)
+    if not os.path.isfile(os.path.join(path, "meta.json")):
+        return None
+    with open(os.path.join(path, "meta.json")) as meta:
+        meta = json.load(meta)
+    if meta["version"] != GTF_CACHE_VERSION or not same_content(
+        gtf_location, meta["gtf"]
+    ):
+        print("parsed GTF {} is outdated, reading the GTF file".format(path))
+        return None
+    names = ["feature", "start", "end"]
+    for column in GTF_STRING_COLUMNS:
+        names += ["{}_codes".format(column), "{}_values".format(column)]
+    return {name: np.load(os.path.join(path, "{}.npy".format(name))) for name in names}
+
+
 class GTFReader(object):
-    """Class for reading and parseing gtf file."""
+    """Class for reading and parseing gtf file.
 
-    def __init__(self, gtf_location):
+    The exon and CDS lines are kept as GTFRecord objects, grouped
+    by transcript (exons) and by gene and transcript (CDS), in the
+    order of the file. The parsed lines are cached next to the GTF file.
+    """
+
+    def __init__(self, gtf_location, cache=True):
         """
         Parameters
         ---------
         gtf_location : string
-                       Path to gtf file
+                       Path to gtf file, possibly compressed with gzip
+        cache : bool
+                whether to use and write the parsed GTF cache
         """
         self.gtf_location = gtf_location
         self.transcript = defaultdict(list)
         self.cds = defaultdict(lambda: defaultdict(list))
-        # print('reading GTF file...')
-        with open(self.gtf_location, "r") as gtf:
-            total_lines = len(["" for line in gtf])
-        with open(self.gtf_location, "r") as gtf:
-            with tqdm(total=total_lines, unit="lines", leave=False) as pbar:
-                for line in gtf:
-                    pbar.update()
-                    track = GTFTrack.from_string(line)
-                    if track is not None:
-                        try:
-                            gid = track.gene_id
-                            tid = track.transcript_id
-                        except AttributeError:
-                            print(
-                                "missing gene or transcript id {}:{}-{}".format(
-                                    track.chrom, track.start, track.end
-                                )
-                            )
-                        else:
-                            if track.feature == "exon":
-                                self.transcript[tid].append(track)
-                            elif track.feature == "cds":
-                                self.cds[gid][tid].append(track)
+        columns = load_gtf_cache(gtf_location) if cache else None
+        if columns is None:
+            columns = parse_gtf(gtf_location)
+            if cache:
+                try:
+                    save_gtf_cache(columns, gtf_location)
+                except OSError as e:
+                    print("could not save parsed GTF: {}".format(e))
+
+        values = {
+            column: columns["{}_values".format(column)].tolist()
+            for column in GTF_STRING_COLUMNS
+        }
+        rows = zip(
+            columns["feature"].tolist(),
+            columns["start"].tolist(),
+            columns["end"].tolist(),
+            *[
+                columns["{}_codes".format(column)].tolist()
+                for column in GTF_STRING_COLUMNS
+            ]
+        )
+        chroms, strands, gene_ids, tids, gnames, ttypes, gtypes = [
+            values[column] for column in GTF_STRING_COLUMNS
+        ]
+        for feature, start, end, chrom, strand, gid, tid, gname, ttype, gtype in rows:
+            track = GTFRecord(
+                chroms[chrom],
+                GTF_FEATURES[feature],
+                start,
+                end,
+                strands[strand],
+                gene_ids[gid],
+                tids[tid],
+                gnames[gname],
+                ttypes[ttype],
+                gtypes[gtype],
+            )
+            if feature == 0:
+                self.transcript[track.transcript_id].append(track)
+            else:
+                self.cds[track.gene_id][track.transcript_id].append(track)
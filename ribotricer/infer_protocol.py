@@ -14,28 +14,42 @@
 # GNU General Public License for more details.
 
 from collections import Counter
-from .common import is_read_uniq_mapping
+from .bam import AlignmentStream
+from .bam import open_bam
+from .common import ReadFilter
 
-import pysam
 from quicksect import Interval
 
 # required to convert numeric strands to '+/-'
 NUM_TO_STRAND = {1: "+", -1: "-"}
 
 
-def infer_protocol(bam, gene_interval_tree, prefix, n_reads=20000):
+def infer_protocol(
+    bam,
+    gene_interval_tree,
+    prefix,
+    n_reads=20000,
+    read_filter=None,
+    reference_fasta=None,
+):
     """Infer strandedness protocol given a bam file
 
     Parameters
     ----------
-    bam: str
-         Path to bam file
+    bam: str or AlignmentStream
+         Path to bam file, or stream of alignments. Only the
+         first reads of a stream are used and kept for later
     gene_interval_tree: defaultdict(IntervalTree)
             chrom: (start, end, strand)
     prefix: str
             Prefix for protocol file
     n_reads: int
              Number of reads to use (downsampled)
+    read_filter: ReadFilter
+                 rules for identifying uniquely mapping reads,
+                 default rules if None
+    reference_fasta: str
+                     Path to the reference used for decoding CRAM files
 
     Returns
     -------
@@ -54,34 +68,39 @@ def infer_protocol(bam, gene_interval_tree, prefix, n_reads=20000):
     Equal proportion of the above two scenairos implies unstranded protocol.
     
     """
+    if read_filter is None:
+        read_filter = ReadFilter()
     iteration = 0
-    bam = pysam.AlignmentFile(bam, "rb")
+    if isinstance(bam, AlignmentStream):
+        reads = bam.prefix()
+    else:
+        bam = open_bam(bam, reference_fasta)
+        reads = bam.fetch(until_eof=True)
     strandedness = Counter()
-    for read in bam.fetch(until_eof=True):
-        if iteration <= n_reads:
-            if is_read_uniq_mapping(read):
-                if read.is_reverse:
-                    mapped_strand = "-"
-                else:
-                    mapped_strand = "+"
-                mapped_start = read.reference_start
-                mapped_end = read.reference_end
-                chrom = read.reference_name
-                # get corresponding gene's strand
-                interval = list(
-                    set(
-                        gene_interval_tree[chrom].find(
-                            Interval(mapped_start, mapped_end)
-                        )
-                    )
-                )
-                if len(interval) == 1:
-                    # Filter out genes with ambiguous strand info
-                    # (those) that have a tx_start on opposite strands
-                    gene_strand = NUM_TO_STRAND[interval[0].data]
-                    # count table for mapped strand vs gene strand
-                    strandedness["{}{}".format(mapped_strand, gene_strand)] += 1
-                    iteration += 1
+    for read in reads:
+        # No further read is used once enough reads are counted
+        if iteration > n_reads:
+            break
+        if read_filter.is_uniq_mapping(read):
+            if read.is_reverse:
+                mapped_strand = "-"
+            else:
+                mapped_strand = "+"
+            mapped_start = read.reference_start
+            mapped_end = read.reference_end
+            chrom = read.reference_name
+            # get corresponding gene's strand
+            interval = list(
+                set(gene_interval_tree[chrom].find(Interval(mapped_start, mapped_end)))
+            )
+            if len(interval) == 1:
+                # Filter out genes with ambiguous strand info
+                # (those) that have a tx_start on opposite strands
+                gene_strand = NUM_TO_STRAND[interval[0].data]
+                # count table for mapped strand vs gene strand
+                strandedness["{}{}".format(mapped_strand, gene_strand)] += 1
+                iteration += 1
+    read_filter.warn_undetermined()
     # Add pseudocounts
     strandedness["++"] += 1
     strandedness["--"] += 1
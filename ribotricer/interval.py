@@ -19,6 +19,8 @@ class Interval:
        All the intervals used in this project is 1-based and closed
     """
 
+    __slots__ = ("chrom", "start", "end", "strand")
+
     def __init__(self, chrom=None, start=1, end=1, strand="+"):
         self.chrom = chrom
         self.start = int(start)
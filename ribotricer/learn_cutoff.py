@@ -145,6 +145,8 @@ def determine_cutoff_bam(
     phase_score_cutoff=CUTOFF,
     min_valid_codons=MINIMUM_VALID_CODONS,
     report_all=True,
+    coverage_cache=None,
+    rebuild_cache=False,
 ):
     """Learn cutoff emprically from the given data.
 
@@ -166,6 +168,10 @@ def determine_cutoff_bam(
                            List of 'yes/no/reverse' 
   rna_stranded_protocols: list
                            List of 'yes/no/reverse' 
+  coverage_cache: str
+                  directory for caching the split bam files, no caching if None
+  rebuild_cache: bool
+                 Whether to read the bam files again and replace the cache
   
   
   Returns
@@ -218,6 +224,8 @@ def determine_cutoff_bam(
             min_valid_codons_ratio=MINIMUM_VALID_CODONS_RATIO,
             min_density_over_orf=MINIMUM_DENSITY_OVER_ORF,
             report_all=report_all,
+            coverage_cache=coverage_cache,
+            rebuild_cache=rebuild_cache,
         )
         ribo_tsvs.append("{}_translating_ORFs.tsv".format(bam_prefix))
     print(
@@ -239,6 +247,8 @@ def determine_cutoff_bam(
             min_valid_codons_ratio=MINIMUM_VALID_CODONS_RATIO,
             min_density_over_orf=MINIMUM_DENSITY_OVER_ORF,
             report_all=report_all,
+            coverage_cache=coverage_cache,
+            rebuild_cache=rebuild_cache,
         )
         rna_tsvs.append("{}_translating_ORFs.tsv".format(bam_prefix))
     determine_cutoff_tsv(ribo_tsvs, rna_tsvs, filter_by, sampling_ratio, reps)
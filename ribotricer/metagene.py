@@ -60,7 +60,7 @@ def orf_coverage_length(
     ----------
     orf: ORF
          instance of ORF
-    alignments: dict(dict(Counter))
+    alignments: CoverageStore
                 alignments summarized from bam
     length: int
             the target length
@@ -78,19 +78,17 @@ def orf_coverage_length(
     from_stop: Series
                coverage for ORF for specific length aligned at stop codon
     """
-    coverage = []
     chrom = orf.chrom
     strand = orf.strand
     if strand == "-":
         offset_5p, offset_3p = offset_3p, offset_5p
 
-    for pos in next_genome_pos(
-        orf.intervals, max_positions, offset_5p, offset_3p, strand == "-"
-    ):
-        try:
-            coverage.append(alignments[length][strand][(chrom, pos)])
-        except KeyError:
-            coverage.append(0)
+    positions = list(
+        next_genome_pos(
+            orf.intervals, max_positions, offset_5p, offset_3p, strand == "-"
+        )
+    )
+    coverage = alignments.gather(chrom, strand, positions, length)
 
     if strand == "-":
         from_start = pd.Series(
@@ -127,7 +125,7 @@ def metagene_coverage(
     ----------
     cds: List[ORF]
          list of cds
-    alignments: dict(dict(Counter))
+    alignments: CoverageStore
                 alignments summarized from bam
     read_lengths: dict
                   key is the length, value is the number reads
@@ -267,15 +265,17 @@ def align_metagenes(
             )
         )
 
+    # lengths are taken in increasing order, whatever the order
+    # in which they were found in the bam file
     psite_offsets = OrderedDict()
     base = n_reads = 0
-    for length, reads in list(read_lengths.items()):
+    for length, reads in sorted(read_lengths.items()):
         if reads > n_reads:
             base = length
             n_reads = reads
     reference = metagenes[base][0].values
     to_write = "relative lag to base: {}\n".format(base)
-    for length, (meta, _, _, _, _, _) in list(metagenes.items()):
+    for length, (meta, _, _, _, _, _) in sorted(metagenes.items()):
         cov = meta.values
         xcorr = np.correlate(reference, cov, "full")
         origin = len(xcorr) // 2
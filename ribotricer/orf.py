@@ -14,13 +14,73 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 # GNU General Public License for more details.
 
+from array import array
 import sys
+
+import numpy as np
+
 from .interval import Interval
 
+# String columns of an ORFTable, in the order of the ORF constructor
+STRING_COLUMNS = [
+    "category",
+    "transcript_id",
+    "transcript_type",
+    "gene_id",
+    "gene_name",
+    "gene_type",
+    "chrom",
+    "strand",
+    "start_codon",
+]
+
+
+def _orf_id(tid, intervals):
+    """ORF id built from the transcript id and the sorted intervals"""
+    return "{}_{}_{}_{}".format(
+        tid,
+        intervals[0].start,
+        intervals[-1].end,
+        sum([x.end - x.start + 1 for x in intervals]),
+    )
+
+
+# Odd multipliers used for hashing ORF signatures
+_HASH_FACTORS = [
+    np.uint64(0x9E3779B97F4A7C15),
+    np.uint64(0xC2B2AE3D27D4EB4F),
+    np.uint64(0x165667B19E3779F9),
+]
+
+
+def _mix_hash(values):
+    """Scramble the bits of an array of uint64 (splitmix64 finalizer)"""
+    values = values ^ (values >> np.uint64(30))
+    values = values * np.uint64(0xBF58476D1CE4E5B9)
+    values = values ^ (values >> np.uint64(27))
+    values = values * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
 
 class ORF:
     """Class for candidate ORF."""
 
+    __slots__ = (
+        "category",
+        "tid",
+        "ttype",
+        "gid",
+        "gname",
+        "gtype",
+        "chrom",
+        "strand",
+        "intervals",
+        "oid",
+        "seq",
+        "leader",
+        "trailer",
+    )
+
     def __init__(
         self,
         category,
@@ -45,14 +105,7 @@ class ORF:
         self.chrom = chrom
         self.strand = strand
         self.intervals = sorted(intervals, key=lambda x: x.start)
-        start = self.intervals[0].start
-        end = self.intervals[-1].end
-        self.oid = "{}_{}_{}_{}".format(
-            transcript_id,
-            start,
-            end,
-            sum([x.end - x.start + 1 for x in self.intervals]),
-        )
+        self.oid = _orf_id(transcript_id, self.intervals)
         self.seq = seq
         self.leader = leader
         self.trailer = trailer
@@ -198,3 +251,316 @@ class ORF:
             leader,
             trailer,
         )
+
+
+class ORFView:
+    """Read-only view of one row of an ORFTable.
+
+    It has the attributes of an ORF, which are looked up
+    in the table on access.
+    """
+
+    __slots__ = ("table", "row")
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+    @property
+    def category(self):
+        return self.table.value("category", self.row)
+
+    @property
+    def tid(self):
+        return self.table.value("transcript_id", self.row)
+
+    @property
+    def ttype(self):
+        return self.table.value("transcript_type", self.row)
+
+    @property
+    def gid(self):
+        return self.table.value("gene_id", self.row)
+
+    @property
+    def gname(self):
+        return self.table.value("gene_name", self.row)
+
+    @property
+    def gtype(self):
+        return self.table.value("gene_type", self.row)
+
+    @property
+    def chrom(self):
+        return self.table.value("chrom", self.row)
+
+    @property
+    def strand(self):
+        return self.table.value("strand", self.row)
+
+    @property
+    def seq(self):
+        """Start codon as written to the index"""
+        return self.table.value("start_codon", self.row)
+
+    @property
+    def start_codon(self):
+        """Return the first 3 bases from sequence"""
+        seq = self.seq
+        if len(seq) < 3:
+            return None
+        return seq[:3]
+
+    @property
+    def intervals(self):
+        chrom = self.chrom
+        strand = self.strand
+        starts, ends = self.table.exons(self.row)
+        return [
+            Interval(chrom, start, end, strand)
+            for start, end in zip(starts.tolist(), ends.tolist())
+        ]
+
+    @property
+    def oid(self):
+        return _orf_id(self.tid, self.intervals)
+
+
+def chrom_order(chrom_codes, starts, n_chroms):
+    """Rows of each chromosome sorted by start
+
+    Parameters
+    ----------
+    chrom_codes: np.ndarray
+                 chromosome code of each row
+    starts: np.ndarray
+            start of the first exon of each row
+    n_chroms: int
+              number of chromosomes
+
+    Returns
+    -------
+    order: np.ndarray
+           rows sorted by chromosome code and start
+    offsets: np.ndarray
+             the rows of chromosome k are order[offsets[k]:offsets[k + 1]]
+    """
+    order = np.lexsort((starts, chrom_codes)).astype(np.int64)
+    chrom_counts = np.bincount(chrom_codes, minlength=n_chroms)
+    offsets = np.concatenate(([0], np.cumsum(chrom_counts))).astype(np.int64)
+    return order, offsets
+
+
+class ORFTable:
+    """ORFs stored column-wise.
+
+    Each string column is stored as integer codes into a dictionary of
+    distinct values. The exons of row i are
+    exon_starts[exon_offsets[i]:exon_offsets[i + 1]] and the matching
+    exon_ends, sorted by start. Rows are accessed as ORFView objects.
+
+    A table is either built by appending ORFs, with columns held in
+    compact python arrays, or created from numpy arrays, which may be
+    memory-mapped.
+    """
+
+    def __init__(self, arrays=None):
+        """
+        Parameters
+        ----------
+        arrays: dict
+                output of to_arrays, an empty table is created if None
+        """
+        if arrays is None:
+            self.codes = {column: array("i") for column in STRING_COLUMNS}
+            self.dictionaries = {column: [] for column in STRING_COLUMNS}
+            self._lookup = {column: {} for column in STRING_COLUMNS}
+            self.exon_offsets = array("q", [0])
+            self.exon_starts = array("q")
+            self.exon_ends = array("q")
+        else:
+            self.codes = {
+                column: arrays["{}_codes".format(column)] for column in STRING_COLUMNS
+            }
+            self.dictionaries = {
+                column: arrays["{}_values".format(column)].tolist()
+                for column in STRING_COLUMNS
+            }
+            self._lookup = None
+            self.exon_offsets = arrays["exon_offsets"]
+            self.exon_starts = arrays["exon_starts"]
+            self.exon_ends = arrays["exon_ends"]
+
+    def __len__(self):
+        return len(self.exon_offsets) - 1
+
+    def __getitem__(self, row):
+        if row < 0:
+            row += len(self)
+        if not 0 <= row < len(self):
+            raise IndexError("row out of range")
+        return ORFView(self, row)
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield ORFView(self, row)
+
+    def append(self, orf):
+        """Add an ORF (or ORFView) at the end of the table"""
+        if self._lookup is None:
+            raise ValueError("cannot append to a table created from arrays")
+        values = [
+            orf.category,
+            orf.tid,
+            orf.ttype,
+            orf.gid,
+            orf.gname,
+            orf.gtype,
+            orf.chrom,
+            orf.strand,
+            # as written to the index
+            orf.seq if isinstance(orf, ORFView) else orf.start_codon,
+        ]
+        for column, value in zip(STRING_COLUMNS, values):
+            value = str(value)
+            lookup = self._lookup[column]
+            code = lookup.get(value)
+            if code is None:
+                code = lookup[value] = len(lookup)
+                self.dictionaries[column].append(value)
+            self.codes[column].append(code)
+        for interval in orf.intervals:
+            self.exon_starts.append(interval.start)
+            self.exon_ends.append(interval.end)
+        self.exon_offsets.append(len(self.exon_starts))
+
+    def clear(self):
+        """Remove all rows of a table built by appending ORFs
+
+        The dictionaries of the string columns are kept, so appended
+        rows get the same codes as before.
+        """
+        if self._lookup is None:
+            raise ValueError("cannot clear a table created from arrays")
+        self.codes = {column: array("i") for column in STRING_COLUMNS}
+        self.exon_offsets = array("q", [0])
+        self.exon_starts = array("q")
+        self.exon_ends = array("q")
+
+    def value(self, column, row):
+        """Value of a string column in a row"""
+        return self.dictionaries[column][self.codes[column][row]]
+
+    def exons(self, row):
+        """Starts and ends of the exons of a row"""
+        begin, end = self.exon_offsets[row], self.exon_offsets[row + 1]
+        return (self.exon_starts[begin:end], self.exon_ends[begin:end])
+
+    def array(self, name):
+        """Numpy version of exon_offsets, exon_starts or exon_ends"""
+        return np.asarray(getattr(self, name), dtype=np.int64)
+
+    def column(self, name):
+        """Codes and dictionary of a string column as numpy arrays"""
+        return (
+            np.asarray(self.codes[name], dtype=np.int32),
+            np.array(self.dictionaries[name], dtype=str),
+        )
+
+    def isin(self, name, values):
+        """Rows whose string column is one of values
+
+        Returns
+        -------
+        mask: np.ndarray
+              True for matching rows
+        """
+        codes, dictionary = self.column(name)
+        return np.isin(codes, np.flatnonzero(np.isin(dictionary, list(values))))
+
+    def signature_hashes(self):
+        """Hash of the genomic signature (chrom, strand and exons) of each row
+
+        Rows with the same exons on the same chromosome and strand get
+        the same hash. Different signatures may collide, so equal hashes
+        must be confirmed by comparing the exons.
+
+        Returns
+        -------
+        hashes: np.ndarray
+                uint64 hash of each row
+        """
+        if len(self) == 0:
+            return np.zeros(0, dtype=np.uint64)
+        offsets = self.array("exon_offsets")
+        n_exons = np.diff(offsets)
+        # rank of each exon in its row
+        ranks = np.arange(offsets[-1]) - np.repeat(offsets[:-1], n_exons)
+        exons = _mix_hash(
+            self.array("exon_starts").astype(np.uint64) * _HASH_FACTORS[0]
+            + self.array("exon_ends").astype(np.uint64) * _HASH_FACTORS[1]
+            + ranks.astype(np.uint64) * _HASH_FACTORS[2]
+        )
+        rows = (
+            self.column("chrom")[0].astype(np.uint64) * _HASH_FACTORS[0]
+            + self.column("strand")[0].astype(np.uint64) * _HASH_FACTORS[1]
+            + n_exons.astype(np.uint64) * _HASH_FACTORS[2]
+        )
+        return _mix_hash(np.add.reduceat(exons, offsets[:-1]) ^ _mix_hash(rows))
+
+    def take(self, rows):
+        """Table made of some rows
+
+        Parameters
+        ----------
+        rows: array like
+              rows to take, in the order of the new table
+
+        Returns
+        -------
+        table: ORFTable
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        offsets = self.array("exon_offsets")
+        n_exons = offsets[rows + 1] - offsets[rows]
+        new_offsets = np.concatenate(([0], np.cumsum(n_exons))).astype(np.int64)
+        exons = np.repeat(offsets[rows] - new_offsets[:-1], n_exons) + np.arange(
+            new_offsets[-1]
+        )
+        arrays = {
+            "exon_offsets": new_offsets,
+            "exon_starts": self.array("exon_starts")[exons],
+            "exon_ends": self.array("exon_ends")[exons],
+        }
+        for column in STRING_COLUMNS:
+            codes, dictionary = self.column(column)
+            arrays["{}_codes".format(column)] = codes[rows]
+            arrays["{}_values".format(column)] = dictionary
+        return ORFTable(arrays)
+
+    def to_arrays(self):
+        """Columns as numpy arrays, for saving with numpy
+
+        Returns
+        -------
+        arrays: dict
+                exon_offsets, exon_starts and exon_ends, the codes and
+                dictionary of each string column ({column}_codes and
+                {column}_values), and chrom_order and chrom_offsets, which
+                list the rows of chromosome k sorted by start as
+                chrom_order[chrom_offsets[k]:chrom_offsets[k + 1]]
+        """
+        arrays = {
+            name: np.array(getattr(self, name), dtype=np.int64)
+            for name in ("exon_offsets", "exon_starts", "exon_ends")
+        }
+        for column in STRING_COLUMNS:
+            codes, dictionary = self.column(column)
+            arrays["{}_codes".format(column)] = np.array(codes)
+            arrays["{}_values".format(column)] = dictionary
+        arrays["chrom_order"], arrays["chrom_offsets"] = chrom_order(
+            arrays["chrom_codes"],
+            arrays["exon_starts"][arrays["exon_offsets"][:-1]],
+            len(arrays["chrom_values"]),
+        )
+        return arrays
@@ -0,0 +1,584 @@
+"""Columnar binary version of the ribotricer index"""
+# Part of ribotricer software
+#
+# Copyright (C) 2019 Saket Choudhary, Wenzheng Li, and Andrew D Smith
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pysam
+from tqdm import tqdm
+
+from .common import CHECKSUM_BLOCK_SIZE
+from .common import file_fingerprint
+from .common import is_gzipped
+from .common import open_file
+from .common import replace_directory
+from .common import same_content
+from .orf import ORF
+from .orf import ORFTable
+from .orf import ORFView
+from .orf import STRING_COLUMNS
+from .orf import chrom_order
+
+# Bumped whenever the layout of the binary index changes
+ORF_INDEX_VERSION = 2
+# Columns of the tsv index
+INDEX_COLUMNS = [
+    "ORF_ID",
+    "ORF_type",
+    "transcript_id",
+    "transcript_type",
+    "gene_id",
+    "gene_name",
+    "gene_type",
+    "chrom",
+    "strand",
+    "start_codon",
+    "coordinate",
+]
+# Number of ORFs formatted before each write of an ORFWriter
+WRITE_BATCH_SIZE = 4096
+
+
+def binary_index_path(ribotricer_index):
+    """Directory of the binary index belonging to a tsv index"""
+    return "{}.bin".format(ribotricer_index)
+
+
+def index_checksum(ribotricer_index):
+    """MD5 checksum of the decompressed content of a tsv index
+
+    This is the checksum computed by the ORFWriter of the index, which
+    does not depend on the compression or on the file metadata.
+
+    Parameters
+    ----------
+    ribotricer_index: str
+                      Path to the tsv index
+
+    Returns
+    -------
+    checksum: str
+    """
+    checksum = hashlib.md5()
+    with open_file(ribotricer_index, "rb") as anno:
+        for block in iter(lambda: anno.read(CHECKSUM_BLOCK_SIZE), b""):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+def write_orf_index(orfs, ribotricer_index):
+    """Write the binary index next to a tsv index
+
+    Parameters
+    ----------
+    orfs: ORFTable or List[ORF]
+          ORFs in the order of the tsv index
+    ribotricer_index: str
+                      Path to the tsv index, which must already be written
+    """
+    writer = ORFIndexWriter(ribotricer_index)
+    try:
+        for orf in orfs:
+            writer.write(orf)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+
+
+class ORFIndexWriter:
+    """Write a binary index one ORF at a time.
+
+    ORFs are added to an ORFTable whose columns are appended to raw files
+    every WRITE_BATCH_SIZE ORFs, so only the dictionaries of the string
+    columns are kept in memory. The raw files are turned into the arrays
+    of the binary index when the writer is closed.
+    """
+
+    def __init__(self, ribotricer_index):
+        """
+        Parameters
+        ----------
+        ribotricer_index: str
+                          Path to the tsv index the binary index belongs to
+        """
+        self.ribotricer_index = ribotricer_index
+        self.path = binary_index_path(ribotricer_index)
+        self.tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        os.makedirs(self.tmp_path)
+        self.table = ORFTable()
+        self.dtypes = {
+            "exon_offsets": np.int64,
+            "exon_starts": np.int64,
+            "exon_ends": np.int64,
+        }
+        for column in STRING_COLUMNS:
+            self.dtypes["{}_codes".format(column)] = np.int32
+        self.outputs = {name: open(self._raw_path(name), "wb") for name in self.dtypes}
+        self.outputs["exon_offsets"].write(np.zeros(1, dtype=np.int64).tobytes())
+        self.n_orfs = 0
+        self.n_exons = 0
+
+    def _raw_path(self, name):
+        return os.path.join(self.tmp_path, "{}.raw".format(name))
+
+    def write(self, orf):
+        """Add an ORF (or ORFView) at the end of the index"""
+        self.table.append(orf)
+        if len(self.table) >= WRITE_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Append the columns of the ORFs added since the last flush"""
+        table = self.table
+        blocks = {
+            "exon_offsets": table.array("exon_offsets")[1:] + self.n_exons,
+            "exon_starts": table.array("exon_starts"),
+            "exon_ends": table.array("exon_ends"),
+        }
+        for column in STRING_COLUMNS:
+            blocks["{}_codes".format(column)] = table.column(column)[0]
+        for name, block in blocks.items():
+            self.outputs[name].write(block.astype(self.dtypes[name]).tobytes())
+        self.n_orfs += len(table)
+        self.n_exons += len(table.exon_starts)
+        table.clear()
+
+    def _load_raw(self, name):
+        """Memory-mapped raw file of an array"""
+        if os.path.getsize(self._raw_path(name)) == 0:
+            return np.zeros(0, dtype=self.dtypes[name])
+        return np.memmap(self._raw_path(name), dtype=self.dtypes[name], mode="r")
+
+    def close(self):
+        """Finish writing and move the binary index to its place
+
+        The tsv index must be in its place, its checksum is saved
+        to check that the binary index is up-to-date.
+        """
+        self.flush()
+        for output in self.outputs.values():
+            output.close()
+        arrays = {name: self._load_raw(name) for name in self.dtypes}
+        for column in STRING_COLUMNS:
+            arrays["{}_values".format(column)] = self.table.column(column)[1]
+        arrays["chrom_order"], arrays["chrom_offsets"] = chrom_order(
+            arrays["chrom_codes"],
+            arrays["exon_starts"][arrays["exon_offsets"][:-1]],
+            len(arrays["chrom_values"]),
+        )
+        for name, values in arrays.items():
+            np.save(os.path.join(self.tmp_path, "{}.npy".format(name)), values)
+        del arrays
+        for name in self.dtypes:
+            os.remove(self._raw_path(name))
+        meta = {
+            "version": ORF_INDEX_VERSION,
+            "n_orfs": self.n_orfs,
+            "tsv": file_fingerprint(self.ribotricer_index),
+        }
+        with open(os.path.join(self.tmp_path, "meta.json"), "w") as output:
+            json.dump(meta, output)
+        replace_directory(self.tmp_path, self.path)
+
+    def abort(self):
+        """Stop writing and remove the temporary files"""
+        for output in self.outputs.values():
+            output.close()
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+
+class ORFIndex(ORFTable):
+    """Binary ribotricer index, an ORFTable with all arrays memory-mapped"""
+
+    def __init__(self, path):
+        """
+        Parameters
+        ----------
+        path: str
+              directory of the binary index
+        """
+        with open(os.path.join(path, "meta.json")) as meta:
+            self.meta = json.load(meta)
+        self.path = path
+        names = ["exon_offsets", "exon_starts", "exon_ends", "chrom_order"]
+        names += ["chrom_offsets"]
+        for column in STRING_COLUMNS:
+            names += ["{}_codes".format(column), "{}_values".format(column)]
+        arrays = {
+            name: np.load(os.path.join(path, "{}.npy".format(name)), mmap_mode="r")
+            for name in names
+        }
+        super().__init__(arrays)
+        self.chrom_order = arrays["chrom_order"]
+        self.chrom_offsets = arrays["chrom_offsets"]
+
+    @classmethod
+    def open(cls, ribotricer_index):
+        """Binary index of a tsv index
+
+        Parameters
+        ----------
+        ribotricer_index: str
+                          Path to the tsv index
+
+        Returns
+        -------
+        index: ORFIndex
+               None if there is no binary index, or if it
+               does not match the tsv index
+        """
+        path = binary_index_path(ribotricer_index)
+        if not os.path.isfile(os.path.join(path, "meta.json")):
+            return None
+        with open(os.path.join(path, "meta.json")) as meta:
+            meta = json.load(meta)
+        if meta["version"] != ORF_INDEX_VERSION or not same_content(
+            ribotricer_index, meta["tsv"]
+        ):
+            print("binary index {} is outdated, reading the tsv index".format(path))
+            return None
+        return cls(path)
+
+    def chrom_rows(self, chrom):
+        """Rows of a chromosome, sorted by start"""
+        if chrom not in self.dictionaries["chrom"]:
+            return np.zeros(0, dtype=np.int64)
+        code = self.dictionaries["chrom"].index(chrom)
+        offsets = self.chrom_offsets
+        return self.chrom_order[offsets[code] : offsets[code + 1]]
+
+
+def read_orfs(ribotricer_index, categories=None):
+    """Iterate over the ORFs of an index, in their order in the tsv file
+
+    The binary index is used if there is an up-to-date one.
+
+    Parameters
+    ----------
+    ribotricer_index: str
+                      Path to the tsv index generated by ribotricer prepare_orfs
+    categories: set
+                ORF types to include, all if None
+
+    Returns
+    -------
+    orfs: generator of ORF or ORFView
+    """
+    index = ORFIndex.open(ribotricer_index)
+    if index is not None:
+        if categories is None:
+            yield from index
+        else:
+            for row in np.flatnonzero(index.isin("category", categories)).tolist():
+                yield index[row]
+        return
+    with open_file(ribotricer_index, "r") as anno:
+        # Skip header
+        anno.readline()
+        for line in anno:
+            orf = ORF.from_string(line)
+            if categories is None or orf.category in categories:
+                yield orf
+
+
+def read_orf_table(ribotricer_index, categories=None):
+    """Load the ORFs of an index into an ORFTable
+
+    Parameters
+    ----------
+    ribotricer_index: str
+                      Path to the tsv index generated by ribotricer prepare_orfs
+    categories: set
+                ORF types to include, all if None
+
+    Returns
+    -------
+    orfs: ORFTable
+    """
+    index = ORFIndex.open(ribotricer_index)
+    if index is not None:
+        if categories is None:
+            return index
+        return index.take(np.flatnonzero(index.isin("category", categories)))
+    table = ORFTable()
+    for orf in read_orfs(ribotricer_index, categories):
+        table.append(orf)
+    return table
+
+
+class ORFStream:
+    """Single pass over the ORFs of an index, in their order in the tsv file.
+
+    The position of the stream is a row of the binary index if there is
+    an up-to-date one, and a byte offset into the tsv index otherwise.
+    The tsv index is reopened for every read, so the stream can be kept
+    while other work is done.
+    """
+
+    def __init__(self, ribotricer_index):
+        """
+        Parameters
+        ----------
+        ribotricer_index: str
+                          Path to the tsv index generated by ribotricer prepare_orfs
+        """
+        self.ribotricer_index = ribotricer_index
+        self.index = ORFIndex.open(ribotricer_index)
+        if self.index is not None:
+            self.size = len(self.index)
+            self.position = 0
+            self.unit = "ORFs"
+        else:
+            # positions are offsets into the uncompressed file,
+            # whose size is unknown for compressed ones
+            self.size = None
+            if not is_gzipped(ribotricer_index):
+                self.size = os.path.getsize(ribotricer_index)
+            with open_file(ribotricer_index, "rb") as anno:
+                # Skip header
+                self.position = len(anno.readline())
+            self.unit = "B"
+
+    def progress(self, **kwargs):
+        """Progress bar for the rest of the stream"""
+        return tqdm(
+            total=None if self.size is None else self.size - self.position,
+            unit=self.unit,
+            unit_scale=self.unit == "B",
+            **kwargs
+        )
+
+    def signature_hashes(self):
+        """Hash of the genomic signature of every ORF of the index
+
+        Hashes are given for all rows, in the order of the tsv index,
+        whatever the position of the stream. Equal signatures have
+        equal hashes, but equal hashes may come from different ones.
+
+        Returns
+        -------
+        hashes: np.ndarray
+                one hash per row of the index, None if there is no
+                binary index, as they would take another pass over
+                the tsv index
+        """
+        if self.index is None:
+            return None
+        return self.index.signature_hashes()
+
+    def _orfs(self):
+        """Remaining ORFs, with the position following each of them"""
+        if self.index is not None:
+            for row in range(self.position, self.size):
+                yield self.index[row], row + 1
+            return
+        position = self.position
+        with open_file(self.ribotricer_index, "rb") as anno:
+            anno.seek(position)
+            for line in iter(anno.readline, b""):
+                position += len(line)
+                yield ORF.from_string(line.decode()), position
+
+    def read_leading(self, category, pbar=None):
+        """Read ORFs as long as they belong to a category
+
+        Parameters
+        ----------
+        category: str
+                  ORF type, such as 'annotated'
+        pbar: tqdm
+              progress bar to update
+
+        Returns
+        -------
+        orfs: ORFTable
+              the ORFs read, the stream is left at the first ORF
+              of another category
+        """
+        if self.index is not None:
+            # the rows are taken from the index without building objects
+            not_leading = np.flatnonzero(~self.index.isin("category", [category]))
+            not_leading = not_leading[not_leading >= self.position]
+            end = not_leading[0] if len(not_leading) else self.size
+            rows = np.arange(self.position, end)
+            if pbar is not None:
+                pbar.update(len(rows))
+            self.position = int(end)
+            return self.index.take(rows)
+        orfs = ORFTable()
+        for orf, position in self._orfs():
+            if orf is None or orf.category != category:
+                break
+            orfs.append(orf)
+            if pbar is not None:
+                pbar.update(position - self.position)
+            self.position = position
+        return orfs
+
+    def chunks(self, size, pbar=None):
+        """Read the remaining ORFs in chunks, without parsing them
+
+        Parameters
+        ----------
+        size: int
+              number of ORFs in each chunk
+        pbar: tqdm
+              progress bar to update
+
+        Returns
+        -------
+        chunks: generator
+                (start, end) row ranges of the binary index if there
+                is one, lists of lines of the tsv index otherwise
+        """
+        if self.index is not None:
+            while self.position < self.size:
+                start = self.position
+                self.position = min(start + size, self.size)
+                if pbar is not None:
+                    pbar.update(self.position - start)
+                yield (start, self.position)
+            return
+        with open_file(self.ribotricer_index, "rb") as anno:
+            anno.seek(self.position)
+            position = self.position
+            lines = []
+            for line in iter(anno.readline, b""):
+                position += len(line)
+                lines.append(line.decode())
+                if len(lines) == size:
+                    if pbar is not None:
+                        pbar.update(position - self.position)
+                    self.position = position
+                    yield lines
+                    lines = []
+            if lines:
+                if pbar is not None:
+                    pbar.update(position - self.position)
+                self.position = position
+                yield lines
+
+    def __iter__(self):
+        return self.iter()
+
+    def iter(self, pbar=None):
+        """Read the remaining ORFs
+
+        Parameters
+        ----------
+        pbar: tqdm
+              progress bar to update
+
+        Returns
+        -------
+        orfs: generator of ORF
+        """
+        for orf, position in self._orfs():
+            if pbar is not None:
+                pbar.update(position - self.position)
+            self.position = position
+            yield orf
+
+
+class ORFWriter:
+    """Write a tsv index one ORF at a time.
+
+    Lines are formatted in batches and written to a temporary file,
+    compressed with bgzip if requested, which replaces the index
+    when the writer is closed. The binary index can be written
+    at the same time, without keeping the ORFs in memory. The MD5
+    checksum of the lines written is kept, as given by index_checksum.
+    """
+
+    def __init__(self, ribotricer_index, bgzip=False, binary=False):
+        """
+        Parameters
+        ----------
+        ribotricer_index: str
+                          Path to the tsv index to write
+        bgzip: bool
+               whether to compress the index with bgzip
+        binary: bool
+                whether to write the binary index too
+        """
+        self.ribotricer_index = ribotricer_index
+        self.tmp_path = "{}.{}.tmp".format(ribotricer_index, os.getpid())
+        if bgzip:
+            self.output = pysam.BGZFile(self.tmp_path, "wb")
+        else:
+            self.output = open(self.tmp_path, "wb")
+        self.index_writer = None
+        if binary:
+            self.index_writer = ORFIndexWriter(ribotricer_index)
+        self.checksum = hashlib.md5()
+        self.lines = ["\t".join(INDEX_COLUMNS) + "\n"]
+        self.formatter = "{}\t" * (len(INDEX_COLUMNS) - 1) + "{}\n"
+
+    def write(self, orf):
+        """Add an ORF (or ORFView) at the end of the index"""
+        coordinate = ",".join(
+            ["{}-{}".format(iv.start, iv.end) for iv in orf.intervals]
+        )
+        self.lines.append(
+            self.formatter.format(
+                orf.oid,
+                orf.category,
+                orf.tid,
+                orf.ttype,
+                orf.gid,
+                orf.gname,
+                orf.gtype,
+                orf.chrom,
+                orf.strand,
+                # views hold the start codon as written to the index
+                orf.seq if isinstance(orf, ORFView) else orf.start_codon,
+                coordinate,
+            )
+        )
+        if len(self.lines) >= WRITE_BATCH_SIZE:
+            self.flush()
+        if self.index_writer is not None:
+            self.index_writer.write(orf)
+
+    def flush(self):
+        """Write the formatted lines"""
+        data = "".join(self.lines).encode()
+        self.checksum.update(data)
+        self.output.write(data)
+        self.lines = []
+
+    def close(self):
+        """Finish writing and move the index to its place"""
+        self.flush()
+        self.output.close()
+        os.replace(self.tmp_path, self.ribotricer_index)
+        if self.index_writer is not None:
+            self.index_writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.output.close()
+            os.remove(self.tmp_path)
+            if self.index_writer is not None:
+                self.index_writer.abort()
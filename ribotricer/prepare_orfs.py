@@ -15,16 +15,40 @@
 
 from collections import defaultdict
 import datetime
-import re
+import hashlib
+import json
+from multiprocessing import Pool
+import os
 
+import numpy as np
+
+from .common import TranscriptCoordinateMapper
 from .common import merge_intervals
 from .fasta import FastaReader
 from .gtf import GTFReader
 from .interval import Interval
 from .orf import ORF
+from .orf_index import ORFWriter
+from .orf_index import index_checksum
+from .orf_index import read_orf_table
 
 from tqdm import tqdm
 
+# Number of transcripts sent to a worker process at a time
+TRANSCRIPTS_PER_BATCH = 200
+
+# Bumped whenever the content of the manifest changes
+MANIFEST_VERSION = 3
+
+# FastaReader of a worker process
+_worker_fasta = None
+
+# Code of each byte in an encoded sequence: A, C, G, T are 0 to 3,
+# anything else is 4. Codons are then coded in base 5
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for _code, _base in enumerate(b"ACGT"):
+    BASE_CODES[_base] = _code
+
 
 def tracks_to_ivs(tracks):
     """
@@ -74,38 +98,8 @@ def transcript_to_genome_iv(start, end, intervals, reverse=False):
     ivs: List[Interval]
          the coordinate for start, end in genome
     """
-    total_len = sum(i.end - i.start + 1 for i in intervals)
-    if reverse:
-        start, end = total_len - end - 1, total_len - start - 1
-    ivs = []
-    start_genome = None
-    end_genome = None
-
-    # find start in genome
-    cur = 0
-    for i in intervals:
-        i_len = i.end - i.start + 1
-        if cur + i_len > start:
-            start_genome = i.start + start - cur
-            break
-        cur += i_len
-
-    # find end in genome
-    cur = 0
-    for i in intervals:
-        i_len = i.end - i.start + 1
-        if cur + i_len > end:
-            end_genome = i.start + end - cur
-            break
-        cur += i_len
-
-    # find overlap with (start_genome, end_genome)
-    for i in intervals:
-        s = max(i.start, start_genome)
-        e = min(i.end, end_genome)
-        if s <= e:
-            ivs.append(Interval(i.chrom, s, e, i.strand))
-    return ivs
+    mapper = TranscriptCoordinateMapper(intervals, reverse)
+    return mapper.map_intervals([start], [end])[0]
 
 
 def fetch_seq(fasta, tracks):
@@ -133,7 +127,91 @@ def fetch_seq(fasta, tracks):
     return merged_seq
 
 
-def search_orfs(fasta, intervals, min_orf_length, start_codons, stop_codons, longest):
+def codon_lookup(codons):
+    """Lookup table telling which codon codes belong to a set of codons
+
+    Parameters
+    ----------
+    codons: set
+            set of codons made of A, C, G, T
+
+    Returns
+    -------
+    lookup: np.ndarray
+            boolean array of size 125, indexed by codon code
+    """
+    lookup = np.zeros(125, dtype=bool)
+    for codon in codons:
+        bases = BASE_CODES[np.frombuffer(codon.encode(), dtype=np.uint8)]
+        lookup[int(bases[0]) * 25 + int(bases[1]) * 5 + int(bases[2])] = True
+    return lookup
+
+
+def scan_orfs(seq, start_codons, stop_codons, min_orf_length, longest):
+    """Find start to stop codon pairs in a sequence
+
+    Every start codon is paired with the next in-frame stop codon.
+    A codon that is both a start and a stop codon acts as a stop codon.
+
+    Parameters
+    ----------
+    seq: str
+         sequence to scan
+    start_codons: set
+                  set of start codons
+    stop_codons: set
+                 set of stop codons
+    min_orf_length: int
+                    minimum distance between a start and its stop codon
+    longest: bool
+             whether to keep only the most upstream start codon of each
+             stop codon
+
+    Returns
+    -------
+    starts: np.ndarray
+            start codon positions (zero-based)
+    stops: np.ndarray
+           matching stop codon positions, pairs are sorted by frame
+           and then by start position
+    """
+    if len(seq) < 3:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    bases = BASE_CODES[np.frombuffer(seq.encode(), dtype=np.uint8)].astype(np.int64)
+    codons = bases[:-2] * 25 + bases[1:-1] * 5 + bases[2:]
+    is_stop = codon_lookup(stop_codons)[codons]
+    is_start = codon_lookup(start_codons)[codons] & ~is_stop
+    starts = []
+    stops = []
+    for frame in [0, 1, 2]:
+        frame_starts = np.flatnonzero(is_start[frame::3]) * 3 + frame
+        frame_stops = np.flatnonzero(is_stop[frame::3]) * 3 + frame
+        # next stop codon of each start codon
+        next_stop = np.searchsorted(frame_stops, frame_starts)
+        closed = next_stop < len(frame_stops)
+        frame_starts = frame_starts[closed]
+        next_stop = next_stop[closed]
+        if longest:
+            # starts are sorted, so the first one of each stop is the most upstream
+            _, first = np.unique(next_stop, return_index=True)
+            frame_starts = frame_starts[first]
+            next_stop = next_stop[first]
+        frame_stops = frame_stops[next_stop]
+        long_enough = frame_stops - frame_starts >= min_orf_length
+        starts.append(frame_starts[long_enough])
+        stops.append(frame_stops[long_enough])
+    return np.concatenate(starts), np.concatenate(stops)
+
+
+def search_orfs(
+    fasta,
+    intervals,
+    min_orf_length,
+    start_codons,
+    stop_codons,
+    longest,
+    flanks=False,
+):
     """
     Parameters
     ----------
@@ -150,6 +228,8 @@ def search_orfs(fasta, intervals, min_orf_length, start_codons, stop_codons, lon
     longest: bool
              whether to choose the most upstream start codon when multiple in
              frame ones exist
+    flanks: bool
+            whether to return the leader and trailer sequences
 
     Returns
     -------
@@ -157,8 +237,8 @@ def search_orfs(fasta, intervals, min_orf_length, start_codons, stop_codons, lon
           list of (List[Interval], seq, leader, trailer)
             list of intervals for candidate ORF
             seq: sequence for the candidate ORF
-            leader: sequence upstream of the ORF
-            trailer: sequence downstream of the ORF
+            leader: sequence upstream of the ORF, None unless flanks is set
+            trailer: sequence downstream of the ORF, None unless flanks is set
     """
     if not intervals:
         return []
@@ -175,89 +255,405 @@ def search_orfs(fasta, intervals, min_orf_length, start_codons, stop_codons, lon
         merged_seq = fasta.reverse_complement(merged_seq)
         reverse = True
 
-    start_stop_idx = []
-    if "ATG" in start_codons:
-        start_stop_idx += [(m.start(0), "ATG") for m in re.finditer("ATG", merged_seq)]
-    if start_codons - {"ATG"}:
-        alternative_start_regx = re.compile(
-            r"(?=({}))".format("|".join(start_codons - {"ATG"}))
-        )
-        start_stop_idx += [
-            (m.start(0), "start")
-            for m in re.finditer(alternative_start_regx, merged_seq)
-        ]
-    stop_regx = re.compile(r"(?=({}))".format("|".join(stop_codons)))
-    start_stop_idx += [(m.start(0), "stop") for m in re.finditer(stop_regx, merged_seq)]
-    start_stop_idx.sort(key=lambda x: x[0])
-    for frame in [0, 1, 2]:
-        inframe_codons = [x for x in start_stop_idx if x[0] % 3 == frame]
-        starts = []
-        for idx, label in inframe_codons:
-            if label != "stop":
-                starts.append(idx)
-            elif starts:
-                for start in starts:
-                    if idx - start >= min_orf_length:
-                        ivs = transcript_to_genome_iv(
-                            start, idx - 1, intervals, reverse
-                        )
-                        seq = merged_seq[start:idx]
-                        leader = merged_seq[:start]
-                        trailer = merged_seq[idx + 3 :]
-                        if ivs:
-                            orfs.append((ivs, seq, leader, trailer))
-                    if longest:
-                        break
-                starts = []
+    starts, stops = scan_orfs(
+        merged_seq, start_codons, stop_codons, min_orf_length, longest
+    )
+    mapper = TranscriptCoordinateMapper(intervals, reverse)
+    orf_ivs = mapper.map_intervals(starts, stops - 1)
+    leader = trailer = None
+    for start, idx, ivs in zip(starts.tolist(), stops.tolist(), orf_ivs):
+        if ivs:
+            seq = merged_seq[start:idx]
+            if flanks:
+                leader = merged_seq[:start]
+                trailer = merged_seq[idx + 3 :]
+            orfs.append((ivs, seq, leader, trailer))
     return orfs
 
 
-def check_orf_type(orf, cds_orfs):
+def _init_search_worker(fasta_location):
+    """Open a fasta handle for the worker process"""
+    global _worker_fasta
+    _worker_fasta = FastaReader(fasta_location)
+
+
+def _search_batch(args):
+    """Search the ORFs of a batch of transcripts in a worker process
+
+    Parameters
+    ----------
+    args: tuple
+          (batch, min_orf_length, start_codons, stop_codons, longest),
+          batch being a list of (transcript id, List[Interval])
+
+    Returns
+    -------
+    results: list
+             list of (transcript id, list of (List[Interval], start codon))
+    """
+    batch, min_orf_length, start_codons, stop_codons, longest = args
+    results = []
+    for tid, ivs in batch:
+        orfs = search_orfs(
+            _worker_fasta, ivs, min_orf_length, start_codons, stop_codons, longest
+        )
+        results.append((tid, [(orf_ivs, seq[:3]) for orf_ivs, seq, _, _ in orfs]))
+    return results
+
+
+def transcript_batches(gtf, transcripts=None, batch_size=TRANSCRIPTS_PER_BATCH):
+    """Split the transcripts into chromosome-local batches
+
+    Batches hold consecutive transcripts of the same chromosome, so
+    concatenating them gives back the order of the transcripts.
+
+    Parameters
+    ----------
+    gtf: GTFReader
+         instance of GTFReader
+    transcripts: list
+                 ids of the transcripts to split, all of gtf.transcript if None
+    batch_size: int
+                maximum number of transcripts in a batch
+
+    Returns
+    -------
+    batches: list
+             list of batches, each a list of (transcript id, List[Interval])
     """
+    batches = []
+    batch = []
+    batch_chrom = None
+    if transcripts is None:
+        transcripts = gtf.transcript
+    for tid in transcripts:
+        tracks = gtf.transcript[tid]
+        chrom = tracks[0].chrom
+        if batch and (chrom != batch_chrom or len(batch) >= batch_size):
+            batches.append(batch)
+            batch = []
+        batch_chrom = chrom
+        batch.append((tid, tracks_to_ivs(tracks)))
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def transcript_orfs(
+    gtf,
+    fasta,
+    min_orf_length,
+    start_codons,
+    stop_codons,
+    longest,
+    threads=1,
+    transcripts=None,
+):
+    """Search the ORFs of transcripts
+
     Parameters
     ----------
-    orf: GTFReader
+    gtf: GTFReader
          instance of GTFReader
-    cds_orfs: FastaReader
+    fasta: FastaReader
            instance of FastaReader
+    min_orf_length: int
+                    minimum length (nts) of ORF to include
+    start_codons: set
+                  set of start codons
+    stop_codons: set
+                 set of stop codons
+    longest: bool
+             whether to choose the most upstream start codon when multiple in
+             frame ones exist
+    threads: int
+             number of worker processes, each with its own fasta handle
+    transcripts: list
+                 ids of the transcripts to search, all of gtf.transcript if None
+
+    Returns
+    -------
+    orfs: generator
+          (transcript id, list of (List[Interval], start codon)) in the
+          order of the transcripts, whatever the number of processes
+    """
+    if transcripts is None:
+        transcripts = list(gtf.transcript)
+    if threads == 1:
+        for tid in transcripts:
+            ivs = tracks_to_ivs(gtf.transcript[tid])
+            orfs = search_orfs(
+                fasta, ivs, min_orf_length, start_codons, stop_codons, longest
+            )
+            yield tid, [(orf_ivs, seq[:3]) for orf_ivs, seq, _, _ in orfs]
+        return
+    args = [
+        (batch, min_orf_length, start_codons, stop_codons, longest)
+        for batch in transcript_batches(gtf, transcripts)
+    ]
+    with Pool(threads, _init_search_worker, (fasta.fasta_location,)) as pool:
+        # imap returns the batches in order
+        for results in pool.imap(_search_batch, args):
+            yield from results
+
+
+# ORF types decided by the position of an ORF relative to the gene span
+# and to the CDS of its transcript, in the order they are tested.
+# ORFs on the - strand get the upstream and downstream types swapped
+POSITION_TYPES = {
+    "+": ["super_uORF", "super_dORF", "uORF", "overlap_uORF", "dORF", "overlap_dORF"],
+    "-": ["super_dORF", "super_uORF", "dORF", "overlap_dORF", "uORF", "overlap_uORF"],
+}
+
+
+class ORFClassifier:
+    """Index of the annotated CDS used to assign candidate ORF types.
+
+    The span of each gene (from its most upstream to its most
+    downstream CDS) and the boundaries of the CDS of each transcript
+    are computed once, so that classifying an ORF only takes a few
+    comparisons.
+    """
+
+    def __init__(self, cds_orfs):
+        """
+        Parameters
+        ----------
+        cds_orfs: dict
+                  annotated ORFs, keyed by gene id and transcript id
+        """
+        self.gene_spans = {}
+        self.cds = {}
+        for gid, gene_cds in cds_orfs.items():
+            if not gene_cds:
+                continue
+            self.gene_spans[gid] = (
+                min(cds.intervals[0].start for cds in gene_cds.values()),
+                max(cds.intervals[-1].end for cds in gene_cds.values()),
+            )
+            for tid, cds in gene_cds.items():
+                self.cds[gid, tid] = (
+                    cds.intervals[0].start,
+                    cds.intervals[-1].end,
+                    cds.intervals,
+                )
+
+    def classify(self, orf):
+        """Type of a candidate ORF
+
+        Parameters
+        ----------
+        orf: ORF
+             instance of ORF
+
+        Returns
+        -------
+        otype: str
+               Type of the candidate ORF
+        """
+        otypes = self.classify_transcript(orf.gid, orf.tid, orf.strand, [orf.intervals])
+        return otypes[0]
+
+    def classify_transcript(self, gid, tid, strand, orf_intervals):
+        """Types of the candidate ORFs of a transcript
+
+        Parameters
+        ----------
+        gid: str
+             gene id
+        tid: str
+             transcript id
+        strand: str
+                strand of the transcript
+        orf_intervals: List[List[Interval]]
+                       intervals of each ORF, sorted by start
+
+        Returns
+        -------
+        otypes: list of str
+                Type of each candidate ORF
+        """
+        cds = self.cds.get((gid, tid))
+        if cds is None:
+            return ["novel"] * len(orf_intervals)
+        gene_start, gene_end = self.gene_spans[gid]
+        cds_start, cds_end, cds_intervals = cds
+        starts = np.array([ivs[0].start for ivs in orf_intervals], dtype=np.int64)
+        ends = np.array([ivs[-1].end for ivs in orf_intervals], dtype=np.int64)
+        conditions = [
+            ends < gene_start,
+            starts > gene_end,
+            (starts < cds_start) & (ends < cds_start),
+            (starts < cds_start) & (ends < cds_end),
+            (ends > cds_end) & (starts > cds_end),
+            (ends > cds_end) & (starts > cds_start),
+        ]
+        position_types = POSITION_TYPES["+" if strand == "+" else "-"]
+        otypes = np.select(conditions, position_types, "internal").tolist()
+        # only ORFs with the boundaries of the CDS can be the CDS itself
+        for i in np.flatnonzero((starts == cds_start) & (ends == cds_end)).tolist():
+            if orf_intervals[i] == cds_intervals:
+                otypes[i] = "annotated"
+        return otypes
+
+
+def check_orf_type(orf, cds_orfs):
+    """
+    Parameters
+    ----------
+    orf: ORF
+         instance of ORF
+    cds_orfs: dict or ORFClassifier
+              annotated ORFs, keyed by gene id and transcript id,
+              or a classifier built from them
 
     Returns
     -------
     otype: str
            Type of the candidate ORF
+    """
+    if not isinstance(cds_orfs, ORFClassifier):
+        cds_orfs = ORFClassifier(cds_orfs)
+    return cds_orfs.classify(orf)
+
 
-    This method uses a fail-sast strategy 
-    and hence multiple returns. 
+def manifest_path(ribotricer_index):
+    """Path of the manifest written next to a tsv index"""
+    return "{}.manifest".format(ribotricer_index)
+
+
+def transcript_digests(gtf, fasta, cds_orfs):
+    """Checksum of everything the candidate ORFs of a transcript depend on
+
+    This covers the exons, attributes and sequence of the transcript,
+    and the annotated CDS of its gene, which decide the type of its ORFs.
+    The sequence is the one searched for ORFs, so edits of the genome
+    outside of the exons keep the checksum.
+
+    Parameters
+    ----------
+    gtf: GTFReader
+         instance of GTFReader
+    fasta: FastaReader
+           instance of FastaReader
+    cds_orfs: dict
+              annotated ORFs, keyed by gene id and transcript id
+
+    Returns
+    -------
+    digests: dict
+             key is the transcript id, value is the checksum
     """
-    if orf.gid not in cds_orfs:
-        return "novel"
-    if orf.tid not in cds_orfs[orf.gid]:
-        return "novel"
-    matched_cds = cds_orfs[orf.gid][orf.tid]
-    if orf.intervals == matched_cds.intervals:
-        return "annotated"
-    gene_cds = [cds_orfs[orf.gid][tid] for tid in cds_orfs[orf.gid]]
-    gene_start = min([gc.intervals[0].start for gc in gene_cds])
-    gene_end = max([gc.intervals[-1].end for gc in gene_cds])
-    if orf.intervals[-1].end < gene_start:
-        return "super_uORF" if orf.strand == "+" else "super_dORF"
-    if orf.intervals[0].start > gene_end:
-        return "super_dORF" if orf.strand == "+" else "super_uORF"
-    if orf.intervals[0].start < matched_cds.intervals[0].start:
-        if orf.intervals[-1].end < matched_cds.intervals[0].start:
-            return "uORF" if orf.strand == "+" else "dORF"
-        if orf.intervals[-1].end < matched_cds.intervals[-1].end:
-            return "overlap_uORF" if orf.strand == "+" else "overlap_dORF"
-    if orf.intervals[-1].end > matched_cds.intervals[-1].end:
-        if orf.intervals[0].start > matched_cds.intervals[-1].end:
-            return "dORF" if orf.strand == "+" else "uORF"
-        if orf.intervals[0].start > matched_cds.intervals[0].start:
-            return "overlap_dORF" if orf.strand == "+" else "overlap_uORF"
-    return "internal"
+    gene_digests = {}
+    digests = {}
+    for tid, tracks in gtf.transcript.items():
+        track = tracks[0]
+        sequence_digest = None
+        if track.chrom in fasta.chrom_lengths:
+            # the merged exons, as fetched by search_orfs
+            sequence = "".join(fasta.query(tracks_to_ivs(tracks)))
+            sequence_digest = hashlib.md5(sequence.encode()).hexdigest()
+        gid = track.gene_id
+        if gid not in gene_digests:
+            gene_cds = cds_orfs.get(gid, {})
+            gene_digests[gid] = sorted(
+                (cds_tid, [(iv.start, iv.end) for iv in cds.intervals])
+                for cds_tid, cds in gene_cds.items()
+            )
+        content = (
+            [(t.chrom, t.start, t.end, t.strand) for t in tracks],
+            track.transcript_type,
+            gid,
+            track.gene_name,
+            track.gene_type,
+            sequence_digest,
+            gene_digests[gid],
+        )
+        digests[tid] = hashlib.md5(repr(content).encode()).hexdigest()
+    return digests
+
+
+def write_manifest(ribotricer_index, parameters, digests, checksum):
+    """Save the parameters and transcript checksums of a prepare-orfs run
+
+    Parameters
+    ----------
+    ribotricer_index: str
+                      Path to the tsv index, which must already be written
+    parameters: dict
+                parameters of the ORF search
+    digests: dict
+             output of transcript_digests
+    checksum: str
+              checksum of the content of the index, see index_checksum
+    """
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "index": checksum,
+        "parameters": parameters,
+        "transcripts": digests,
+    }
+    with open(manifest_path(ribotricer_index), "w") as output:
+        json.dump(manifest, output)
+
+
+def load_previous_index(ribotricer_index, parameters):
+    """Candidate ORFs and transcript checksums of an earlier run
+
+    Parameters
+    ----------
+    ribotricer_index: str
+                      Path to the tsv index of the earlier run
+    parameters: dict
+                parameters of the current ORF search
+
+    Returns
+    -------
+    previous: tuple
+              (digests, orfs, rows) where digests are the transcript
+              checksums of the earlier run, orfs is an ORFTable and rows
+              maps a transcript id to the rows of its searched ORFs.
+              None if the earlier run cannot be reused.
+    """
+    path = manifest_path(ribotricer_index)
+    if not os.path.isfile(path):
+        print("no manifest found for {}, processing all transcripts".format(path))
+        return None
+    with open(path) as manifest:
+        manifest = json.load(manifest)
+    if (
+        manifest["version"] != MANIFEST_VERSION
+        or manifest["index"] != index_checksum(ribotricer_index)
+        or manifest["parameters"] != parameters
+    ):
+        print(
+            "{} does not match the previous index or the parameters, {}".format(
+                path, "processing all transcripts"
+            )
+        )
+        return None
+    orfs = read_orf_table(ribotricer_index)
+    # annotated ORFs come from the CDS, the others from searching transcripts
+    searched = np.flatnonzero(~orfs.isin("category", ["annotated"]))
+    tid_codes, tids = orfs.column("transcript_id")
+    codes = tid_codes[searched]
+    order = np.argsort(codes, kind="stable")
+    groups = np.split(searched[order], np.flatnonzero(np.diff(codes[order])) + 1)
+    rows = {tids[tid_codes[group[0]]]: group.tolist() for group in groups if len(group)}
+    return manifest["transcripts"], orfs, rows
 
 
 def prepare_orfs(
-    gtf, fasta, prefix, min_orf_length, start_codons, stop_codons, longest
+    gtf,
+    fasta,
+    prefix,
+    min_orf_length,
+    start_codons,
+    stop_codons,
+    longest,
+    threads=1,
+    previous_index=None,
+    bgzip=False,
 ):
     """
     Parameters
@@ -277,105 +673,107 @@ def prepare_orfs(
     longest: bool
              whether to choose the most upstream start codon when multiple in
              frame ones exist
+    threads: int
+             number of processes used for searching ORFs
+    previous_index: str
+                    Path to the index of an earlier run, whose ORFs are
+                    reused for the transcripts that did not change
+    bgzip: bool
+           whether to compress the index with bgzip
     """
 
     now = datetime.datetime.now()
     print(now.strftime("%b %d %H:%M:%S ..... started ribotricer prepare-orfs"))
     now = datetime.datetime.now()
     print(now.strftime("%b %d %H:%M:%S ... starting to parse GTF file"))
-    candidate_orfs = []
+    parameters = {
+        "min_orf_length": min_orf_length,
+        "start_codons": sorted(start_codons),
+        "stop_codons": sorted(stop_codons),
+        "longest": longest,
+    }
+    previous = None
+    if previous_index is not None:
+        previous = load_previous_index(previous_index, parameters)
     if not isinstance(gtf, GTFReader):
         gtf = GTFReader(gtf)
     if not isinstance(fasta, FastaReader):
         fasta = FastaReader(fasta)
 
-    # process CDS gtf
-    now = datetime.datetime.now()
-    print(now.strftime("%b %d %H:%M:%S ... starting extracting annotated ORFs"))
-    cds_orfs = defaultdict(lambda: defaultdict(ORF))
-    for gid in tqdm(gtf.cds, unit="lines", leave=False):
-        for tid in gtf.cds[gid]:
-            tracks = gtf.cds[gid][tid]
-            seq = fetch_seq(fasta, tracks)
-            orf = ORF.from_tracks(tracks, "annotated", seq=seq[:3])
-            if orf:
-                cds_orfs[gid][tid] = orf
-                candidate_orfs.append(orf)
+    # ORFs are written as they are produced, annotated ones first,
+    # to the tsv and binary indexes
+    ribotricer_index = "{}_candidate_orfs.tsv".format(prefix)
+    if bgzip:
+        ribotricer_index += ".gz"
+    with ORFWriter(ribotricer_index, bgzip, binary=True) as writer:
+        # process CDS gtf
+        now = datetime.datetime.now()
+        print(now.strftime("%b %d %H:%M:%S ... starting extracting annotated ORFs"))
+        cds_orfs = defaultdict(lambda: defaultdict(ORF))
+        for gid in tqdm(gtf.cds, unit="lines", leave=False):
+            for tid in gtf.cds[gid]:
+                tracks = gtf.cds[gid][tid]
+                seq = fetch_seq(fasta, tracks)
+                orf = ORF.from_tracks(tracks, "annotated", seq=seq[:3])
+                if orf:
+                    cds_orfs[gid][tid] = orf
+                    writer.write(orf)
 
-    now = datetime.datetime.now()
-    print(
-        "{} ... {}".format(
-            now.strftime("%b %d %H:%M:%S"),
-            "starting searching transcriptome-wide ORFs. This may take a long time...",
-        )
-    )
-    for tid in tqdm(gtf.transcript, unit="transcripts", leave=False):
-        tracks = gtf.transcript[tid]
-        ttype = tracks[0].transcript_type
-        gid = tracks[0].gene_id
-        gname = tracks[0].gene_name
-        gtype = tracks[0].gene_type
-        chrom = tracks[0].chrom
-        strand = tracks[0].strand
-        ivs = tracks_to_ivs(tracks)
-        orfs = search_orfs(
-            fasta, ivs, min_orf_length, start_codons, stop_codons, longest
-        )
-        for ivs, seq, leader, trailer in orfs:
-            orf = ORF(
-                "unknown",
-                tid,
-                ttype,
-                gid,
-                gname,
-                gtype,
-                chrom,
-                strand,
-                ivs,
-                seq=seq[:3],
+        now = datetime.datetime.now()
+        print(
+            "{} ... {}".format(
+                now.strftime("%b %d %H:%M:%S"),
+                "starting searching transcriptome-wide ORFs. This may take a long time...",
             )
-            orf.category = check_orf_type(orf, cds_orfs)
-            if orf.category != "annotated" and orf.category != "internal":
-                candidate_orfs.append(orf)
-
-    # save to file
-    now = datetime.datetime.now()
-    print(now.strftime("%b %d %H:%M:%S ... saving candidate ORFs into disk"))
-    columns = [
-        "ORF_ID",
-        "ORF_type",
-        "transcript_id",
-        "transcript_type",
-        "gene_id",
-        "gene_name",
-        "gene_type",
-        "chrom",
-        "strand",
-        "start_codon",
-        "coordinate\n",
-    ]
-
-    to_write = "\t".join(columns)
-    formatter = "{}\t" * (len(columns) - 1) + "{}\n"
-    for orf in tqdm(candidate_orfs, unit="ORFs"):
-        coordinate = ",".join(
-            ["{}-{}".format(iv.start, iv.end) for iv in orf.intervals]
         )
-        to_write += formatter.format(
-            orf.oid,
-            orf.category,
-            orf.tid,
-            orf.ttype,
-            orf.gid,
-            orf.gname,
-            orf.gtype,
-            orf.chrom,
-            orf.strand,
-            orf.start_codon,
-            coordinate,
+        digests = transcript_digests(gtf, fasta, cds_orfs)
+        classifier = ORFClassifier(cds_orfs)
+        reused = set()
+        if previous is not None:
+            previous_digests, previous_orfs, previous_rows = previous
+            reused = {
+                tid
+                for tid in gtf.transcript
+                if previous_digests.get(tid) == digests[tid]
+            }
+            print(
+                "reusing the ORFs of {} out of {} transcripts".format(
+                    len(reused), len(gtf.transcript)
+                )
+            )
+        orfs_by_transcript = transcript_orfs(
+            gtf,
+            fasta,
+            min_orf_length,
+            start_codons,
+            stop_codons,
+            longest,
+            threads,
+            [tid for tid in gtf.transcript if tid not in reused],
         )
+        for tid in tqdm(gtf.transcript, unit="transcripts", leave=False):
+            if tid in reused:
+                for row in previous_rows.get(tid, []):
+                    writer.write(previous_orfs[row])
+                continue
+            _, orfs = next(orfs_by_transcript)
+            tracks = gtf.transcript[tid]
+            ttype = tracks[0].transcript_type
+            gid = tracks[0].gene_id
+            gname = tracks[0].gene_name
+            gtype = tracks[0].gene_type
+            chrom = tracks[0].chrom
+            strand = tracks[0].strand
+            otypes = classifier.classify_transcript(
+                gid, tid, strand, [ivs for ivs, _ in orfs]
+            )
+            for (ivs, seq), otype in zip(orfs, otypes):
+                if otype != "annotated" and otype != "internal":
+                    orf = ORF(
+                        otype, tid, ttype, gid, gname, gtype, chrom, strand, ivs, seq
+                    )
+                    writer.write(orf)
 
-    with open("{}_candidate_orfs.tsv".format(prefix), "w") as output:
-        output.write(to_write)
+    write_manifest(ribotricer_index, parameters, digests, writer.checksum.hexdigest())
     now = datetime.datetime.now()
     print(now.strftime("%b %d %H:%M:%S ... finished ribotricer prepare-orfs"))
@@ -0,0 +1,173 @@
+"""Split a ribotricer index into shards scored separately"""
+# Part of ribotricer software
+#
+# Copyright (C) 2019 Saket Choudhary, Wenzheng Li, and Andrew D Smith
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+import heapq
+import os
+
+import numpy as np
+
+from .common import is_gzipped
+from .common import open_file
+from .orf_index import ORFWriter
+from .orf_index import read_orf_table
+
+
+def shard_index_path(ribotricer_index, shard, n_shards):
+    """Path of a shard of a tsv index
+
+    Parameters
+    ----------
+    ribotricer_index: str
+                      Path to the tsv index
+    shard: int
+           number of the shard, from 1 to n_shards
+    n_shards: int
+              number of shards
+
+    Returns
+    -------
+    path: str
+          such as prefix_candidate_orfs.shard1of4.tsv for
+          prefix_candidate_orfs.tsv
+    """
+    root, gz = ribotricer_index, ""
+    if root.endswith(".gz"):
+        root, gz = root[: -len(".gz")], ".gz"
+    root, ext = os.path.splitext(root)
+    return "{}.shard{}of{}{}{}".format(root, shard, n_shards, ext, gz)
+
+
+def shard_rows(orfs, n_shards):
+    """Assign ORFs to shards covering consecutive chromosome ranges
+
+    ORFs are sorted by chromosome and start, and the sorted list is cut
+    into n_shards ranges of about the same total ORF length. ORFs with
+    the same chromosome and start are kept in the same shard.
+
+    Parameters
+    ----------
+    orfs: ORFTable
+          ORFs of the index
+    n_shards: int
+              number of shards
+
+    Returns
+    -------
+    shards: np.ndarray
+            shard of each row, from 0 to n_shards - 1
+    """
+    if len(orfs) == 0:
+        return np.zeros(0, dtype=np.int64)
+    offsets = orfs.array("exon_offsets")
+    lengths = np.add.reduceat(
+        orfs.array("exon_ends") - orfs.array("exon_starts") + 1, offsets[:-1]
+    )
+    starts = orfs.array("exon_starts")[offsets[:-1]]
+    chrom_codes, chroms = orfs.column("chrom")
+    # rank of each chromosome in the sorted chromosome names
+    chrom_ranks = np.argsort(np.argsort(chroms, kind="mergesort"))
+    order = np.lexsort((starts, chrom_ranks[chrom_codes]))
+    before = np.cumsum(lengths[order]) - lengths[order]
+    shards = before * n_shards // lengths.sum()
+    # ORFs starting at the same position follow the first of them
+    same_start = np.zeros(len(order), dtype=bool)
+    same_start[1:] = (starts[order][1:] == starts[order][:-1]) & (
+        chrom_codes[order][1:] == chrom_codes[order][:-1]
+    )
+    first = np.flatnonzero(~same_start)
+    shards = shards[first][np.cumsum(~same_start) - 1]
+    row_shards = np.empty(len(order), dtype=np.int64)
+    row_shards[order] = shards
+    return row_shards
+
+
+def shard_index(ribotricer_index, n_shards):
+    """Split an index into shards for detect-orfs --shard
+
+    Each shard is an index holding some of the ORFs, in their order in
+    the index, so annotated ORFs still come first. A shard is compressed
+    like the index and gets its own binary index.
+
+    Parameters
+    ----------
+    ribotricer_index: str
+                      Path to the tsv index generated by ribotricer prepare_orfs
+    n_shards: int
+              number of shards
+
+    Returns
+    -------
+    paths: list of str
+           paths of the shards
+    """
+    orfs = read_orf_table(ribotricer_index)
+    shards = shard_rows(orfs, n_shards)
+    paths = []
+    for shard in range(n_shards):
+        path = shard_index_path(ribotricer_index, shard + 1, n_shards)
+        rows = orfs.take(np.flatnonzero(shards == shard))
+        with ORFWriter(path, is_gzipped(ribotricer_index), binary=True) as writer:
+            for orf in rows:
+                writer.write(orf)
+        paths.append(path)
+        print("shard {} of {}: {} ORFs".format(shard + 1, n_shards, len(rows)))
+    return paths
+
+
+def _detected_lines(detected_orfs, ranks):
+    """Lines of a detect-orfs output with the row of their ORF in the index"""
+    with open_file(detected_orfs, "r") as detected:
+        # Skip header
+        detected.readline()
+        for line in detected:
+            oid = line[: line.index("\t")]
+            if oid not in ranks:
+                raise ValueError(
+                    "ORF {} of {} is not in the index".format(oid, detected_orfs)
+                )
+            yield ranks[oid], line
+
+
+def merge_detected(ribotricer_index, detected_orfs, out):
+    """Join the outputs of detect-orfs on shards of an index
+
+    Parameters
+    ----------
+    ribotricer_index: str
+                      Path to the tsv index that was sharded
+    detected_orfs: list of str
+                   Paths to the *_translating_ORFs.tsv of the shards
+    out: str
+         Path to the output file, with the ORFs in the order of
+         detect-orfs on the whole index
+    """
+    ranks = {}
+    with open_file(ribotricer_index, "r") as anno:
+        # Skip header
+        anno.readline()
+        for row, line in enumerate(anno):
+            ranks[line[: line.index("\t")]] = row
+    headers = set()
+    for path in detected_orfs:
+        with open_file(path, "r") as detected:
+            headers.add(detected.readline())
+    if len(headers) != 1:
+        raise ValueError("detected ORF files have different columns")
+    # each shard lists its ORFs in the order of the index
+    lines = heapq.merge(*[_detected_lines(path, ranks) for path in detected_orfs])
+    with open(out, "w") as output:
+        output.write(headers.pop())
+        for _, line in lines:
+            output.write(line)
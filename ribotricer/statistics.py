@@ -15,11 +15,13 @@
 # GNU General Public License for more details.
 
 from math import sin, cos, pi, sqrt
-import warnings
 
 import numpy as np
 from scipy import stats
-from scipy import signal
+
+# Sine constant of the radix-3 real FFT of scipy, which is one ulp
+# below sin(2 * pi / 3) as a double
+RFFT3_SIN = 0.8660254037844386467637231707529362
 
 
 def phasescore(profile):
@@ -94,6 +96,130 @@ def pvalue(x, N):
     return stats.ncx2.sf(x, df, nc)
 
 
+def _periodic_component(segments):
+    """DFT at a third of the sampling rate of detrended 3-nt segments
+
+    This is the second bin of the real FFT, computed with the
+    operations and constants of the radix-3 butterfly used by scipy.
+
+    Parameters
+    ----------
+    segments: np.ndarray
+              one segment per row
+
+    Returns
+    -------
+    component: np.ndarray
+               complex value for each segment
+    """
+    detrended = segments - np.mean(segments, -1, keepdims=True)
+    component = np.empty(len(segments), dtype=np.complex128)
+    component.real = detrended[:, 0] + -0.5 * (detrended[:, 1] + detrended[:, 2])
+    component.imag = RFFT3_SIN * (detrended[:, 2] - detrended[:, 1])
+    return component
+
+
+def phase_scores(profiles, lengths=None):
+    """Coherence of many profiles with an ideal 1-0-0 signal
+
+    This computes the values of coherence for all profiles at once.
+    With 3-nt segments, the coherence at a third of the sampling rate
+    only depends on one DFT value per codon, so the calls to
+    scipy.signal.coherence are replaced by sums over codons. The
+    order of the operations is the one of scipy, so the results
+    are the same as those of coherence.
+
+    Parameters
+    ----------
+    profiles: list of array like or np.ndarray
+              profiles of any length, or a 2D array with one
+              profile per row, padded up to the longest one
+    lengths: array like
+             length of each row of a 2D array, all of its width if None
+
+    Returns
+    -------
+    coh: np.ndarray
+         phase score of each profile
+    valid: np.ndarray
+           number of valid codons of each profile
+    """
+    if isinstance(profiles, np.ndarray) and profiles.ndim == 2:
+        n_profiles, width = profiles.shape
+        values = profiles.astype(np.float64).ravel()
+        offsets = np.arange(n_profiles, dtype=np.int64) * width
+        if lengths is None:
+            lengths = np.full(n_profiles, width, dtype=np.int64)
+        lengths = np.asarray(lengths, dtype=np.int64)
+    else:
+        n_profiles = len(profiles)
+        lengths = np.array([len(profile) for profile in profiles], dtype=np.int64)
+        values = np.zeros(lengths.sum(), dtype=np.float64)
+        offsets = np.cumsum(lengths) - lengths
+        for offset, length, profile in zip(
+            offsets.tolist(), lengths.tolist(), profiles
+        ):
+            values[offset : offset + length] = profile
+
+    coh = np.zeros(n_profiles)
+    valid = np.full(n_profiles, -1, dtype=np.int64)
+    # spectral density scaling of scipy for a flat window of 3 points,
+    # doubled for one-sided spectra
+    scale = 1.0 / 3.0
+    uniform = _periodic_component(np.array([[1.0, 0.0, 0.0]]))
+    uniform_power = ((np.conjugate(uniform) * uniform * scale) * 2).real[0]
+    for frame in [0, 1, 2]:
+        n_codons = np.maximum(lengths - frame, 0) // 3
+        # first position of each codon
+        starts = np.repeat(
+            offsets + frame - 3 * (np.cumsum(n_codons) - n_codons), n_codons
+        ) + 3 * np.arange(n_codons.sum())
+        codons = np.stack((values[starts], values[starts + 1], values[starts + 2]), 1)
+        nonempty = codons.any(axis=1)
+        codons = codons[nonempty]
+        owners = np.repeat(np.arange(n_profiles), n_codons)[nonempty]
+        counts = np.bincount(owners, minlength=n_profiles)
+
+        # normalize each codon by its periodic component
+        real = (
+            codons[:, 0]
+            + codons[:, 1] * cos(2 * pi / 3)
+            + codons[:, 2] * cos(4 * pi / 3)
+        )
+        image = codons[:, 1] * sin(2 * pi / 3) + codons[:, 2] * sin(4 * pi / 3)
+        norm = np.sqrt(np.float_power(real, 2) + np.float_power(image, 2))
+        norm[norm == 0] = 1
+        component = _periodic_component(codons / norm[:, np.newaxis])
+
+        # cross and auto spectral densities, averaged over the codons
+        # of each profile in order
+        cross = (np.conjugate(component) * uniform * scale) * 2
+        power = ((np.conjugate(component) * component * scale) * 2).real
+        cross_sum = np.empty(n_profiles, dtype=np.complex128)
+        cross_sum.real = np.bincount(owners, cross.real, n_profiles)
+        cross_sum.imag = np.bincount(owners, cross.imag, n_profiles)
+        uniform_sum = np.bincount(
+            owners, np.full(len(owners), uniform_power), n_profiles
+        )
+        with np.errstate(divide="ignore", invalid="ignore"):
+            cxy = (
+                np.abs(cross_sum / counts) ** 2
+                / (np.bincount(owners, power, n_profiles) / counts)
+                / (uniform_sum / counts)
+            )
+
+        empty = counts == 0
+        better = ~empty & (cxy > coh)
+        coh[better] = cxy[better]
+        valid[better] = counts[better]
+        first = ~empty & (valid == -1)
+        valid[first] = counts[first]
+        # a frame without valid codons resets the score
+        coh[empty] = 0.0
+        valid[empty] = 0
+    return np.sqrt(coh), valid
+
+
 def coherence(original_values):
     """Calculate coherence with an idea ribo-seq signal,
     this function is equivalent to phasescore implemented
@@ -115,52 +241,5 @@ def coherence(original_values):
            number of valid codons used for calculation
 
     """
-    coh, valid = 0.0, -1
-    for frame in [0, 1, 2]:
-        values = original_values[frame:]
-        normalized_values = []
-        i = 0
-        while i + 2 < len(values):
-            if values[i] == values[i + 1] == values[i + 2] == 0:
-                i += 3
-            else:
-                real = (
-                    values[i]
-                    + values[i + 1] * cos(2 * pi / 3)
-                    + values[i + 2] * cos(4 * pi / 3)
-                )
-                image = values[i + 1] * sin(2 * pi / 3) + values[i + 2] * sin(
-                    4 * pi / 3
-                )
-                norm = sqrt(real ** 2 + image ** 2)
-                if norm == 0:
-                    norm = 1
-                normalized_values += [
-                    values[i] / norm,
-                    values[i + 1] / norm,
-                    values[i + 2] / norm,
-                ]
-                i += 3
-
-        length = len(normalized_values) // 3 * 3
-        if length == 0:
-            coh, valid = (0.0, 0)
-        else:
-            normalized_values = normalized_values[:length]
-            uniform_signal = [1, 0, 0] * (len(normalized_values) // 3)
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")
-                f, Cxy = signal.coherence(
-                    normalized_values,
-                    uniform_signal,
-                    window=[1.0, 1.0, 1.0],
-                    nperseg=3,
-                    noverlap=0,
-                )
-                periodicity_score = Cxy[np.argwhere(np.isclose(f, 1 / 3.0))[0]][0]
-                if periodicity_score > coh:
-                    coh = periodicity_score
-                    valid = length // 3
-                if valid == -1:
-                    valid = length // 3
-    return np.sqrt(coh), valid
+    coh, valid = phase_scores([original_values])
+    return coh[0], int(valid[0])
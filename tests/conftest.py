@@ -0,0 +1,83 @@
+"""Fixtures shared by the tests"""
+
+import os
+
+import numpy as np
+import pytest
+
+from ribotricer.coverage import CoverageStore
+from ribotricer.interval import Interval
+from ribotricer.orf import ORF
+from ribotricer.orf_index import ORFWriter
+from ribotricer.orf_index import write_orf_index
+
+
+def make_orf(category, tid, chrom, strand, exons, seq="ATG"):
+    """ORF of a transcript tid spanning exons, a list of (start, end)"""
+    intervals = [Interval(chrom, start, end, strand) for start, end in exons]
+    return ORF(
+        category,
+        tid,
+        "protein_coding",
+        "G" + tid,
+        "gene" + tid,
+        "protein_coding",
+        chrom,
+        strand,
+        intervals,
+        seq=seq,
+    )
+
+
+@pytest.fixture
+def index_orfs():
+    """ORFs of a small index, annotated ones first"""
+    return [
+        make_orf("annotated", "T1", "chr1", "+", [(100, 111), (200, 208)]),
+        make_orf("annotated", "T2", "chr2", "-", [(50, 79)]),
+        make_orf("uORF", "T1", "chr1", "+", [(40, 48)], seq="CTG"),
+        make_orf("uORF", "T3", "chr1", "+", [(40, 48)], seq="CTG"),
+        make_orf("dORF", "T2", "chr2", "-", [(10, 30)], seq="GTG"),
+        make_orf("novel", "T4", "chrM", "+", [(1, 6), (9, 17), (30, 35)]),
+    ]
+
+
+def write_index(orfs, path, bgzip=False, binary=True):
+    """Write a tsv index, and its binary index if requested"""
+    with ORFWriter(path, bgzip) as writer:
+        for orf in orfs:
+            writer.write(orf)
+    if binary:
+        write_orf_index(orfs, path)
+    return path
+
+
+@pytest.fixture
+def index_path(tmp_path, index_orfs):
+    """tsv index of index_orfs with its binary index"""
+    return write_index(index_orfs, os.path.join(str(tmp_path), "candidate_orfs.tsv"))
+
+
+@pytest.fixture
+def coverage():
+    """Merged coverage, periodic on the + strand"""
+    rng = np.random.RandomState(1)
+    merged = CoverageStore(["chr1", "chr2", "chrM"])
+    for chrom in ["chr1", "chr2", "chrM"]:
+        positions = np.arange(1, 2000)
+        counts = rng.poisson(np.where(positions % 3 == 1, 6.0, 0.5))
+        merged.add_counts(chrom, "+", None, positions[counts > 0], counts[counts > 0])
+        counts = rng.poisson(1.0, len(positions))
+        merged.add_counts(chrom, "-", None, positions[counts > 0], counts[counts > 0])
+    return merged
+
+
+@pytest.fixture
+def scored_index(tmp_path, index_orfs):
+    """Index with ORFs of several transcripts covering the same exons"""
+    orfs = list(index_orfs)
+    for i in range(40):
+        exons = [(10 + 30 * (i % 7), 39 + 30 * (i % 7)), (700, 730 + 3 * (i % 5))]
+        orfs.append(make_orf("novel", "N{}".format(i), "chr1", "+", exons))
+        orfs.append(make_orf("uORF", "U{}".format(i), "chr2", "-", exons[:1]))
+    return write_index(orfs, str(tmp_path / "candidate_orfs.tsv"))
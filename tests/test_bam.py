@@ -0,0 +1,90 @@
+"""Tests for reading alignments"""
+
+import pysam
+import pytest
+
+from ribotricer.bam import count_reads
+from ribotricer.bam import decode_reads
+from ribotricer.common import ReadFilter
+from ribotricer.coverage import CoverageStore
+
+CIGARS = [
+    "30M",
+    "5S25M",
+    "10M100N20M",
+    "28M2D",
+    "2S26M3N",
+    "1D29M",
+    "4N10M2I16M1D2S",
+    "10M5D5M1I14M10N",
+]
+
+
+@pytest.fixture
+def header():
+    return pysam.AlignmentHeader.from_dict(
+        {"SQ": [{"SN": "chr1", "LN": 10000}, {"SN": "chr2", "LN": 10000}]}
+    )
+
+
+def make_read(header, name, cigar, start, reverse=False, flag=0):
+    read = pysam.AlignedSegment(header)
+    read.query_name = name
+    read.reference_id = 0
+    read.reference_start = start
+    read.cigarstring = cigar
+    read.query_sequence = "A" * read.infer_query_length()
+    read.flag = flag | (16 if reverse else 0)
+    read.mapping_quality = 255
+    read.set_tag("NH", 1)
+    return read
+
+
+def test_decode_reads_aligned_positions(header):
+    reads = [
+        make_read(header, "r{}".format(i), cigar, 100 + i, reverse=i % 2 == 1)
+        for i, cigar in enumerate(CIGARS)
+    ]
+    (block,) = decode_reads(reads, ReadFilter())
+    for i, read in enumerate(reads):
+        positions = read.get_reference_positions()
+        assert block["start"][i] == read.reference_start
+        assert block["first"][i] == positions[0]
+        assert block["end"][i] == positions[-1]
+        assert block["length"][i] == len(positions)
+
+
+def test_decode_reads_filtered(header):
+    reads = [make_read(header, "dup", "28M2D", 100, flag=1024)]
+    (block,) = decode_reads(reads, ReadFilter())
+    assert block["end"].tolist() == [-1]
+    assert block["length"].tolist() == [0]
+
+
+@pytest.mark.parametrize("protocol", ["forward", "reverse"])
+def test_count_reads_five_prime_ends(header, protocol):
+    reads = [
+        make_read(header, "r{}".format(i), cigar, 100 + 7 * i, reverse=reverse)
+        for i, cigar in enumerate(CIGARS)
+        for reverse in (False, True)
+    ]
+    alignments, read_length_counts, filter_counts = count_reads(
+        reads, CoverageStore(["chr1", "chr2"]), protocol, ReadFilter()
+    )
+    assert filter_counts["valid"] == len(reads)
+    expected = {}
+    for read in reads:
+        positions = read.get_reference_positions()
+        minus = read.is_reverse == (protocol == "forward")
+        # one-based 5' end
+        pos = (positions[-1] if minus else positions[0]) + 1
+        key = (len(positions), "-" if minus else "+", pos)
+        expected[key] = expected.get(key, 0) + 1
+    assert sum(read_length_counts.values()) == len(reads)
+    counted = {}
+    for length in read_length_counts:
+        for strand in ("+", "-"):
+            positions, counts = alignments.track("chr1", strand, length)
+            for pos, count in zip(positions.tolist(), counts.tolist()):
+                counted[(length, strand, pos)] = count
+    assert counted == expected
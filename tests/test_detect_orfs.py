@@ -0,0 +1,49 @@
+"""Tests for scoring the ORFs of an index"""
+
+import os
+import shutil
+
+import pytest
+
+from ribotricer import detect_orfs
+from ribotricer.detect_orfs import export_orf_coverages
+from ribotricer.orf_index import binary_index_path
+
+
+def score(index, coverage, tmp_path, name, **kwargs):
+    prefix = str(tmp_path / name)
+    export_orf_coverages(index, coverage, prefix, report_all=True, **kwargs)
+    with open("{}_translating_ORFs.tsv".format(prefix)) as output:
+        return output.read()
+
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(detect_orfs, "SCORE_CHUNK_SIZE", 3)
+
+
+def test_processes_give_the_same_output(scored_index, coverage, tmp_path):
+    expected = score(scored_index, coverage, tmp_path, "serial")
+    assert len(expected.splitlines()) == 87
+    assert score(scored_index, coverage, tmp_path, "pool", threads=3) == expected
+
+
+def test_single_process_without_fork(scored_index, coverage, tmp_path, monkeypatch):
+    expected = score(scored_index, coverage, tmp_path, "serial")
+
+    def get_context(method=None):
+        raise AssertionError("pool created")
+
+    monkeypatch.setattr(
+        detect_orfs.multiprocessing, "get_all_start_methods", lambda: ["spawn"]
+    )
+    monkeypatch.setattr(detect_orfs.multiprocessing, "get_context", get_context)
+    assert score(scored_index, coverage, tmp_path, "spawn", threads=3) == expected
+
+
+@pytest.mark.parametrize("threads", [1, 2])
+def test_tsv_index_gives_the_same_output(scored_index, coverage, tmp_path, threads):
+    expected = score(scored_index, coverage, tmp_path, "binary")
+    shutil.rmtree(binary_index_path(scored_index))
+    assert not os.path.exists(binary_index_path(scored_index))
+    assert score(scored_index, coverage, tmp_path, "tsv", threads=threads) == expected
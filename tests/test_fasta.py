@@ -0,0 +1,58 @@
+"""Tests for querying sequences from a fasta file"""
+
+import pytest
+
+from ribotricer.fasta import FastaReader
+from ribotricer.interval import Interval
+
+
+@pytest.fixture
+def fasta_path(tmp_path):
+    """fasta file with three chromosomes of different sequences"""
+    sequences = {"chr1": "ACGT" * 250, "chr2": "AACC" * 250, "chr3": "GGTA" * 250}
+    path = str(tmp_path / "genome.fa")
+    with open(path, "w") as output:
+        for name, sequence in sequences.items():
+            output.write(">{}\n{}\n".format(name, sequence))
+    return path, sequences
+
+
+def count_reads(reader):
+    """Record the (chrom, start, end) of every read of the fasta file"""
+    reads = []
+    get_seq = reader.fasta.get_seq
+
+    def counting_get_seq(chrom, start, end):
+        reads.append((chrom, start, end))
+        return get_seq(chrom, start, end)
+
+    reader.fasta.get_seq = counting_get_seq
+    return reads
+
+
+@pytest.mark.parametrize("cache_size", [0, 1, 2])
+def test_interleaved_chromosomes_are_read_whole_once(fasta_path, cache_size):
+    path, sequences = fasta_path
+    reader = FastaReader(path, cache_size=cache_size)
+    reads = count_reads(reader)
+    # exons of transcripts in a GTF file not sorted by chromosome
+    queries = [
+        (chrom, start)
+        for start in range(1, 900, 100)
+        for chrom in ["chr1", "chr2", "chr3"]
+    ]
+    for chrom, start in queries:
+        ivs = [
+            Interval(chrom, start, start + 9, "+"),
+            Interval(chrom, start + 50, start + 59, "+"),
+        ]
+        assert reader.query(ivs) == [
+            sequences[chrom][start - 1 : start + 9],
+            sequences[chrom][start + 49 : start + 59],
+        ]
+    whole = [read for read in reads if read[1:] == (1, 1000)]
+    if cache_size:
+        assert sorted(whole) == [(chrom, 1, 1000) for chrom in sorted(sequences)]
+    else:
+        assert not whole
+    assert len(reads) <= 2 * len(queries)
@@ -0,0 +1,64 @@
+"""Tests for the packed genome"""
+
+import os
+
+import numpy as np
+import pytest
+
+from ribotricer.genome import PackedGenome
+from ribotricer.genome import pack_genome
+from ribotricer.genome import packed_genome_path
+
+from .test_orf_index import edit_in_place
+from .test_orf_index import touch
+
+
+@pytest.fixture
+def fasta_path(tmp_path):
+    """fasta file with soft-masked and N runs, large enough for edits
+    to be far from both ends"""
+    rng = np.random.RandomState(0)
+    sequences = {
+        "chr1": "".join(rng.choice(list("ACGTacgt"), 300000)),
+        "chr2": "NNNN" + "".join(rng.choice(list("ACGTRY"), 1001)) + "NN",
+        "chrM": "",
+    }
+    path = str(tmp_path / "genome.fa")
+    with open(path, "w") as output:
+        for name, sequence in sequences.items():
+            output.write(">{}\n".format(name))
+            for start in range(0, len(sequence), 60):
+                output.write(sequence[start : start + 60] + "\n")
+    return path, {name: sequence.upper() for name, sequence in sequences.items()}
+
+
+def test_packed_sequences(fasta_path):
+    path, sequences = fasta_path
+    assert pack_genome(path) == packed_genome_path(path)
+    assert packed_genome_path(path).endswith(".packed")
+    genome = PackedGenome.open(path)
+    assert genome is not None
+    for chrom, sequence in sequences.items():
+        assert genome.fetch(chrom, 1, len(sequence)) == sequence
+    assert genome.fetch("chr2", 3, 10) == sequences["chr2"][2:10]
+    assert genome.fetch("chr1", 1001, 1000) == ""
+
+
+def test_same_size_edit_makes_packed_genome_outdated(fasta_path):
+    path, _ = fasta_path
+    pack_genome(path)
+    edit_in_place(path, "A", "N")
+    assert PackedGenome.open(path) is None
+    pack_genome(path)
+    genome = PackedGenome.open(path)
+    assert genome.fetch("chr1", 1, 300000).count("N") == 1
+    assert not [name for name in os.listdir(os.path.dirname(path)) if ".tmp" in name]
+
+
+def test_touched_fasta_uses_packed_genome(fasta_path):
+    path, sequences = fasta_path
+    pack_genome(path)
+    touch(path)
+    genome = PackedGenome.open(path)
+    assert genome is not None
+    assert genome.fetch("chr2", 1, len(sequences["chr2"])) == sequences["chr2"]
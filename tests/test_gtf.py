@@ -0,0 +1,94 @@
+"""Tests for the parsed GTF cache"""
+
+import errno
+import os
+import shutil
+
+import pytest
+
+from ribotricer import common
+from ribotricer import gtf
+from ribotricer.gtf import GTFReader
+from ribotricer.gtf import gtf_cache_path
+
+from .test_orf_index import edit_in_place
+from .test_orf_index import touch
+
+
+@pytest.fixture
+def gtf_path(tmp_path):
+    """GTF file large enough for edits to be far from both ends"""
+    path = str(tmp_path / "annotation.gtf")
+    line = (
+        'chr1\tSIM\t{}\t{}\t{}\t.\t+\t.\tgene_id "G{:04d}"; '
+        'transcript_id "G{:04d}.T0"; gene_type "protein_coding"; '
+        'gene_name "NG{:04d}"; transcript_type "protein_coding";\n'
+    )
+    with open(path, "w") as output:
+        for i in range(1000):
+            start = 1000 * i + 1
+            output.write(line.format("exon", start, start + 599, i, i, i))
+            output.write(line.format("CDS", start + 100, start + 399, i, i, i))
+    return path
+
+
+def gene_names(reader):
+    """Gene names of the exon and CDS lines"""
+    names = [
+        track.gene_name for tracks in reader.transcript.values() for track in tracks
+    ]
+    for transcripts in reader.cds.values():
+        names += [
+            track.gene_name for tracks in transcripts.values() for track in tracks
+        ]
+    return set(names)
+
+
+def test_cache_is_used(gtf_path, monkeypatch):
+    reader = GTFReader(gtf_path)
+    assert os.path.isfile(os.path.join(gtf_cache_path(gtf_path), "meta.json"))
+
+    def parse_gtf(gtf_location):
+        raise AssertionError("GTF parsed again")
+
+    monkeypatch.setattr(gtf, "parse_gtf", parse_gtf)
+    cached = GTFReader(gtf_path)
+    assert cached.transcript.keys() == reader.transcript.keys()
+    assert gene_names(cached) == gene_names(reader)
+    assert len(cached.cds) == len(reader.cds) == 1000
+
+
+def test_touched_gtf_uses_cache(gtf_path, monkeypatch):
+    names = gene_names(GTFReader(gtf_path))
+    touch(gtf_path)
+
+    def parse_gtf(gtf_location):
+        raise AssertionError("GTF parsed again")
+
+    monkeypatch.setattr(gtf, "parse_gtf", parse_gtf)
+    assert gene_names(GTFReader(gtf_path)) == names
+
+
+def test_same_size_edit_makes_cache_outdated(gtf_path):
+    GTFReader(gtf_path)
+    edit_in_place(gtf_path, 'gene_name "NG', 'gene_name "NX')
+    names = gene_names(GTFReader(gtf_path))
+    assert len([name for name in names if name.startswith("NX")]) == 1
+    # the cache was replaced by the new one
+    assert gene_names(GTFReader(gtf_path)) == names
+
+
+def test_concurrent_cache_writes(gtf_path, monkeypatch):
+    def racing_rename(src, dst):
+        # another process moves its own cache into place first
+        shutil.copytree(src, dst)
+        raise OSError(errno.ENOTEMPTY, "Directory not empty")
+
+    monkeypatch.setattr(common.os, "rename", racing_rename)
+    reader = GTFReader(gtf_path)
+    monkeypatch.undo()
+    assert sorted(os.listdir(os.path.dirname(gtf_path))) == [
+        "annotation.gtf",
+        "annotation.gtf.parsed",
+    ]
+    assert gene_names(GTFReader(gtf_path)) == gene_names(reader)
@@ -0,0 +1,167 @@
+"""Tests for the tsv and binary ORF indexes"""
+
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+from ribotricer import common
+from ribotricer import orf_index
+
+from ribotricer.orf import ORF
+from ribotricer.orf import ORFTable
+from ribotricer.orf_index import ORFIndex
+from ribotricer.orf_index import ORFStream
+from ribotricer.orf_index import ORFWriter
+from ribotricer.orf_index import binary_index_path
+from ribotricer.orf_index import read_orf_table
+from ribotricer.orf_index import read_orfs
+
+from .conftest import make_orf
+from .conftest import write_index
+
+
+def orf_fields(orf):
+    return (
+        orf.oid,
+        orf.category,
+        orf.tid,
+        orf.ttype,
+        orf.gid,
+        orf.gname,
+        orf.gtype,
+        orf.chrom,
+        orf.strand,
+        orf.start_codon,
+        [(iv.start, iv.end) for iv in orf.intervals],
+    )
+
+
+def tsv_orfs(path):
+    with open(path) as anno:
+        anno.readline()
+        return [ORF.from_string(line) for line in anno]
+
+
+def edit_in_place(path, old, new):
+    """Replace the middle occurrence of text, keeping the size of the file"""
+    assert len(old) == len(new)
+    stat = os.stat(path)
+    with open(path) as handle:
+        text = handle.read()
+    middle = text.index(old, len(text) // 2)
+    with open(path, "w") as handle:
+        handle.write(text[:middle] + new + text[middle + len(old) :])
+    # a later edit, even within the resolution of the file system clock
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+
+def touch(path):
+    """Change the modification time of a file, not its content"""
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+
+def test_binary_index_matches_tsv(index_path, index_orfs):
+    index = ORFIndex.open(index_path)
+    assert index is not None
+    assert len(index) == len(index_orfs)
+    expected = [orf_fields(orf) for orf in tsv_orfs(index_path)]
+    assert [orf_fields(orf) for orf in index] == expected
+    assert [orf_fields(orf) for orf in index_orfs] == expected
+
+
+def test_tsv_and_binary_tables_are_equal(tmp_path, index_orfs):
+    binary = read_orf_table(write_index(index_orfs, str(tmp_path / "a.tsv")))
+    parsed = read_orf_table(
+        write_index(index_orfs, str(tmp_path / "b.tsv"), binary=False)
+    )
+    assert isinstance(binary, ORFIndex)
+    assert not isinstance(parsed, ORFIndex)
+    expected = parsed.to_arrays()
+    arrays = binary.to_arrays()
+    assert sorted(arrays) == sorted(expected)
+    for name, values in expected.items():
+        np.testing.assert_array_equal(arrays[name], values)
+
+
+def test_gzipped_index(tmp_path, index_orfs):
+    path = write_index(index_orfs, str(tmp_path / "candidate_orfs.tsv.gz"), True)
+    assert ORFIndex.open(path) is not None
+    os.remove(os.path.join(binary_index_path(path), "meta.json"))
+    assert ORFIndex.open(path) is None
+    assert [orf_fields(orf) for orf in read_orfs(path)] == [
+        orf_fields(orf) for orf in index_orfs
+    ]
+
+
+def test_same_size_edit_makes_binary_index_outdated(tmp_path):
+    # large enough for the edit to be far from both ends of the file
+    orfs = [
+        make_orf("uORF", "T{}".format(i), "chr1", "+", [(10 * i + 1, 10 * i + 9)])
+        for i in range(5000)
+    ]
+    path = write_index(orfs, str(tmp_path / "candidate_orfs.tsv"))
+    assert os.path.getsize(path) > 1 << 18
+    assert ORFIndex.open(path) is not None
+    edit_in_place(path, "\tgene", "\tGENE")
+    assert ORFIndex.open(path) is None
+    assert ORFStream(path).index is None
+    assert sum(orf.gname.startswith("GENE") for orf in read_orfs(path)) == 1
+
+
+def test_unchanged_index_is_not_read(index_path, monkeypatch):
+    def file_checksum(path):
+        raise AssertionError("{} read again".format(path))
+
+    monkeypatch.setattr(common, "file_checksum", file_checksum)
+    assert ORFIndex.open(index_path) is not None
+
+
+def test_touched_or_copied_index_is_up_to_date(index_path, tmp_path):
+    touch(index_path)
+    assert ORFIndex.open(index_path) is not None
+    # copies get a new modification time
+    copy = tmp_path / "copy"
+    copy.mkdir()
+    shutil.copy(index_path, str(copy))
+    shutil.copytree(
+        binary_index_path(index_path),
+        binary_index_path(str(copy / "candidate_orfs.tsv")),
+    )
+    assert ORFIndex.open(str(copy / "candidate_orfs.tsv")) is not None
+
+
+def test_categories(index_path):
+    index = read_orf_table(index_path, {"uORF"})
+    assert [orf.tid for orf in index] == ["T1", "T3"]
+
+
+@pytest.mark.parametrize("batch_size", [1, 4, 1000])
+def test_binary_index_written_in_batches(tmp_path, index_orfs, batch_size, monkeypatch):
+    monkeypatch.setattr(orf_index, "WRITE_BATCH_SIZE", batch_size)
+    path = str(tmp_path / "candidate_orfs.tsv")
+    with ORFWriter(path, binary=True) as writer:
+        for orf in index_orfs:
+            writer.write(orf)
+    table = ORFTable()
+    for orf in index_orfs:
+        table.append(orf)
+    expected = table.to_arrays()
+    assert sorted(os.listdir(binary_index_path(path))) == sorted(
+        ["{}.npy".format(name) for name in expected] + ["meta.json"]
+    )
+    arrays = ORFIndex.open(path).to_arrays()
+    for name, values in expected.items():
+        assert arrays[name].dtype == values.dtype
+        np.testing.assert_array_equal(arrays[name], values)
+
+
+def test_failed_write_leaves_no_files(tmp_path, index_orfs):
+    path = str(tmp_path / "candidate_orfs.tsv")
+    with pytest.raises(ValueError):
+        with ORFWriter(path, binary=True) as writer:
+            writer.write(index_orfs[0])
+            raise ValueError("search failed")
+    assert os.listdir(str(tmp_path)) == []
@@ -0,0 +1,115 @@
+"""Tests for reusing the ORFs of an earlier prepare-orfs run"""
+
+import json
+import os
+import shutil
+
+import pytest
+
+from ribotricer.fasta import FastaReader
+from ribotricer.gtf import GTFReader
+from ribotricer.orf_index import ORFWriter
+from ribotricer.orf_index import index_checksum
+from ribotricer.prepare_orfs import load_previous_index
+from ribotricer.prepare_orfs import manifest_path
+from ribotricer.prepare_orfs import transcript_digests
+from ribotricer.prepare_orfs import write_manifest
+
+from .conftest import make_orf
+from .test_orf_index import edit_in_place
+
+PARAMETERS = {
+    "min_orf_length": 30,
+    "start_codons": ["ATG"],
+    "stop_codons": ["TAA", "TAG", "TGA"],
+    "longest": False,
+}
+
+
+def previous_index(tmp_path, bgzip=False):
+    """Index with a manifest, large enough for edits to be far from both ends"""
+    orfs = [make_orf("annotated", "T0", "chr1", "+", [(1, 30)])]
+    orfs += [
+        make_orf("uORF", "T{}".format(i % 100), "chr1", "+", [(10 * i + 1, 10 * i + 9)])
+        for i in range(5000)
+    ]
+    path = str(tmp_path / "candidate_orfs.tsv")
+    if bgzip:
+        path += ".gz"
+    with ORFWriter(path, bgzip, binary=True) as writer:
+        for orf in orfs:
+            writer.write(orf)
+    digests = {"T{}".format(i): "digest{}".format(i) for i in range(100)}
+    write_manifest(path, PARAMETERS, digests, writer.checksum.hexdigest())
+    return path, digests
+
+
+def test_previous_index(tmp_path):
+    path, digests = previous_index(tmp_path)
+    previous_digests, orfs, rows = load_previous_index(path, PARAMETERS)
+    assert previous_digests == digests
+    assert len(orfs) == 5001
+    assert sorted(rows) == sorted(digests)
+    assert [orfs[row].tid for row in rows["T7"]] == ["T7"] * 50
+    assert load_previous_index(path, dict(PARAMETERS, longest=True)) is None
+
+
+def test_same_size_edit_makes_manifest_outdated(tmp_path):
+    path, _ = previous_index(tmp_path)
+    edit_in_place(path, "\tgene", "\tGENE")
+    assert load_previous_index(path, PARAMETERS) is None
+
+
+def load_manifest_checksum(path):
+    with open(manifest_path(path)) as manifest:
+        return json.load(manifest)["index"]
+
+
+@pytest.mark.parametrize("bgzip", [False, True])
+def test_copied_index_is_reused(tmp_path, bgzip):
+    path, digests = previous_index(tmp_path, bgzip)
+    assert index_checksum(path) == load_manifest_checksum(path)
+    # a copy without its binary index, with a new modification time
+    copy = tmp_path / "release"
+    copy.mkdir()
+    shutil.copy(path, str(copy))
+    shutil.copy(manifest_path(path), str(copy))
+    copied = str(copy / os.path.basename(path))
+    previous_digests, orfs, rows = load_previous_index(copied, PARAMETERS)
+    assert previous_digests == digests
+    assert len(orfs) == 5001
+
+
+def genome_digests(tmp_path, name, sequence):
+    """Digests of two transcripts with exons at 11-40,61-90 and 201-260"""
+    directory = tmp_path / name
+    directory.mkdir()
+    gtf_path = str(directory / "annotation.gtf")
+    line = (
+        'chr1\tSIM\texon\t{}\t{}\t.\t+\t.\tgene_id "{}"; '
+        'transcript_id "{}.T0"; gene_type "protein_coding"; '
+        'gene_name "{}"; transcript_type "protein_coding";\n'
+    )
+    with open(gtf_path, "w") as output:
+        for start, end, gene in [(11, 40, "G1"), (61, 90, "G1"), (201, 260, "G2")]:
+            output.write(line.format(start, end, gene, gene, gene))
+    fasta_path = str(directory / "genome.fa")
+    with open(fasta_path, "w") as output:
+        output.write(">chr1\n{}\n".format(sequence))
+    return transcript_digests(GTFReader(gtf_path), FastaReader(fasta_path), {})
+
+
+def test_digests_follow_exon_sequence(tmp_path):
+    sequence = "ACGT" * 75
+    digests = genome_digests(tmp_path, "genome", sequence)
+
+    def edit(name, position):
+        edited = sequence[: position - 1] + "N" + sequence[position:]
+        return genome_digests(tmp_path, name, edited)
+
+    # between the exons of G1, and after G2
+    assert edit("intron", 50) == digests
+    assert edit("intergenic", 280) == digests
+    edited = edit("exon", 70)
+    assert edited["G1.T0"] != digests["G1.T0"]
+    assert edited["G2.T0"] == digests["G2.T0"]
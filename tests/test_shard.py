@@ -0,0 +1,91 @@
+"""Tests for sharding an index and merging the detected ORFs"""
+
+import numpy as np
+import pytest
+
+from ribotricer.common import is_gzipped
+from ribotricer.detect_orfs import export_orf_coverages
+from ribotricer.orf_index import ORFIndex
+from ribotricer.orf_index import read_orfs
+from ribotricer.orf_index import read_orf_table
+from ribotricer.shard import merge_detected
+from ribotricer.shard import shard_index
+from ribotricer.shard import shard_index_path
+from ribotricer.shard import shard_rows
+
+from .conftest import write_index
+
+
+def test_shard_index_path():
+    assert (
+        shard_index_path("a/p_candidate_orfs.tsv", 2, 4)
+        == "a/p_candidate_orfs.shard2of4.tsv"
+    )
+    assert (
+        shard_index_path("p_candidate_orfs.tsv.gz", 1, 3)
+        == "p_candidate_orfs.shard1of3.tsv.gz"
+    )
+
+
+@pytest.fixture(params=[False, True], ids=["tsv", "gz"])
+def index(request, tmp_path, scored_index):
+    """scored_index, compressed or not"""
+    if not request.param:
+        return scored_index
+    path = str(tmp_path / "candidate_orfs.tsv.gz")
+    return write_index(list(read_orfs(scored_index)), path, bgzip=True)
+
+
+@pytest.mark.parametrize("n_shards", [1, 3, 7])
+def test_shards_cover_the_index(index, n_shards):
+    paths = shard_index(index, n_shards)
+    assert paths == [shard_index_path(index, i + 1, n_shards) for i in range(n_shards)]
+    oids = [orf.oid for orf in read_orfs(index)]
+    rows = {oid: row for row, oid in enumerate(oids)}
+    shard_oids = []
+    for path in paths:
+        assert is_gzipped(path) == is_gzipped(index)
+        assert ORFIndex.open(path) is not None
+        oids_of_shard = [orf.oid for orf in read_orfs(path)]
+        # ORFs keep their order in the index
+        assert [rows[oid] for oid in oids_of_shard] == sorted(
+            rows[oid] for oid in oids_of_shard
+        )
+        shard_oids += oids_of_shard
+    assert sorted(shard_oids) == sorted(oids)
+
+
+def test_same_start_in_one_shard(scored_index):
+    orfs = read_orf_table(scored_index)
+    shards = shard_rows(orfs, 5)
+    assert shards.min() >= 0 and shards.max() < 5
+    starts = orfs.array("exon_starts")[orfs.array("exon_offsets")[:-1]]
+    chroms = orfs.column("chrom")[0]
+    for key in set(zip(chroms.tolist(), starts.tolist())):
+        same = (chroms == key[0]) & (starts == key[1])
+        assert len(np.unique(shards[same])) == 1
+
+
+@pytest.mark.parametrize("n_shards", [2, 4])
+def test_merged_shards_match_the_index(index, coverage, tmp_path, n_shards):
+    prefix = str(tmp_path / "full")
+    export_orf_coverages(index, coverage, prefix, report_all=True)
+    detected = []
+    for shard, path in enumerate(shard_index(index, n_shards)):
+        shard_prefix = str(tmp_path / "shard{}".format(shard))
+        export_orf_coverages(path, coverage, shard_prefix, report_all=True)
+        detected.append("{}_translating_ORFs.tsv".format(shard_prefix))
+    out = str(tmp_path / "merged_translating_ORFs.tsv")
+    merge_detected(index, detected, out)
+    with open("{}_translating_ORFs.tsv".format(prefix)) as expected:
+        with open(out) as merged:
+            assert merged.read() == expected.read()
+
+
+def test_merge_rejects_unknown_orfs(index_orfs, scored_index, coverage, tmp_path):
+    prefix = str(tmp_path / "full")
+    export_orf_coverages(scored_index, coverage, prefix, report_all=True)
+    annotated = write_index(index_orfs[:2], str(tmp_path / "annotated.tsv"))
+    out = str(tmp_path / "merged.tsv")
+    with pytest.raises(ValueError, match="is not in the index"):
+        merge_detected(annotated, ["{}_translating_ORFs.tsv".format(prefix)], out)
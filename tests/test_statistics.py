@@ -0,0 +1,113 @@
+"""Tests for the phase scores"""
+
+from math import cos
+from math import pi
+from math import sin
+from math import sqrt
+import warnings
+
+import numpy as np
+import pytest
+from scipy import signal
+
+from ribotricer.statistics import coherence
+from ribotricer.statistics import phase_scores
+
+
+def scipy_coherence(original_values):
+    """Phase score computed frame by frame with scipy.signal.coherence"""
+    coh, valid = 0.0, -1
+    for frame in [0, 1, 2]:
+        values = original_values[frame:]
+        normalized_values = []
+        i = 0
+        while i + 2 < len(values):
+            if values[i] == values[i + 1] == values[i + 2] == 0:
+                i += 3
+            else:
+                real = (
+                    values[i]
+                    + values[i + 1] * cos(2 * pi / 3)
+                    + values[i + 2] * cos(4 * pi / 3)
+                )
+                image = values[i + 1] * sin(2 * pi / 3) + values[i + 2] * sin(
+                    4 * pi / 3
+                )
+                norm = sqrt(real**2 + image**2)
+                if norm == 0:
+                    norm = 1
+                normalized_values += [
+                    values[i] / norm,
+                    values[i + 1] / norm,
+                    values[i + 2] / norm,
+                ]
+                i += 3
+
+        length = len(normalized_values) // 3 * 3
+        if length == 0:
+            coh, valid = (0.0, 0)
+        else:
+            normalized_values = normalized_values[:length]
+            uniform_signal = [1, 0, 0] * (len(normalized_values) // 3)
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                f, Cxy = signal.coherence(
+                    normalized_values,
+                    uniform_signal,
+                    window=[1.0, 1.0, 1.0],
+                    nperseg=3,
+                    noverlap=0,
+                )
+                periodicity_score = Cxy[np.argwhere(np.isclose(f, 1 / 3.0))[0]][0]
+                if periodicity_score > coh:
+                    coh = periodicity_score
+                    valid = length // 3
+                if valid == -1:
+                    valid = length // 3
+    return np.sqrt(coh), valid
+
+
+def random_profiles(n_profiles, seed=0):
+    """Profiles of various lengths, periodicity and sparsity"""
+    rng = np.random.RandomState(seed)
+    profiles = []
+    for _ in range(n_profiles):
+        length = rng.randint(0, 60)
+        rates = rng.uniform(0, 3, 3)[np.arange(length) % 3]
+        profile = rng.poisson(rates) * (rng.uniform(size=length) < rng.uniform())
+        profiles.append(profile.tolist())
+    profiles += [[], [0], [1, 0], [0, 0, 0], [1, 0, 0] * 5, [0, 0, 0, 2, 2, 2]]
+    return profiles
+
+
+def test_phase_scores_match_scipy():
+    profiles = random_profiles(300)
+    cohs, valids = phase_scores(profiles)
+    expected = [scipy_coherence(profile) for profile in profiles]
+    np.testing.assert_allclose(cohs, [coh for coh, _ in expected], rtol=0, atol=1e-12)
+    assert valids.tolist() == [valid for _, valid in expected]
+
+
+@pytest.mark.parametrize("profile", random_profiles(20, seed=1))
+def test_coherence_matches_scipy(profile):
+    coh, valid = coherence(profile)
+    expected_coh, expected_valid = scipy_coherence(profile)
+    assert coh == pytest.approx(expected_coh, abs=1e-12)
+    assert valid == expected_valid
+
+
+def test_padded_profiles():
+    profiles = random_profiles(100, seed=2)
+    lengths = [len(profile) for profile in profiles]
+    padded = np.full((len(profiles), max(lengths)), 7, dtype=np.int64)
+    for row, profile in enumerate(profiles):
+        padded[row, : len(profile)] = profile
+    cohs, valids = phase_scores(padded, lengths)
+    expected_cohs, expected_valids = phase_scores(profiles)
+    np.testing.assert_array_equal(cohs, expected_cohs)
+    np.testing.assert_array_equal(valids, expected_valids)
+
+
+def test_no_profiles():
+    cohs, valids = phase_scores([])
+    assert len(cohs) == len(valids) == 0